@@ -0,0 +1,190 @@
+"""Using ltarchiver from other programs.
+
+An Archiver keeps the parsed recordbooks, the device topology and the verified
+recordbook checksums between calls, like the daemon does. Questions that the
+commands would ask on the terminal go to the prompt callback, progress goes to
+the on_progress callback and failures are raised as common.LTAError instead of
+exiting the process.
+
+    archiver = Archiver(prompt=lambda question, choices: "yes")
+    archiver.store(pathlib.Path("photos.tar"), pathlib.Path("/media/backup"))
+    results = archiver.verify()
+"""
+
+import contextlib
+import pathlib
+import threading
+import typing
+
+from ltarchiver import (
+    check_and_restore,
+    common,
+    directio,
+    jobs,
+    packing,
+    progress,
+    refresh_device,
+    store,
+    transaction,
+    verify,
+)
+
+# Calls swap the module level state of the commands, so only one runs at a time.
+_lock = threading.RLock()
+
+
+def _no_prompt(question: str, choices: typing.List[str]) -> str:
+    raise common.LTAError(f"An answer is needed but no prompt was given: {question}")
+
+
+class Archiver:
+    """Store, restore, refresh and verify files.
+
+    prompt is given a question and its possible answers and returns one of them.
+    Without it the operations don't ask for confirmation and fail when an answer
+    is needed. on_progress receives progress.Events for long operations.
+    """
+
+    def __init__(
+        self,
+        prompt: typing.Optional[common.Prompt] = None,
+        on_progress: typing.Optional[typing.Callable[[progress.Event], None]] = None,
+        direct_io: bool = False,
+    ):
+        self.prompt = prompt
+        self.on_progress = on_progress
+        self.direct_io = direct_io
+        self.cache = common.WarmCache()
+        with self._session():
+            transaction.recover()
+
+    @property
+    def interactive(self) -> bool:
+        return self.prompt is not None
+
+    @contextlib.contextmanager
+    def _session(self) -> typing.Iterator[None]:
+        """Install the state of this archiver for the duration of a call."""
+        with _lock:
+            saved = common.warm_cache, directio.enabled
+            common.warm_cache = self.cache
+            directio.enabled = self.direct_io
+            prompt_token = common.prompt_hook.set(self.prompt or _no_prompt)
+            progress_token = progress.sink.set(self.on_progress)
+            try:
+                yield
+            finally:
+                progress.sink.reset(progress_token)
+                common.prompt_hook.reset(prompt_token)
+                common.warm_cache, directio.enabled = saved
+
+    def store(
+        self,
+        source: pathlib.Path,
+        destination: pathlib.Path,
+        checksum: typing.Optional[str] = None,
+        keep_source: bool = True,
+        codec: str = "",
+        as_container: bool = False,
+    ):
+        """Store source on the device of the directory destination.
+
+        codec compresses it first, see ltarchiver.compression, and as_container
+        stores a directory as a container, see ltarchiver.container.
+        """
+        with self._session():
+            store.store(
+                pathlib.Path(source).resolve(),
+                pathlib.Path(destination).resolve(),
+                not self.interactive,
+                checksum=checksum,
+                keep_source=keep_source,
+                codec=codec,
+                as_container=as_container,
+            )
+
+    def store_many(
+        self,
+        sources: typing.Iterable[pathlib.Path],
+        destinations: typing.Iterable[pathlib.Path],
+        writers_per_device: int = 1,
+        codec: str = "",
+        as_container: bool = False,
+        pack_below: int = 0,
+    ) -> typing.List[jobs.Failure]:
+        """Store every source on every destination and return what failed.
+
+        The sources smaller than pack_below bytes are stored in packs, see
+        ltarchiver.packing.
+        """
+        destinations = [pathlib.Path(path).resolve() for path in destinations]
+        sources = list(
+            dict.fromkeys(pathlib.Path(path).resolve() for path in sources)
+        )
+        with self._session():
+            packed, packs = store.pack_small_files(sources, pack_below)
+            sources = [source for source in sources if source not in packed] + packs
+            try:
+                return jobs.run_jobs(
+                    [jobs.Job(source, destinations) for source in sources],
+                    writers_per_device,
+                    codec=codec,
+                    as_container=as_container,
+                )
+            finally:
+                for pack in packs:
+                    common.remove_file(pack)
+
+    def restore(
+        self,
+        backup: pathlib.Path,
+        destination: pathlib.Path,
+        member: typing.Optional[str] = None,
+    ):
+        """Check backup, repairing it if needed, and copy it to destination.
+
+        member restores only that file of a backup stored as a container. A
+        packed file is restored by giving its original path as backup.
+        """
+        backup = pathlib.Path(backup).resolve()
+        destination = pathlib.Path(destination)
+        if destination.is_dir():
+            destination = destination / (
+                pathlib.PurePosixPath(member).name if member else backup.name
+            )
+        with self._session():
+            entry = None if member or backup.exists() else packing.locate(backup)
+            if entry is not None:
+                check_and_restore.restore_packed(entry, destination)
+            elif member:
+                check_and_restore.restore_member(backup, member, destination)
+            else:
+                check_and_restore.restore(backup, destination, not self.interactive)
+
+    def refresh(self, device_path: pathlib.Path):
+        """Repair the damaged files of the device device_path is on."""
+        with self._session():
+            refresh_device.refresh_path(pathlib.Path(device_path))
+
+    def verify(
+        self,
+        paths: typing.Iterable[pathlib.Path] = (),
+        jobs: int = 4,
+        per_device: int = 1,
+    ) -> typing.List[verify.Result]:
+        """Check the files or devices at paths, every stored file without paths."""
+        with self._session():
+            roots = verify.DeviceRoots()
+            try:
+                records = verify.select_records(
+                    verify.current_records(),
+                    [pathlib.Path(path) for path in paths],
+                    roots,
+                )
+            except (AttributeError, FileNotFoundError) as err:
+                raise common.LTAError(str(err)) from err
+            return verify.verify_records(records, roots, jobs, per_device)
+
+    def forget(self):
+        """Drop what was cached, after the devices changed for example."""
+        self.cache = common.WarmCache()
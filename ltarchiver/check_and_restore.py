@@ -1,22 +1,46 @@
 """Restore command
 
 Usage:
-  ltarchiver-restore <backup> <destination>
+  ltarchiver-restore [options] <backup> <destination>
 
+Options:
+  --non-interactive  Don't ask for confirmation before starting.
+  --member=<name>    Restore only this file of a backup stored as a container,
+                     reading only the file and its part of the ECC.
+  --direct-io        Read the backup without going through the page cache.
+  --metrics=<file>   Record how long each phase took to file, as JSON lines or
+                     as a Prometheus textfile when file ends in .prom.
+  --profile=<file>   Profile the run with cProfile and save the stats to file.
+
+A file stored in a pack (see ltarchiver-store --pack-below) is restored by
+giving its original path as <backup>, its pack is found on whichever device
+with it is connected.
 """
 
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
 import os
 import pathlib
 import shutil
 import subprocess
 import shlex
+import typing
 
 from docopt import docopt
 
-from ltarchiver import common
+from ltarchiver import (
+    common,
+    directio,
+    instrument,
+    parity,
+    pipeline,
+    progress,
+    transaction,
+)
 
 from ltarchiver.common import (
-    error,
     file_ok,
     recordbook_checksum_file_path,
     recordbook_path,
@@ -30,45 +54,106 @@ from ltarchiver.common import (
 
 def run():
     arguments = docopt(__doc__)
+    directio.enabled = arguments["--direct-io"]
+    with instrument.session("restore", arguments["--metrics"], arguments["--profile"]):
+        run_command(arguments)
+
+
+def run_command(arguments: dict):
     backup_file_path = pathlib.Path(arguments["<backup>"]).resolve()
+    member = arguments["--member"]
     if pathlib.Path(arguments["<destination>"]).is_dir():
-        destination_path = (
-            pathlib.Path(arguments["<destination>"]) / backup_file_path.name
+        destination_path = pathlib.Path(arguments["<destination>"]) / (
+            pathlib.PurePosixPath(member).name if member else backup_file_path.name
         )
     else:
         destination_path = pathlib.Path(arguments["<destination>"])
-    restore(backup_file_path, destination_path)
+    if not member and not backup_file_path.exists():
+        from ltarchiver import packing
 
+        entry = packing.locate(backup_file_path)
+        if entry is not None:
+            try:
+                restore_packed(entry, destination_path)
+            except common.LTAError as err:
+                common.error(err.args[0])
+            return
+    if member:
+        try:
+            restore_member(backup_file_path, member, destination_path)
+        except common.LTAError as err:
+            common.error(err.args[0])
+        return
+    if arguments["--non-interactive"]:
+        from ltarchiver import daemon
 
-def restore(backup_file_path: pathlib.Path, destination_path: pathlib.Path):
+        if daemon.run_remotely(
+            "restore",
+            backup=str(backup_file_path),
+            destination=str(destination_path),
+        ):
+            return
+    transaction.recover()
+    try:
+        restore(backup_file_path, destination_path, arguments["--non-interactive"])
+    except common.LTAError as err:
+        common.error(err.args[0])
+
+
+def restore(
+    backup_file_path: pathlib.Path,
+    destination_path: pathlib.Path,
+    non_interactive: bool = False,
+):
+    """Restore backup_file_path to destination_path, raising LTAError on failure."""
     destination_path = destination_path.resolve()
     if destination_path == backup_file_path:
-        common.error("Backup and destination are the same.")
+        raise common.LTAError("Backup and destination are the same.")
     file_ok(backup_file_path)
     print(
         f"This program will check if there are any errors on the file {backup_file_path} and try to restore them if"
         f" necessary.\nDestination: {destination_path}"
     )
-    if not common.DEBUG:
-        input("Press ENTER to continue. Press Ctrl+C to abort.")
+    if not (common.DEBUG or non_interactive):
+        common.confirm("Press ENTER to continue. Press Ctrl+C to abort.")
+    partial_path = destination_path.with_name(destination_path.name + ".part")
+    try:
+        restore_file(backup_file_path, destination_path, partial_path)
+    finally:
+        common.remove_file(partial_path)
+
+
+def restore_file(
+    backup_file_path: pathlib.Path,
+    destination_path: pathlib.Path,
+    partial_path: pathlib.Path,
+):
+    """Restore the backup to destination.
+
+    The backup is copied to partial_path while its checksum is computed, so
+    a healthy backup is read only once. The copy is moved to the destination if
+    it matches the recordbook.
+    """
     file_ok(recordbook_checksum_file_path)
     local_record_is_valid = (
         subprocess.call(shlex.split(f"md5sum -c {recordbook_checksum_file_path}")) == 0
+        or common.repair_recordbook(recordbook_checksum_file_path, recordbook_path)
     )
-    dest_uuid, dest_root = common.get_device_uuid_and_root_from_path(backup_file_path)
-    metadata_dir = (
-        backup_file_path.parent / common.METADATA_DIR_NAME
-        if common.DEBUG
-        else dest_root / common.METADATA_DIR_NAME
-    )
+    metadata_dir = backup_metadata_dir(backup_file_path)
     backup_checksum_file = metadata_dir / "checksum.txt"
 
     backup_record_is_valid = False
     if backup_checksum_file.is_file() and os.access(backup_checksum_file, os.R_OK):
         backup_record_is_valid = (
             subprocess.call(shlex.split(f"md5sum -c {backup_checksum_file}")) == 0
+            or common.repair_recordbook(
+                backup_checksum_file, metadata_dir / common.recordbook_file_name
+            )
+        )
+    with instrument.span("copy", instrument.file_size(backup_file_path)):
+        backup_file_checksum = common.copy_with_checksum(
+            backup_file_path, partial_path
         )
-    backup_file_checksum = get_file_checksum(backup_file_path)
     # check if file is in either record
     local_record = record_of_file(
         recordbook_path, backup_file_checksum, backup_file_path
@@ -93,12 +178,12 @@ def restore(backup_file_path: pathlib.Path, destination_path: pathlib.Path):
                     record = backup_record
                     try_copy_recordbook(recordbook_backup_path, recordbook_path)
                 else:
-                    input(
+                    common.confirm(
                         "The file was found in both recordbooks but they (the recordbooks) don't match their checksums. Press CTR+C to"
                         " abort or Enter to try continuing with the restoration."
                     )
             else:
-                input(
+                common.confirm(
                     "The file was found only in the local recordbook but its checksum doesn't match. Press CTR+C to"
                     " abort or Enter to try continuing with the restoration."
                 )
@@ -108,46 +193,67 @@ def restore(backup_file_path: pathlib.Path, destination_path: pathlib.Path):
                 record = backup_record
                 try_copy_recordbook(recordbook_backup_path, recordbook_path)
             else:
-                input(
+                common.confirm(
                     "The file was only found in the backup recordbook but it doesn't match the checksum. Press CTR+C to"
                     " abort or Enter to try continuing with the restoration."
                 )
         else:
-            error(
+            raise common.LTAError(
                 f"Neither {backup_file_path.name} or its checksum was found in the recordbooks"
             )
 
-    backup_md5 = get_file_checksum(backup_file_path)
-    original_ecc_file_path = (metadata_dir / "ecc") / record.checksum
-    original_ecc_checksum = get_file_checksum(original_ecc_file_path)
+    backup_md5 = backup_file_checksum
+    if backup_md5 != record.checksum and restore_from_replicas(
+        record,
+        backup_file_path,
+        partial_path,
+        common.find_ecc_file(metadata_dir, record.checksum),
+    ):
+        backup_md5 = record.checksum
+    original_ecc_file_path, original_ecc_checksum = common.hash_ecc_file(
+        metadata_dir, record.checksum
+    )
+    if original_ecc_checksum is None:
+        raise common.LTAError(f"{original_ecc_file_path} doesn't exist")
     if backup_md5 == record.checksum and original_ecc_checksum == record.ecc_checksum:
-        print("No errors detected on the file. Beginning copy.")
-        shutil.copyfile(backup_file_path, destination_path)
+        print("No errors detected on the file.")
+        if record.compression:
+            decompress(record, partial_path, destination_path)
+        else:
+            common.fsync_file(partial_path)
+            os.replace(partial_path, destination_path)
         print("File was successfully copied. Goodbye.")
-        exit(0)
     elif backup_md5 == record.checksum and original_ecc_checksum != record.ecc_checksum:
-        print(
+        raise common.LTAError(
             "Only the ecc differs from what's stored in the recordbook. The fastest way to go is to call the restore"
             " routine on this file again."
         )
-        exit(1)
     else:
         print(
             "Checksum doesn't match. Attempting to restore the file onto destination."
         )
         new_ecc_file_path = recordbook_dir / "temp_ecc.bin"
-        subprocess.check_call(
-            [
-                "c-ltarchiver/out/ltarchiver_restore",
-                str(backup_file_path),
-                str(destination_path),
-                str(original_ecc_file_path),
-                str(new_ecc_file_path),
-            ]
-        )
+        # a compressed file is repaired first and decompressed afterwards
+        repaired_path = partial_path if record.compression else destination_path
+        with instrument.span(
+            "ecc-decode", instrument.file_size(backup_file_path)
+        ), progress.watch_files(
+            f"Restoring {backup_file_path.name}",
+            [repaired_path],
+            instrument.file_size(backup_file_path),
+        ):
+            common.decode_ecc(
+                backup_file_path,
+                repaired_path,
+                original_ecc_file_path,
+                new_ecc_file_path,
+                record.holes,
+            )
         print("Checking if the restoration succeeded...")
-        new_ecc_checksum = get_file_checksum(new_ecc_file_path)
-        destination_checksum = get_file_checksum(destination_path)
+        with instrument.span("ecc-hash", instrument.file_size(new_ecc_file_path)):
+            new_ecc_checksum = get_file_checksum(new_ecc_file_path)
+        with instrument.span("hash", instrument.file_size(repaired_path)):
+            destination_checksum = get_file_checksum(repaired_path)
         failed = False
         if new_ecc_checksum != record.ecc_checksum:
             print("The restored ECC doesn't match what was expected.")
@@ -156,15 +262,306 @@ def restore(backup_file_path: pathlib.Path, destination_path: pathlib.Path):
             print("The file doesn't match what was expected.")
             failed = True
         if failed:
-            print(
+            raise common.LTAError(
                 "Sorry! Failed to restore the requested file. You are on your own now."
             )
-            exit(1)
         else:
+            if record.compression:
+                decompress(record, repaired_path, destination_path)
             subprocess.check_call(["cp", new_ecc_file_path, original_ecc_file_path])
             os.remove(new_ecc_file_path)
             print("Restoration successful!")
-            exit(0)
+
+
+def replica_paths(
+    record: common.Record, backup_file_path: pathlib.Path
+) -> typing.List[pathlib.Path]:
+    """The other copies of the file of record on the connected devices."""
+    paths = []
+    for other in get_records(recordbook_path):
+        if other.deleted or other.checksum != record.checksum:
+            continue
+        try:
+            path = common.get_root_from_uuid(other.destination) / other.file_name
+        except AttributeError:
+            continue  # the device isn't connected
+        if path.is_file() and path.resolve() != backup_file_path and path not in paths:
+            paths.append(path)
+    return paths
+
+
+def restore_from_replicas(
+    record: common.Record,
+    backup_file_path: pathlib.Path,
+    partial_path: pathlib.Path,
+    ecc_file_path: pathlib.Path,
+) -> bool:
+    """Put an intact copy of the file of record in partial_path, from its replicas.
+
+    partial_path has the damaged copy read from backup_file_path. Returns False
+    when some chunks are damaged on every copy, the ECC is used then.
+    """
+    replicas = replica_paths(record, backup_file_path)
+    if not replicas:
+        return False
+    print(f"{backup_file_path} is damaged, checking its {len(replicas)} other copies.")
+    copies = [partial_path, *replicas]
+    merged = partial_path.with_name(partial_path.name + ".merged")
+    try:
+        with instrument.span("replicas", instrument.file_size(backup_file_path)):
+            owners = verify_chunks(record, copies, ecc_file_path, partial_path)
+            if not merge_copies(record, copies, merged, owners):
+                return False
+        os.replace(merged, partial_path)
+    finally:
+        common.remove_file(merged)
+    print("The damaged chunks were read from the other copies.")
+    print(f"Run ltarchiver-refresh on the device of {backup_file_path} to repair it.")
+    return True
+
+
+def verify_chunks(
+    record: common.Record,
+    copies: typing.List[pathlib.Path],
+    ecc_file_path: pathlib.Path,
+    partial_path: pathlib.Path,
+) -> typing.Optional[bytearray]:
+    """Which of copies has each chunk of the file of record intact.
+
+    The encoder computes the ECC of every copy at once, each on its own device,
+    next to partial_path, and the ECC of each chunk is compared to the one in
+    ecc_file_path. The encoders still running are stopped once every chunk has
+    an intact copy. Item i is 1 plus the index of a copy with chunk i intact, 0
+    when there's none. None when the chunks can't be checked: the ECC of a file
+    with holes covers its data without the holes and not its chunks.
+    """
+    if record.holes or not ecc_file_path.exists():
+        return None
+    sizes = [instrument.file_size(copy) for copy in copies]
+    count = -(-max(sizes) // record.chunksize)
+    owners = bytearray(count)
+    missing = count
+    computed = [
+        partial_path.with_name(f"{partial_path.name}.ecc{index}")
+        for index in range(len(copies))
+    ]
+    processes = [
+        subprocess.Popen(common.encoder_command(copy, ecc))
+        for copy, ecc in zip(copies, computed)
+    ]
+    try:
+        with concurrent.futures.ThreadPoolExecutor(len(processes)) as executor:
+            futures = {
+                executor.submit(process.wait): index
+                for index, process in enumerate(processes)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                index = futures[future]
+                if future.result() == 0:
+                    missing -= _mark_intact(
+                        owners,
+                        index,
+                        computed[index],
+                        ecc_file_path,
+                        sizes[index],
+                        record,
+                    )
+                if not missing:
+                    break
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+    finally:
+        for process in processes:
+            process.wait()
+        for ecc in computed:
+            common.remove_file(ecc)
+    return owners
+
+
+def _mark_intact(
+    owners: bytearray,
+    index: int,
+    computed: pathlib.Path,
+    ecc_file_path: pathlib.Path,
+    size: int,
+    record: common.Record,
+) -> int:
+    """Make copy index the owner of its chunks that computed says are intact.
+
+    The ECC file holds eccsize bytes per chunk, in order, after a header. Returns
+    how many chunks got their first owner.
+    """
+    eccsize = record.eccsize
+    count = min(-(-size // record.chunksize), len(owners))
+    header = instrument.file_size(computed) - count * eccsize
+    if header < 0:
+        return 0
+    found = 0
+    per_read = max(pipeline.block_size // eccsize, 1)
+    with computed.open("rb") as ours, ecc_file_path.open("rb") as expected:
+        ours.seek(header)
+        expected.seek(header)
+        for first in range(0, count, per_read):
+            last = min(first + per_read, count)
+            block = ours.read((last - first) * eccsize)
+            expected_block = expected.read((last - first) * eccsize)
+            for chunk in range(first, last):
+                offset = (chunk - first) * eccsize
+                if (
+                    not owners[chunk]
+                    and block[offset : offset + eccsize]
+                    == expected_block[offset : offset + eccsize]
+                    and len(expected_block) >= offset + eccsize
+                ):
+                    owners[chunk] = index + 1
+                    found += 1
+    return found
+
+
+def merge_copies(
+    record: common.Record,
+    copies: typing.List[pathlib.Path],
+    destination: pathlib.Path,
+    owners: typing.Optional[bytearray] = None,
+) -> bool:
+    """Write to destination each chunk from a copy where it's intact.
+
+    owners, from verify_chunks, tells which copy has each chunk intact. The
+    chunks no copy has intact are taken as most copies have them when there are
+    three copies or more, from the first copy otherwise, for the ECC to repair.
+    Returns whether destination matches record.
+    """
+    chunksize = record.chunksize
+    per_read = max(pipeline.block_size // chunksize, 1) * chunksize
+    md5 = hashlib.md5()
+    with contextlib.ExitStack() as stack:
+        fds = [stack.enter_context(copy.open("rb")).fileno() for copy in copies]
+        out = stack.enter_context(destination.open("wb"))
+        size = max(os.fstat(fd).st_size for fd in fds)
+        for start in range(0, size, per_read):
+            # the first copy is local, the others are only read where needed
+            read = fds if owners is None else fds[:1]
+            blocks = [os.pread(fd, per_read, start) for fd in read]
+            for offset in range(0, min(per_read, size - start), chunksize):
+                chunk_index = (start + offset) // chunksize
+                owner = owners[chunk_index] if owners is not None else 0
+                if owner == 1:
+                    chunk = blocks[0][offset : offset + chunksize]
+                elif owner:
+                    chunk = os.pread(fds[owner - 1], chunksize, start + offset)
+                elif owners is None:
+                    chunk = _vote(
+                        [block[offset : offset + chunksize] for block in blocks]
+                    )
+                else:
+                    chunk = _vote(
+                        [os.pread(fd, chunksize, start + offset) for fd in fds]
+                    )
+                md5.update(chunk)
+                out.write(chunk)
+    return md5.hexdigest() == record.checksum
+
+
+def _vote(chunks: typing.List[bytes]) -> bytes:
+    """The chunk most copies agree on, from three copies or more."""
+    # a truncated copy has no say on what is past its end
+    present = [chunk for chunk in chunks if chunk]
+    if len(present) >= 3:
+        chunk, votes = collections.Counter(present).most_common(1)[0]
+        if votes > 1:
+            return chunk
+    return present[0] if present else b""
+
+
+def backup_metadata_dir(backup_file_path: pathlib.Path) -> pathlib.Path:
+    if common.DEBUG:
+        return backup_file_path.parent / common.METADATA_DIR_NAME
+    _, dest_root = common.get_device_uuid_and_root_from_path(backup_file_path)
+    return dest_root / common.METADATA_DIR_NAME
+
+
+def restore_member(
+    backup_file_path: pathlib.Path, name: str, destination_path: pathlib.Path
+):
+    """Restore the member name of the container backup_file_path to destination_path.
+
+    Only the member is read and, if it is damaged, only its part of the ECC. The
+    ECC itself isn't repaired, refresh or a restore of the whole container do that.
+    """
+    from ltarchiver import container
+
+    destination_path = destination_path.resolve()
+    if destination_path == backup_file_path:
+        raise common.LTAError("Backup and destination are the same.")
+    file_ok(backup_file_path)
+    metadata_dir = backup_metadata_dir(backup_file_path)
+    # the checksum of the whole container isn't known without reading all of it
+    record = record_of_file(recordbook_path, "", backup_file_path) or record_of_file(
+        metadata_dir / recordbook_file_name, "", backup_file_path
+    )
+    if record is None:
+        raise common.LTAError(
+            f"{backup_file_path.name} was not found in the recordbooks"
+        )
+    member = container.find_member(container.read_index(backup_file_path), name)
+    partial_path = destination_path.with_name(destination_path.name + ".part")
+    try:
+        with instrument.span("copy", member.size):
+            intact = container.extract_member(backup_file_path, member, partial_path)
+        if intact:
+            print("No errors detected on the file.")
+        else:
+            print("Checksum doesn't match. Attempting to restore the file.")
+            with instrument.span("ecc-decode", member.size):
+                container.repair_member(
+                    backup_file_path,
+                    common.find_ecc_file(metadata_dir, record.checksum),
+                    member,
+                    partial_path,
+                    record.chunksize,
+                    record.eccsize,
+                )
+        common.fsync_file(partial_path)
+        os.replace(partial_path, destination_path)
+    finally:
+        common.remove_file(partial_path)
+    print("File was successfully copied. Goodbye.")
+
+
+def restore_packed(entry: dict, destination_path: pathlib.Path):
+    """Restore a packed file, entry is its line of the pack index."""
+    for record in get_records(recordbook_path):
+        if record.deleted or record.file_name != entry["pack"]:
+            continue
+        try:
+            root = common.get_root_from_uuid(record.destination)
+        except AttributeError:
+            continue  # try the other devices the pack is on
+        restore_member(root / entry["pack"], entry["member"], destination_path)
+        return
+    raise common.LTAError(
+        f"{entry['source']} was packed in {entry['pack']} but no device with it is"
+        " connected"
+    )
+
+
+def decompress(
+    record: common.Record, compressed: pathlib.Path, destination_path: pathlib.Path
+):
+    """Decompress the restored copy of a compressed file to destination_path."""
+    from ltarchiver import compression
+
+    decompressed = destination_path.with_name(destination_path.name + ".decompressing")
+    try:
+        with instrument.span("decompress", instrument.file_size(compressed)):
+            compression.decompress_file(
+                compressed, decompressed, *compression.parse(record.compression)
+            )
+        common.fsync_file(decompressed)
+        os.replace(decompressed, destination_path)
+    finally:
+        common.remove_file(decompressed)
 
 
 def try_copy_recordbook(source, destination):
@@ -182,17 +579,19 @@ def try_copy_recordbook(source, destination):
         print(f"{destination} has files that {source} doesn't")
         has_more = True
     if has_more:
+        question = f"Do you want to overwrite {destination} with the contents of {source} (yes/no/abort)?"
         while True:
-            answer = input(
-                f"Do you want to overwrite {destination} with the contents of {source} (yes/no/abort)?"
-            ).lower()
+            answer = common.ask(question, ["yes", "no", "abort"])
+            if answer is None:
+                answer = input(question).lower()
             if answer == "yes":
                 shutil.copy(source, destination)
+                parity.write(destination)
                 return
             elif answer == "no":
                 return
             elif answer == "abort":
-                exit(1)
+                raise common.LTAError("Aborted by the request of the user")
             else:
                 pass
 
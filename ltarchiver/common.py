@@ -1,16 +1,24 @@
+import contextlib
+import contextvars
 import datetime
 import enum
+import hashlib
 import os
 import pathlib
+import re
 import shlex
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import typing
-import psutil
 from os import access, R_OK, W_OK
 import dataclasses
 
+from ltarchiver import directio, instrument, parity, pipeline, progress, sparse
+
 METADATA_DIR_NAME = ".ltarchiver"
 
 recordbook_file_name = "recordbook.txt"
@@ -24,8 +32,12 @@ recordbook_path = recordbook_dir / recordbook_file_name
 recordbook_checksum_file_path = recordbook_dir / "checksum.txt"
 RECORD_PATH = recordbook_dir / "new_transaction.txt"
 ecc_dir_name = "ecc"
+# ECC files are spread over ecc/<2 hex digits>/<2 hex digits>/ so that no
+# directory gets huge
+ecc_shard_levels = 2
 chunksize = 1024  # bytes
 eccsize = 16  # bytes
+resumable_store_min_size = 64 * 1024 * 1024  # bytes
 
 
 class LTAError(Exception):
@@ -71,6 +83,11 @@ class TerminalMenu:
     def show(self):
         callbacks = list(self.options.values())
         while True:
+            answer = ask(self.title, list(self.options.keys()))
+            if answer is not None:
+                if self.options[answer]() == TerminalMenu.REDISPLAY_MENU:
+                    continue
+                break
             print(self.title)
             option_count = 1
             for text in self.options.keys():
@@ -105,36 +122,57 @@ class Record:
     checksum_algorithm: str = "md5"
     deleted: bool = False
     version: int = 1
+    generation: int = dataclasses.field(default=0, compare=False)
+    # the ECC of a file with holes covers only its data, see ltarchiver.sparse
+    holes: sparse.Holes = ()
+    # the codec the file was compressed with, see ltarchiver.compression
+    compression: str = ""
+    # which shard of a file spread over several devices, see ltarchiver.erasure
+    stripe: str = ""
 
     def write(self, recordbook: pathlib.Path = recordbook_path):
         with recordbook.open("at") as f:
-            f.write("Item\n")
-            f.write(f"Version: {self.version}\n")
-            f.write(f"Deleted: {self.deleted}\n")
-            f.write(f"File-Name: {self.file_name}\n")
-            f.write(f"Source: {self.source.resolve()}\n")
-            f.write(f"Destination: {self.destination}\n")
-            f.write(f"Bytes-per-chunk: {self.chunksize}\n")
-            f.write(f"EC-bytes-per-chunk: {self.eccsize}\n")
-            f.write(f"Timestamp: {datetime.datetime.now().isoformat()}\n")
-            f.write(f"Checksum-Algorithm: {self.checksum_algorithm}\n")
-            f.write(f"Checksum: {self.checksum}\n")
-            f.write(f"ECC-Checksum: {self.ecc_checksum}\n")
-
-    def get_validation(self) -> Validation:
-        """True if file exists and checksum matches"""
-        root = get_root_from_uuid(self.destination)
+            self.write_to(f)
+
+    def write_to(self, f: typing.TextIO):
+        f.write("Item\n")
+        f.write(f"Version: {self.version}\n")
+        f.write(f"Generation: {self.generation}\n")
+        f.write(f"Deleted: {self.deleted}\n")
+        f.write(f"File-Name: {self.file_name}\n")
+        f.write(f"Source: {self.source.resolve()}\n")
+        f.write(f"Destination: {self.destination}\n")
+        f.write(f"Bytes-per-chunk: {self.chunksize}\n")
+        f.write(f"EC-bytes-per-chunk: {self.eccsize}\n")
+        f.write(f"Timestamp: {self.timestamp.isoformat()}\n")
+        f.write(f"Checksum-Algorithm: {self.checksum_algorithm}\n")
+        f.write(f"Checksum: {self.checksum}\n")
+        f.write(f"ECC-Checksum: {self.ecc_checksum}\n")
+        if self.holes:
+            f.write(f"Holes: {sparse.format_holes(self.holes)}\n")
+        if self.compression:
+            f.write(f"Compression: {self.compression}\n")
+        if self.stripe:
+            f.write(f"Stripe: {self.stripe}\n")
+
+    def get_validation(self, root: typing.Optional[pathlib.Path] = None) -> Validation:
+        """True if file exists and checksum matches
+
+        root is where the device of the record is mounted, looked up when not given.
+        """
+        if root is None:
+            root = get_root_from_uuid(self.destination)
         path = self.file_path(root)
         if not path.exists():
             return Validation.DOESNT_EXIST
-        checksum = get_file_checksum(path)
+        with instrument.span("hash", instrument.file_size(path)):
+            checksum = get_file_checksum(path)
         if checksum != self.checksum:
             return Validation.CORRUPTED
 
-        ecc_file_path = self.ecc_file_path(root)
-        if not ecc_file_path.exists():
+        _, checksum = hash_ecc_file(root / METADATA_DIR_NAME, self.checksum)
+        if checksum is None:
             return Validation.ECC_DOESNT_EXIST
-        checksum = get_file_checksum(ecc_file_path)
         if checksum != self.ecc_checksum:
             return Validation.ECC_CORRUPTED
         return Validation.VALID
@@ -142,20 +180,299 @@ class Record:
     def file_path(self, root: pathlib.Path):
         return root / self.file_name
 
+    def identity(self) -> typing.Tuple[str, str, str]:
+        """What stays the same when a record is refreshed or deleted."""
+        return self.file_name, self.destination, self.checksum
+
     def ecc_file_path(self, root: pathlib.Path) -> pathlib.Path:
-        return root / METADATA_DIR_NAME / ecc_dir_name / self.checksum
+        return find_ecc_file(root / METADATA_DIR_NAME, self.checksum)
 
     def __str__(self):
         return f"Record of {self.file_name} stored on {self.destination}"
 
 
+@dataclasses.dataclass
+class RecordbookHeader:
+    """Generation counters kept at the top of a recordbook, before the first Item.
+
+    The generation is bumped on every change to the recordbook and each record is
+    tagged with the generation that introduced it. The high-water marks map a
+    device UUID to the last generation on which the home recordbook and the
+    recordbook of that device agreed.
+    """
+
+    generation: int = 0
+    high_water_marks: typing.Dict[str, int] = dataclasses.field(default_factory=dict)
+
+    def text(self) -> str:
+        lines = [f"Recordbook-Generation: {self.generation}\n"]
+        for device_uuid, mark in sorted(self.high_water_marks.items()):
+            lines.append(f"High-Water-Mark: {device_uuid} {mark}\n")
+        return "".join(lines)
+
+    def copy(self) -> "RecordbookHeader":
+        return RecordbookHeader(self.generation, dict(self.high_water_marks))
+
+
+class Divergence(enum.Enum):
+    IN_SYNC = "The recordbooks are in sync"
+    HOME_AHEAD = "The home recordbook has entries the device doesn't"
+    DEVICE_AHEAD = "The device recordbook has entries the home doesn't"
+    DIVERGED = "Both recordbooks changed since they were last synced"
+    UNKNOWN = "The recordbooks were never synced with generation counters"
+
+    def __str__(self):
+        return self.value
+
+
 def error(msg: str):
     print(msg, file=sys.stderr)
     exit(1)
 
 
-def get_file_checksum(source: pathlib.Path):
-    return subprocess.check_output([f"md5sum", source], encoding="utf-8").split()[0]
+# Answers the questions of the commands instead of the terminal when set. It's
+# given the question and the possible answers and returns one of them.
+Prompt = typing.Callable[[str, typing.List[str]], str]
+prompt_hook: contextvars.ContextVar[typing.Optional[Prompt]] = contextvars.ContextVar(
+    "prompt_hook", default=None
+)
+
+
+def ask(question: str, choices: typing.List[str]) -> typing.Optional[str]:
+    """The answer of the prompt hook, None when the terminal must be used."""
+    hook = prompt_hook.get()
+    if hook is None:
+        return None
+    answer = hook(question, choices)
+    if answer not in choices:
+        raise LTAError(f"{answer!r} is not one of {choices}")
+    return answer
+
+
+def confirm(message: str):
+    """Give the user a chance to abort."""
+    answer = ask(message, ["continue", "abort"])
+    if answer is None:
+        input(message)
+    elif answer == "abort":
+        raise LTAError("Aborted by the request of the user")
+
+
+def ask_yes_no(question: str) -> bool:
+    answer = ask(question, ["yes", "no"])
+    if answer is None:
+        import yesno
+
+        return yesno.input_until_bool(question)
+    return answer == "yes"
+
+
+def _stopper(stop: typing.Optional[threading.Event], message: str):
+    def check_stop(block):
+        if stop is not None and stop.is_set():
+            raise LTAError(message)
+
+    return check_stop
+
+
+def get_file_checksum(
+    source: pathlib.Path, stop: typing.Optional[threading.Event] = None
+):
+    """md5 of source, computed in-process so its progress can be shown.
+
+    Setting stop interrupts the hashing with an LTAError.
+    """
+    md5 = hashlib.md5()
+    with directio.Reader(source) as reader, progress.Progress(
+        f"Hashing {source.name}", reader.size
+    ) as hashing:
+        pipeline.run(
+            reader,
+            compute=[
+                _stopper(stop, f"Stopped hashing {source}"),
+                md5.update,
+                lambda block: hashing.advance(len(block)),
+            ],
+        )
+    return md5.hexdigest()
+
+
+def copy_with_checksum(
+    source: pathlib.Path,
+    destination: pathlib.Path,
+    stop: typing.Optional[threading.Event] = None,
+    tee: typing.Optional[typing.Callable[[memoryview], None]] = None,
+) -> str:
+    """Copy source to destination and return its md5, reading source only once.
+
+    The holes of source are left as holes on destination. tee is also given
+    every block read, in order. Setting stop interrupts the copy with an
+    LTAError.
+    """
+    md5 = hashlib.md5()
+    holes = sparse.find_holes(source)
+    with directio.Reader(source) as reader, destination.open(
+        "wb"
+    ) as out, progress.Progress(f"Copying {source.name}", reader.size) as copying:
+        writer = sparse.Writer(out, holes)
+        pipeline.run(
+            reader,
+            write=writer.write,
+            compute=[
+                _stopper(stop, f"Stopped copying {source}"),
+                md5.update,
+                lambda block: copying.advance(len(block)),
+                *([tee] if tee is not None else []),
+            ],
+        )
+        writer.finish()
+    return md5.hexdigest()
+
+
+def expected_ecc_size(size: int) -> int:
+    """Roughly how big the ECC of size bytes is."""
+    return -(-size // chunksize) * eccsize
+
+
+@contextlib.contextmanager
+def temporary_file(suffix: str) -> typing.Iterator[pathlib.Path]:
+    """A path in the recordbook directory that is removed afterwards."""
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=recordbook_dir)
+    os.close(fd)
+    try:
+        yield pathlib.Path(path)
+    finally:
+        remove_file(pathlib.Path(path))
+
+
+@contextlib.contextmanager
+def named_pipe(
+    mode: str, work: typing.Callable[[typing.BinaryIO], None]
+) -> typing.Iterator[pathlib.Path]:
+    """A pipe for a program that takes paths, work has the other end.
+
+    work writes what the program reads when mode is "wb" and reads what it
+    writes when mode is "rb", in a thread. Nothing goes through a disk. The
+    errors of work are raised once the program is done.
+    """
+    directory = pathlib.Path(tempfile.mkdtemp(prefix="ltarchiver-"))
+    path = directory / "pipe"
+    os.mkfifo(path)
+    errors: typing.List[BaseException] = []
+
+    def run():
+        try:
+            with path.open(mode) as f:
+                work(f)
+        except BaseException as err:
+            errors.append(err)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield path
+    finally:
+        # Opening a pipe waits for its other end, so work waits for programs that
+        # never open it until the other end is opened here.
+        if mode == "wb":
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                if os.read(fd, 1):
+                    errors.append(LTAError(f"{path} wasn't read to the end"))
+            except BlockingIOError:
+                pass
+            finally:
+                os.close(fd)
+        else:
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass  # work is done with the pipe already
+        thread.join()
+        shutil.rmtree(directory, ignore_errors=True)
+    if errors:
+        raise errors[0]
+
+
+def encode_ecc(
+    source: pathlib.Path, ecc_file_path: pathlib.Path, holes: sparse.Holes = ()
+):
+    """Write the ECC of source to ecc_file_path without copying source anywhere.
+
+    When holes are given only the data around them is encoded.
+    """
+    if holes:
+        encode_stream(
+            lambda out: sparse.write_packed(source, holes, out),
+            ecc_file_path,
+            sparse.data_size(instrument.file_size(source), holes),
+            f"Encoding {source.name}",
+        )
+    else:
+        size = instrument.file_size(source)
+        _encode(source, ecc_file_path, size, f"Encoding {source.name}")
+
+
+def encode_stream(
+    feed: typing.Callable[[typing.BinaryIO], None],
+    ecc_file_path: pathlib.Path,
+    size: int,
+    label: str,
+):
+    """Write the ECC of the size bytes feed writes to the file it's given."""
+    with named_pipe("wb", feed) as pipe:
+        _encode(pipe, ecc_file_path, size, label)
+
+
+def _encode(source: pathlib.Path, ecc_file_path: pathlib.Path, size: int, label: str):
+    with instrument.span("ecc-encode", size), progress.watch_files(
+        label, [ecc_file_path], expected_ecc_size(size)
+    ):
+        subprocess.check_call(encoder_command(source, ecc_file_path))
+
+
+def encoder_command(
+    source: pathlib.Path, ecc_file_path: pathlib.Path
+) -> typing.List[str]:
+    """The encoder writing only the ECC of source."""
+    return [
+        "c-ltarchiver/out/ltarchiver_store",
+        str(source),
+        os.devnull,
+        str(ecc_file_path),
+    ]
+
+
+def decode_ecc(
+    source: pathlib.Path,
+    destination: pathlib.Path,
+    ecc_file_path: pathlib.Path,
+    new_ecc_file_path: pathlib.Path,
+    holes: sparse.Holes = (),
+):
+    """Write source repaired with its ECC to destination, and the ECC repaired.
+
+    holes are those of the record of source, the ECC covers only the data around
+    them.
+    """
+    if holes:
+        size = source.stat().st_size
+        with named_pipe(
+            "wb", lambda out: sparse.write_packed(source, holes, out)
+        ) as packed, named_pipe(
+            "rb", lambda f: sparse.read_packed(f, destination, holes, size)
+        ) as repaired:
+            decode_ecc(packed, repaired, ecc_file_path, new_ecc_file_path)
+        return
+    subprocess.check_call(
+        [
+            "c-ltarchiver/out/ltarchiver_restore",
+            str(source),
+            str(destination),
+            str(ecc_file_path),
+            str(new_ecc_file_path),
+        ]
+    )
 
 
 class FileValidation(enum.Enum):
@@ -223,6 +540,7 @@ def copy_recordbook_from_to(
         check_recordbook_md5(from_checksum)
         shutil.copy(from_file, to_file)
         shutil.copy(from_checksum, to_checksum)
+        parity.write(to_file)
 
     return copy
 
@@ -259,78 +577,297 @@ def decide_recordbooks(
 
 
 def get_records(recordbook_path: pathlib.Path) -> typing.Iterable[Record]:
-    recordbook = recordbook_path.open("r")
-    source = None
-    destination = None
-    file_name = None
-    deleted = None
-    version = None
-    chunksize_ = None
-    eccsize_ = None
-    timestamp = None
-    checksum = None
-    checksum_alg = None
+    if warm_cache is not None:
+        return iter(warm_cache.get_records(recordbook_path))
+    return parse_records(recordbook_path)
+
+
+# a record as Record.write writes it, parsed in one go by parse_records
+_RECORD = re.compile(
+    r"Item\n"
+    r"Version: (\S+)\n"
+    r"Generation: (\S+)\n"
+    r"Deleted: (\S+)\n"
+    r"File-Name: (\S+)\n"
+    r"Source: (\S+)\n"
+    r"Destination: (\S+)\n"
+    r"Bytes-per-chunk: (\S+)\n"
+    r"EC-bytes-per-chunk: (\S+)\n"
+    r"Timestamp: (\S+)\n"
+    r"Checksum-Algorithm: (\S+)\n"
+    r"Checksum: (\S+)\n"
+    r"ECC-Checksum: (\S+)\n"
+    r"(?:Holes: (\S+)\n)?"
+    r"(?:Compression: (\S+)\n)?"
+    r"(?:Stripe: (\S+)\n)?"
+)
+_LINE_FIELDS = {
+    "Deleted:": ("deleted", lambda value: value.lower() == "true"),
+    "Source:": ("source", str),
+    "Destination:": ("destination", str),
+    "Checksum:": ("checksum", str),
+    "File-Name:": ("file_name", str),
+    "Bytes-per-chunk:": ("chunksize", int),
+    "EC-bytes-per-chunk:": ("eccsize", int),
+    "Timestamp:": ("timestamp", datetime.datetime.fromisoformat),
+    "Checksum-Algorithm:": ("checksum_algorithm", str),
+    "ECC-Checksum:": ("ecc_checksum", str),
+    "Version:": ("version", int),
+    "Generation:": ("generation", int),
+    "Holes:": ("holes", sparse.parse_holes),
+    "Compression:": ("compression", str),
+    "Stripe:": ("stripe", str),
+}
+# the fields that don't carry over from one record to the next
+_OPTIONAL_FIELDS = {"holes": (), "compression": "", "stripe": ""}
+parse_read_size = 16 * 1024 * 1024  # characters
+
+
+def _record(fields: dict, paths: typing.Dict[str, pathlib.Path]) -> Record:
+    """The record with fields, paths has the sources already seen.
+
+    fields must have every field of Record, test_parse_records_fields checks
+    that _LINE_FIELDS still covers them all when Record changes.
+    """
+    source = paths.get(fields["source"])
+    if source is None:
+        # replicas of a file on several devices have the same source
+        source = paths[fields["source"]] = pathlib.Path(fields["source"])
+    # the __init__ of a frozen dataclass sets each field with object.__setattr__,
+    # which takes more time than all the parsing of a record
+    record = object.__new__(Record)
+    record.__dict__.update(fields, source=source)
+    return record
+
+
+def _item_chunks(recordbook: typing.TextIO) -> typing.Iterator[str]:
+    """recordbook parse_read_size characters at a time, cut before Item lines."""
+    rest = ""
+    for data in iter(lambda: recordbook.read(parse_read_size), ""):
+        data = rest + data
+        cut = data.rfind("\nItem\n") + 1
+        yield data[:cut]
+        rest = data[cut:]
+    yield rest
+
+
+def parse_records(recordbook_path: pathlib.Path) -> typing.Iterable[Record]:
+    """The records of recordbook_path.
+
+    A record as Record.write writes it is matched whole by one regular
+    expression, anything else is parsed a line at a time. A field missing from a
+    record keeps its value from the record before.
+    """
+    fields = dict.fromkeys(name for name, _ in _LINE_FIELDS.values())
+    fields.update(_OPTIONAL_FIELDS, generation=0)
     first_item = True
-    ecc_checksum = None
-    for line in recordbook:
-        line = line.strip()
-        parts = line.split(" ")
-        if parts[0] == "Item":
-            if first_item:
-                first_item = False
-            else:
-                yield Record(
-                    source=pathlib.Path(source),
-                    destination=destination,
-                    file_name=file_name,
-                    deleted=deleted,
-                    version=version,
-                    chunksize=chunksize_,
-                    eccsize=eccsize_,
-                    timestamp=timestamp,
-                    checksum=checksum,
-                    checksum_algorithm=checksum_alg,
-                    ecc_checksum=ecc_checksum,
-                )
-        elif parts[0] == "Deleted:":
-            deleted = parts[1] == "true"
-        elif parts[0] == "Source:":
-            source = parts[1]
-        elif parts[0] == "Destination:":
-            destination = parts[1]
-        elif parts[0] == "Checksum:":
-            checksum = parts[1]
-        elif parts[0] == "File-Name:":
-            file_name = parts[1]
-        elif parts[0] == "Bytes-per-chunk:":
-            chunksize_ = int(parts[1])
-        elif parts[0] == "EC-bytes-per-chunk:":
-            eccsize_ = int(parts[1])
-        elif parts[0] == "Timestamp:":
-            timestamp = datetime.datetime.fromisoformat(parts[1])
-        elif parts[0] == "Checksum-Algorithm:":
-            checksum_alg = parts[1]
-        elif parts[0] == "ECC-Checksum:":
-            ecc_checksum = parts[1]
-        elif parts[0] == "Version:":
-            version = int(parts[1])
-    recordbook.close()
-    if first_item:
-        return []
+    paths: typing.Dict[str, pathlib.Path] = {}
+    fromisoformat = datetime.datetime.fromisoformat
+    with recordbook_path.open("r") as recordbook:
+        for chunk in _item_chunks(recordbook):
+            position = 0
+            while position < len(chunk):
+                match = _RECORD.match(chunk, position)
+                if match is None:
+                    end = chunk.find("\nItem\n", position) + 1 or len(chunk)
+                    for line in chunk[position:end].split("\n"):
+                        parts = line.strip().split(" ")
+                        if parts[0] == "Item":
+                            if first_item:
+                                first_item = False
+                            else:
+                                yield _record(fields, paths)
+                                fields.update(_OPTIONAL_FIELDS)
+                        elif parts[0] in _LINE_FIELDS:
+                            name, parse = _LINE_FIELDS[parts[0]]
+                            fields[name] = parse(parts[1])
+                    position = end
+                    continue
+                if first_item:
+                    first_item = False
+                else:
+                    yield _record(fields, paths)
+                (
+                    version,
+                    generation,
+                    deleted,
+                    fields["file_name"],
+                    fields["source"],
+                    fields["destination"],
+                    chunksize_,
+                    eccsize_,
+                    timestamp,
+                    fields["checksum_algorithm"],
+                    fields["checksum"],
+                    fields["ecc_checksum"],
+                    holes,
+                    compression,
+                    stripe,
+                ) = match.groups()
+                fields["version"] = int(version)
+                fields["generation"] = int(generation)
+                fields["deleted"] = deleted.lower() == "true"
+                fields["chunksize"] = int(chunksize_)
+                fields["eccsize"] = int(eccsize_)
+                fields["timestamp"] = fromisoformat(timestamp)
+                fields["holes"] = sparse.parse_holes(holes) if holes else ()
+                fields["compression"] = compression or ""
+                fields["stripe"] = stripe or ""
+                position = match.end()
+    if not first_item:
+        yield _record(fields, paths)
+
+
+def read_recordbook_header(recordbook_path: pathlib.Path) -> RecordbookHeader:
+    """Read only the header of a recordbook, stopping at the first Item."""
+    header = RecordbookHeader()
+    try:
+        recordbook = recordbook_path.open("r")
+    except FileNotFoundError:
+        return header
+    with recordbook:
+        for line in recordbook:
+            parts = line.split()
+            if not parts:
+                continue
+            elif parts[0] == "Item":
+                break
+            elif parts[0] == "Recordbook-Generation:":
+                header.generation = int(parts[1])
+            elif parts[0] == "High-Water-Mark:":
+                header.high_water_marks[parts[1]] = int(parts[2])
+    return header
+
+
+def write_recordbook_header(
+    recordbook_path: pathlib.Path,
+    header: RecordbookHeader,
+    appended: typing.Iterable[Record] = (),
+):
+    """Replace the header of a recordbook keeping its records untouched.
+
+    The appended records are added at the end. The records are copied as they
+    are, without parsing them, to a new file that replaces the old one.
+    """
+    temp_path = recordbook_path.with_name(recordbook_path.name + ".tmp")
+    with temp_path.open("w") as out:
+        out.write(header.text())
+        try:
+            recordbook = recordbook_path.open("r")
+        except FileNotFoundError:
+            pass
+        else:
+            with recordbook:
+                for line in iter(recordbook.readline, ""):
+                    if line.strip() == "Item":
+                        out.write(line)
+                        shutil.copyfileobj(recordbook, out)
+                        break
+        for record in appended:
+            record.write_to(out)
+    fsync_file(temp_path)
+    os.replace(temp_path, recordbook_path)
+    fsync_directory(recordbook_path.parent)
+
+
+def write_recordbook_checksum(
+    recordbook_path: pathlib.Path, recordbook_checksum: pathlib.Path
+):
+    """Write the md5 of the recordbook and its parity, see ltarchiver.parity."""
+    recordbook_checksum.write_text(
+        f"{get_file_checksum(recordbook_path)}  {recordbook_path}\n"
+    )
+    parity.write(recordbook_path)
+
+
+def repair_recordbook(
+    recordbook_checksum: pathlib.Path, recordbook: typing.Optional[pathlib.Path] = None
+) -> bool:
+    """Repair the recordbook of a checksum file with its parity, True if it was repaired.
+
+    recordbook defaults to the path written in the checksum file, which is wrong
+    when the device is mounted somewhere else than when the file was written.
+    """
+    try:
+        md5, written_path = (
+            recordbook_checksum.read_text().rstrip("\n").split("  ", 1)
+        )
+    except (FileNotFoundError, ValueError):
+        return False
+    if recordbook is None:
+        recordbook = pathlib.Path(written_path)
+    status = parity.repair(recordbook, md5)
+    if status == parity.Status.REPAIRED:
+        print(f"{recordbook} was damaged and has been repaired with its parity.")
+    return status == parity.Status.REPAIRED
+
+
+def compare_generations(
+    home_header: RecordbookHeader, device_header: RecordbookHeader, device_uuid: str
+) -> Divergence:
+    """Tell which side of a home/device pair of recordbooks has new entries.
+
+    Only the headers are consulted so the answer doesn't depend on the size of
+    the recordbooks.
+    """
+    mark = home_header.high_water_marks.get(device_uuid)
+    if mark is None or device_header.high_water_marks.get(device_uuid) != mark:
+        return Divergence.UNKNOWN
+    home_ahead = home_header.generation > mark
+    device_ahead = device_header.generation > mark
+    if home_ahead and device_ahead:
+        return Divergence.DIVERGED
+    elif home_ahead:
+        return Divergence.HOME_AHEAD
+    elif device_ahead:
+        return Divergence.DEVICE_AHEAD
     else:
-        yield Record(
-            source=pathlib.Path(source),
-            destination=destination,
-            file_name=file_name,
-            deleted=deleted,
-            version=version,
-            chunksize=chunksize_,
-            eccsize=eccsize_,
-            timestamp=timestamp,
-            checksum=checksum,
-            checksum_algorithm=checksum_alg,
-            ecc_checksum=ecc_checksum,
+        return Divergence.IN_SYNC
+
+
+def replay_recordbook_delta(
+    from_recordbook: pathlib.Path,
+    from_checksum: pathlib.Path,
+    to_recordbook: pathlib.Path,
+    to_checksum: pathlib.Path,
+    device_uuid: str,
+):
+    """Append to to_recordbook the records of from_recordbook it hasn't seen yet.
+
+    Both recordbooks must have been compared with compare_generations first and
+    to_recordbook must be the one that is behind. Afterwards both recordbooks
+    share the same generation and high-water mark for device_uuid.
+    """
+    check_recordbook_md5(from_checksum)
+    from_header = read_recordbook_header(from_recordbook)
+    to_header = read_recordbook_header(to_recordbook)
+    mark = to_header.high_water_marks[device_uuid]
+    delta = {
+        record.identity(): record
+        for record in get_records(from_recordbook)
+        if record.generation > mark
+    }
+    from_header.high_water_marks[device_uuid] = from_header.generation
+    to_header.generation = from_header.generation
+    to_header.high_water_marks[device_uuid] = from_header.generation
+    write_recordbook_header(from_recordbook, from_header)
+    if any(record.deleted for record in delta.values()):
+        # a deletion replaces the older version of its record
+        records = [
+            delta.pop(record.identity(), record)
+            for record in get_records(to_recordbook)
+        ]
+        records.extend(delta.values())
+        write_records(to_recordbook, to_header, records)
+    else:
+        # new records only, to_recordbook isn't parsed
+        write_recordbook_header(
+            to_recordbook,
+            to_header,
+            sorted(delta.values(), key=lambda record: record.generation),
         )
+    write_recordbook_checksum(from_recordbook, from_checksum)
+    write_recordbook_checksum(to_recordbook, to_checksum)
 
 
 def check_recordbook_md5(recordbook_checksum: pathlib.Path):
@@ -338,77 +875,204 @@ def check_recordbook_md5(recordbook_checksum: pathlib.Path):
         raise FileNotFoundError(
             f"Recordbook checksum file {recordbook_checksum} not found or empty"
         )
+    if warm_cache is not None and warm_cache.checksum_verified(recordbook_checksum):
+        return
     try:
         subprocess.check_call(shlex.split(f"md5sum -c {recordbook_checksum}"))
     except subprocess.CalledProcessError as err:
+        if repair_recordbook(recordbook_checksum):
+            return check_recordbook_md5(recordbook_checksum)
         raise LTAError(
             f"The recordbook checksum file {recordbook_checksum} doesn't match what's stored. Please validate it and retry."
         ) from err
+    if warm_cache is not None:
+        warm_cache.mark_checksum_verified(recordbook_checksum)
 
 
-def mark_record_as_deleted(record_idx: int):
-    records = list(get_records(recordbook_path))
-    records[record_idx].deleted = True
-    os.remove(recordbook_path)
+def write_records(
+    path: pathlib.Path, header: RecordbookHeader, records: typing.Iterable[Record]
+):
+    """Replace the recordbook at path, the old one stays intact until the new one is on disk."""
+    temp_path = path.with_name(path.name + ".tmp")
+    temp_path.write_text(header.text())
     for record in records:
-        record.write()
+        record.write(temp_path)
+    fsync_file(temp_path)
+    os.replace(temp_path, path)
+    fsync_directory(path.parent)
+
+
+def commit_record(record: Record, metadata_dir: pathlib.Path):
+    """Add record to the home recordbook and copy it to the device."""
+    with instrument.span("recordbook-commit"):
+        _commit_record(record, metadata_dir)
+
+
+def _commit_record(record: Record, metadata_dir: pathlib.Path):
+    header = read_recordbook_header(recordbook_path)
+    header.generation += 1
+    header.high_water_marks[record.destination] = header.generation
+    record = dataclasses.replace(record, generation=header.generation)
+    write_recordbook_header(recordbook_path, header)
+    record.write(recordbook_path)
+    device_recordbook_path = metadata_dir / recordbook_file_name
+    shutil.copy(recordbook_path, device_recordbook_path)
+    write_recordbook_checksum(recordbook_path, recordbook_checksum_file_path)
+    write_recordbook_checksum(device_recordbook_path, metadata_dir / "checksum.txt")
+    for path in (
+        recordbook_path,
+        recordbook_checksum_file_path,
+        device_recordbook_path,
+        metadata_dir / "checksum.txt",
+    ):
+        fsync_file(path)
+    fsync_directory(recordbook_dir)
+    fsync_directory(metadata_dir)
+
+
+class DeviceTopology:
+    """Snapshot of the UUID of every device and where each one is mounted."""
+
+    def __init__(self):
+        self.uuid_to_device: typing.Dict[str, pathlib.Path] = {}
+        self.device_to_uuid: typing.Dict[pathlib.Path, str] = {}
+        self.root_to_device: typing.Dict[pathlib.Path, pathlib.Path] = {}
+        self.device_to_root: typing.Dict[pathlib.Path, pathlib.Path] = {}
+        self.taken_at = 0.0
+        self.refresh()
+
+    def refresh(self):
+        import psutil
+
+        self.uuid_to_device = {
+            p.name: p.resolve() for p in pathlib.Path("/dev/disk/by-uuid").iterdir()
+        }
+        self.device_to_uuid = {
+            device: uuid for uuid, device in self.uuid_to_device.items()
+        }
+        self.root_to_device = {}
+        self.device_to_root = {}
+        for partition in psutil.disk_partitions():
+            if not partition.device.startswith("/dev/"):
+                continue
+            device = pathlib.Path(partition.device).resolve()
+            root = pathlib.Path(partition.mountpoint).resolve()
+            self.root_to_device[root] = device
+            self.device_to_root.setdefault(device, root)
+        self.taken_at = time.monotonic()
+
+    def uuid_and_root_from_path(self, path: pathlib.Path) -> (str, pathlib.Path):
+        prev_parent = None
+        parent = path.resolve()
+        while prev_parent != parent:
+            if parent in self.root_to_device:
+                return self.device_to_uuid[self.root_to_device[parent]], parent
+            else:
+                prev_parent = parent
+                parent = parent.parent
+        raise AttributeError(
+            f"Could not find the device associated with the path {path}"
+        )
+
+    def root_from_uuid(self, uuid: str) -> pathlib.Path:
+        try:
+            device = self.uuid_to_device[uuid]
+            try:
+                return self.device_to_root[device]
+            except KeyError as err:
+                raise AttributeError(
+                    f"Could not find the root of the device {device}. Is it mounted?"
+                ) from err
+        except KeyError as err:
+            raise AttributeError(
+                f"Could not find the device associated with the UUID {uuid}."
+                f" Is it pluged int?"
+            ) from err
 
 
 def get_device_uuid_and_root_from_path(path: pathlib.Path) -> (str, pathlib.Path):
-    devices_to_uuids = {}
-    for line in subprocess.check_output(
-        ["ls", "-l", "/dev/disk/by-uuid"], encoding="utf-8"
-    ).split("\n")[1:]:
-        if not line.strip():
-            break
-        parts = line.split()
-        devices_to_uuids[
-            (pathlib.Path("/dev/disk/by-uuid") / pathlib.Path(parts[-1])).resolve(
-                strict=True
-            )
-        ] = parts[-3]
-    path_to_devices = {}
-    for line in subprocess.check_output("mount", encoding="utf-8").split("\n"):
-        if not line.strip():
-            break
-        if line.startswith("/dev/"):
-            parts = line.split()
-            path_to_devices[pathlib.Path(parts[2]).resolve(strict=True)] = pathlib.Path(
-                parts[0]
-            ).resolve(strict=True)
-    prev_parent = None
-    parent = path.resolve()
-    while prev_parent != parent:
-        if parent in path_to_devices:
-            return devices_to_uuids[path_to_devices[parent]], parent
-        else:
-            prev_parent = parent
-            parent = parent.parent
-    raise AttributeError(f"Could not find the device associated with the path {path}")
+    with instrument.span("device-lookup"):
+        if warm_cache is not None:
+            return warm_cache.uuid_and_root_from_path(path)
+        return DeviceTopology().uuid_and_root_from_path(path)
 
 
 def get_root_from_uuid(uuid: str) -> pathlib.Path:
-    uuid_to_device = {}
-    for p in pathlib.Path("/dev/disk/by-uuid").iterdir():
-        uuid_to_device[p.name] = p.resolve()
-    device_to_path = {}
-    for partition in psutil.disk_partitions():
-        device_to_path[pathlib.Path(partition.device)] = pathlib.Path(
-            partition.mountpoint
-        )
-    try:
-        device = uuid_to_device[uuid]
+    if warm_cache is not None:
+        return warm_cache.root_from_uuid(uuid)
+    return DeviceTopology().root_from_uuid(uuid)
+
+
+def stat_key(path: pathlib.Path) -> typing.Tuple[int, int, int, int]:
+    stat = path.stat()
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class WarmCache:
+    """State that long-running processes keep between requests.
+
+    Parsed recordbooks and verified recordbook checksums are reused for as long as
+    the files on disk don't change. The device topology is taken again once it's
+    older than topology_ttl seconds or when a lookup misses, so plugging in a
+    device never requires a restart.
+    """
+
+    def __init__(self, topology_ttl: float = 5.0):
+        self.topology_ttl = topology_ttl
+        self._topology: typing.Optional[DeviceTopology] = None
+        self._records: typing.Dict[pathlib.Path, typing.Tuple[tuple, list]] = {}
+        self._verified_checksums: typing.Dict[pathlib.Path, tuple] = {}
+
+    def topology(self, fresh: bool = False) -> DeviceTopology:
+        if (
+            fresh
+            or self._topology is None
+            or time.monotonic() - self._topology.taken_at > self.topology_ttl
+        ):
+            self._topology = DeviceTopology()
+        return self._topology
+
+    def uuid_and_root_from_path(self, path: pathlib.Path) -> (str, pathlib.Path):
         try:
-            return device_to_path[device]
-        except KeyError as err:
-            raise AttributeError(
-                f"Could not find the root of the device {device}. Is it mounted?"
-            ) from err
-    except KeyError as err:
-        raise AttributeError(
-            f"Could not find the device associated with the UUID {uuid}."
-            f" Is it pluged int?"
-        ) from err
+            return self.topology().uuid_and_root_from_path(path)
+        except (AttributeError, KeyError):
+            return self.topology(fresh=True).uuid_and_root_from_path(path)
+
+    def root_from_uuid(self, uuid: str) -> pathlib.Path:
+        try:
+            return self.topology().root_from_uuid(uuid)
+        except AttributeError:
+            return self.topology(fresh=True).root_from_uuid(uuid)
+
+    def get_records(self, recordbook_path: pathlib.Path) -> typing.List[Record]:
+        key = stat_key(recordbook_path)
+        path = recordbook_path.resolve()
+        cached = self._records.get(path)
+        if cached is None or cached[0] != key:
+            cached = (key, list(parse_records(recordbook_path)))
+            self._records[path] = cached
+        return cached[1]
+
+    def _checksum_key(self, recordbook_checksum: pathlib.Path) -> tuple:
+        recorded_path = recordbook_checksum.read_text().split(maxsplit=1)[1].strip()
+        return stat_key(recordbook_checksum), stat_key(pathlib.Path(recorded_path))
+
+    def checksum_verified(self, recordbook_checksum: pathlib.Path) -> bool:
+        try:
+            key = self._checksum_key(recordbook_checksum)
+        except (IndexError, FileNotFoundError):
+            return False
+        return self._verified_checksums.get(recordbook_checksum.resolve()) == key
+
+    def mark_checksum_verified(self, recordbook_checksum: pathlib.Path):
+        try:
+            key = self._checksum_key(recordbook_checksum)
+        except (IndexError, FileNotFoundError):
+            return
+        self._verified_checksums[recordbook_checksum.resolve()] = key
+
+
+warm_cache: typing.Optional[WarmCache] = None
 
 
 def record_of_file(
@@ -428,6 +1092,7 @@ class RecordBook:
     def __init__(self, path: pathlib.Path, checksum_file_path: pathlib.Path):
         self.path = path
         self.records: typing.Set[Record] = set(get_records(path))
+        self.header = read_recordbook_header(path)
         self.checksum_file_path = checksum_file_path
         self.valid = True
         self.invalid_reason: Validation = Validation.VALID
@@ -435,15 +1100,25 @@ class RecordBook:
 
     def merge(self, other_recordbook: "RecordBook"):
         self.records = self.records.union(other_recordbook.records)
+        self.header.generation = max(
+            self.header.generation, other_recordbook.header.generation
+        )
         self.write()
 
+    def mark_synced_with(self, other_recordbook: "RecordBook", device_uuid: str):
+        """Make other_recordbook carry the same records and header as this one."""
+        self.header.high_water_marks[device_uuid] = self.header.generation
+        other_recordbook.records = self.records
+        other_recordbook.header = self.header.copy()
+
     def write(self):
-        remove_file(self.path)
+        self.path.write_text(self.header.text())
         for record in self.records:
             record.write(self.path)
         subprocess.check_call(
             f"md5sum {self.path} > {self.checksum_file_path}", shell=True
         )
+        parity.write(self.path)
 
     def get_records_by_uuid(self, device_uuid: str) -> typing.Iterable[Record]:
         for record in self.records:
@@ -457,7 +1132,17 @@ class RecordBook:
         elif not self.checksum_file_path.exists():
             self.valid = False
             self.invalid_reason = Validation.NO_CHECKSUM_FILE
-        elif not self.checksum_file_path.read_text() == get_file_checksum(self.path):
+        else:
+            # md5sum's format, the md5 and the path of the recordbook
+            recorded = self.checksum_file_path.read_text().split()
+            if recorded[:1] == [get_file_checksum(self.path)]:
+                return
+            if repair_recordbook(self.checksum_file_path, self.path):
+                self.records = set(get_records(self.path))
+                self.header = read_recordbook_header(self.path)
+                self.valid = True
+                self.invalid_reason = Validation.VALID
+                return
             self.valid = False
             self.invalid_reason = Validation.CORRUPTED
 
@@ -466,7 +1151,80 @@ class RecordBook:
 
     def update_record(self, record: Record):
         self.records.remove(record)
-        self.records.add(dataclasses.replace(record, timestamp=datetime.datetime.now()))
+        self.header.generation += 1
+        self.records.add(
+            dataclasses.replace(
+                record,
+                timestamp=datetime.datetime.now(),
+                generation=self.header.generation,
+            )
+        )
+
+
+def fsync_file(path: pathlib.Path):
+    """Make sure the contents of path reached the disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_directory(path: pathlib.Path):
+    """Make sure the files created, renamed or removed in path reached the disk."""
+    fsync_file(path)
+
+
+def sharded_ecc_file_path(metadata_dir: pathlib.Path, checksum: str) -> pathlib.Path:
+    shards = [checksum[2 * i : 2 * i + 2] for i in range(ecc_shard_levels)]
+    return metadata_dir.joinpath(ecc_dir_name, *shards, checksum)
+
+
+def legacy_ecc_file_path(metadata_dir: pathlib.Path, checksum: str) -> pathlib.Path:
+    return metadata_dir / ecc_dir_name / checksum
+
+
+def find_ecc_file(metadata_dir: pathlib.Path, checksum: str) -> pathlib.Path:
+    """Path to the ECC of the file with checksum.
+
+    Devices written before the ECC files were sharded keep them all directly
+    in the ecc directory until they are migrated, see ltarchiver.migrate. New
+    ECC files go in their shard.
+    """
+    sharded = sharded_ecc_file_path(metadata_dir, checksum)
+    if sharded.exists():
+        return sharded
+    legacy = legacy_ecc_file_path(metadata_dir, checksum)
+    if legacy.exists():
+        return legacy
+    return sharded
+
+
+def hash_ecc_file(
+    metadata_dir: pathlib.Path, checksum: str
+) -> typing.Tuple[pathlib.Path, typing.Optional[str]]:
+    """The ECC file of the file with checksum and its md5, None if it's missing.
+
+    ltarchiver-migrate may move the ECC file to its shard after it's found and
+    before it's read, it's then looked up again.
+    """
+    for _ in range(2):
+        ecc_file_path = find_ecc_file(metadata_dir, checksum)
+        try:
+            with instrument.span("ecc-hash", instrument.file_size(ecc_file_path)):
+                return ecc_file_path, get_file_checksum(ecc_file_path)
+        except FileNotFoundError:
+            pass
+    return ecc_file_path, None
+
+
+def make_ecc_shard(ecc_file_path: pathlib.Path):
+    """Create the directories of the shard of ecc_file_path if they are missing."""
+    for level in reversed(range(ecc_shard_levels)):
+        directory = ecc_file_path.parents[level]
+        if not directory.is_dir():
+            directory.mkdir(parents=True, exist_ok=True)
+            fsync_directory(directory.parent)
 
 
 def remove_file(path: pathlib.Path):
@@ -487,6 +1245,7 @@ def validate_and_recover_recordbooks(
     def copy_recordbook_callback(a: RecordBook, b: RecordBook):
         def cp():
             b.records = a.records
+            b.header = a.header.copy()
             b.write()
             b.validate()
 
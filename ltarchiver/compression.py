@@ -0,0 +1,188 @@
+"""Compression of the stored files.
+
+Files are stored as they are unless a codec is asked for. A compressed file is
+compressed on its way to the destination and its record, checksum and ECC are
+those of the compressed bytes, so verifying and refreshing it reads less. The
+Compression line of the record also has the md5 of the original file, like
+lzma:5eb63bbbe01eeed093cb22bb8f5acdc3, which the decompressed file is checked
+against. It keeps its name on the destination and is decompressed when restored.
+
+The only codec is lzma from the standard library. Its Python binding can't use
+several threads, so the file is cut into chunk_size pieces that are compressed
+by a pool of threads into independent xz streams. One after the other they make
+a regular .xz file, which xz can decompress too, and restore finds the streams
+through their footers and decompresses them in parallel as well.
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import lzma
+import os
+import pathlib
+import struct
+import typing
+
+from ltarchiver import common, directio, pipeline, progress
+
+codecs = ["lzma"]
+chunk_size = 16 * 1024 * 1024  # bytes of input per xz stream
+preset = 6
+threads = os.cpu_count() or 1
+
+XZ_HEADER_SIZE = 12
+XZ_FOOTER_SIZE = 12
+XZ_FOOTER_MAGIC = b"YZ"
+
+
+def describe(codec: str, checksum: str) -> str:
+    """What the record of a file compressed with codec says about it."""
+    return f"{codec}:{checksum}"
+
+
+def parse(text: str) -> typing.Tuple[str, str]:
+    """The codec and original md5 of a record, the md5 is empty for old records."""
+    codec, _, checksum = text.partition(":")
+    return codec, checksum
+
+
+def check_codec(codec: str):
+    if codec not in codecs:
+        raise common.LTAError(
+            f"Unknown compression {codec}, it must be one of {', '.join(codecs)}"
+        )
+
+
+class _Ordered:
+    """Runs functions in a pool of threads and hands their results back in order.
+
+    At most twice as many functions as there are threads are in flight, which
+    bounds the memory used.
+    """
+
+    def __init__(self, consume: typing.Callable[[bytes], None]):
+        self.consume = consume
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.pending: typing.Deque[concurrent.futures.Future] = collections.deque()
+
+    def submit(self, function, *args):
+        self.pending.append(self.executor.submit(function, *args))
+        while len(self.pending) > 2 * threads:
+            self.consume(self.pending.popleft().result())
+
+    def finish(self):
+        while self.pending:
+            self.consume(self.pending.popleft().result())
+
+    def __enter__(self) -> "_Ordered":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+        return False
+
+
+def compress_file(
+    source: pathlib.Path,
+    destination: pathlib.Path,
+    codec: str,
+    tee: typing.Optional[typing.Callable[[bytes], None]] = None,
+) -> typing.Tuple[str, str]:
+    """Compress source to destination and return the md5 of destination and source.
+
+    tee is also given the compressed data, in order.
+    """
+    check_codec(codec)
+    md5 = hashlib.md5()
+    original_md5 = hashlib.md5()
+    chunk = bytearray()
+
+    def consume(compressed: bytes):
+        md5.update(compressed)
+        out.write(compressed)
+        if tee is not None:
+            tee(compressed)
+
+    with directio.Reader(source) as reader, destination.open(
+        "wb"
+    ) as out, progress.Progress(
+        f"Compressing {source.name}", reader.size
+    ) as compressing, _Ordered(consume) as ordered:
+
+        def add(block: memoryview):
+            original_md5.update(block)
+            chunk.extend(block)
+            compressing.advance(len(block))
+            while len(chunk) >= chunk_size:
+                piece = bytes(chunk[:chunk_size])
+                del chunk[:chunk_size]
+                ordered.submit(lzma.compress, piece, lzma.FORMAT_XZ, -1, preset)
+
+        pipeline.run(reader, compute=[add])
+        if chunk or not reader.size:
+            ordered.submit(lzma.compress, bytes(chunk), lzma.FORMAT_XZ, -1, preset)
+        ordered.finish()
+    return md5.hexdigest(), original_md5.hexdigest()
+
+
+def _read_varint(data: bytes, position: int) -> typing.Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def xz_streams(f: typing.BinaryIO) -> typing.List[typing.Tuple[int, int]]:
+    """(offset, length) of every stream of the xz file f, from its footers."""
+    streams = []
+    end = os.fstat(f.fileno()).st_size
+    while end > 0:
+        f.seek(end - XZ_FOOTER_SIZE)
+        footer = f.read(XZ_FOOTER_SIZE)
+        if len(footer) != XZ_FOOTER_SIZE or footer[10:] != XZ_FOOTER_MAGIC:
+            raise common.LTAError("Not an xz file or damaged beyond its ECC")
+        index_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+        f.seek(end - XZ_FOOTER_SIZE - index_size)
+        index = f.read(index_size)
+        count, position = _read_varint(index, 1)
+        blocks_size = 0
+        for _ in range(count):
+            unpadded, position = _read_varint(index, position)
+            _, position = _read_varint(index, position)
+            blocks_size += -(-unpadded // 4) * 4
+        length = XZ_HEADER_SIZE + blocks_size + index_size + XZ_FOOTER_SIZE
+        streams.append((end - length, length))
+        end -= length
+    return streams[::-1]
+
+
+def decompress_file(
+    source: pathlib.Path, destination: pathlib.Path, codec: str, checksum: str = ""
+):
+    """Decompress source, written by compress_file, to destination.
+
+    When checksum is given it must be the md5 of what was decompressed.
+    """
+    check_codec(codec)
+    md5 = hashlib.md5()
+    with source.open("rb") as f, destination.open("wb") as out, progress.Progress(
+        f"Decompressing {source.name}", os.fstat(f.fileno()).st_size
+    ) as decompressing, _Ordered(
+        lambda decompressed: (md5.update(decompressed), out.write(decompressed))
+    ) as ordered:
+        for offset, length in xz_streams(f):
+            f.seek(offset)
+            ordered.submit(lzma.decompress, f.read(length), lzma.FORMAT_XZ)
+            decompressing.advance(length)
+        ordered.finish()
+    if checksum and md5.hexdigest() != checksum:
+        raise common.LTAError(
+            f"{source} was decompressed but doesn't match the original file"
+        )
@@ -0,0 +1,249 @@
+"""Containers of many small files.
+
+A directory stored as a container is one file on the destination, with one
+record and one ECC like any other file, but each of its files (members) can be
+verified and restored by itself, reading only that member and its part of the
+ECC.
+
+Every member starts on a chunk boundary and is padded with zeros up to the next
+one. As the ECC has eccsize bytes for each chunksize bytes of the file, the ECC
+of a member is a range of the ECC of the container. After the members comes the
+index, a JSON line per member with its name, offset, size and checksum, and the
+container ends with a trailer line giving the offset and the md5 of the index.
+
+Usage:
+  ltarchiver-container list <container>
+  ltarchiver-container extract <container> <directory> [<member>...]
+"""
+
+import dataclasses
+import hashlib
+import json
+import os
+import pathlib
+import sys
+import typing
+
+from ltarchiver import common
+
+suffix = ".lta"
+TRAILER_MAGIC = "LTARCHIVER-INDEX"
+TRAILER_SIZE = len(f"{TRAILER_MAGIC} {0:020d} {'0' * 32}\n")
+copy_block_size = 1024 * 1024  # bytes
+
+
+@dataclasses.dataclass
+class Member:
+    name: str
+    offset: int
+    size: int
+    checksum: str
+    mtime: int  # nanoseconds
+
+    def chunks(self, chunksize: int = common.chunksize) -> typing.Tuple[int, int]:
+        """The first chunk of the member and how many chunks it spans."""
+        return self.offset // chunksize, -(-self.size // chunksize)
+
+    def ecc_range(
+        self, chunksize: int = common.chunksize, eccsize: int = common.eccsize
+    ) -> typing.Tuple[int, int]:
+        """Offset and length of the ECC of the member in the ECC of the container."""
+        first, count = self.chunks(chunksize)
+        return first * eccsize, count * eccsize
+
+
+def _copy_range(
+    source: typing.BinaryIO,
+    offset: int,
+    length: int,
+    out: typing.Optional[typing.BinaryIO] = None,
+) -> str:
+    """Copy length bytes of source from offset to out and return their md5."""
+    md5 = hashlib.md5()
+    source.seek(offset)
+    while length:
+        block = source.read(min(length, copy_block_size))
+        if not block:
+            raise common.LTAError("The container is shorter than its index says")
+        md5.update(block)
+        if out is not None:
+            out.write(block)
+        length -= len(block)
+    return md5.hexdigest()
+
+
+def create(
+    directory: pathlib.Path,
+    destination: pathlib.Path,
+    chunksize: int = common.chunksize,
+) -> typing.List[Member]:
+    """Put the files under directory in a container at destination.
+
+    Member names start with the name of directory, like the paths in a tar.
+    Only regular files are kept, not empty directories, links or permissions.
+    """
+    return write(
+        (
+            (path, path.relative_to(directory.parent).as_posix())
+            for path in sorted(directory.rglob("*"))
+            if not path.is_symlink() and path.is_file()
+        ),
+        destination,
+        chunksize,
+    )
+
+
+def write(
+    files: typing.Iterable[typing.Tuple[pathlib.Path, str]],
+    destination: pathlib.Path,
+    chunksize: int = common.chunksize,
+) -> typing.List[Member]:
+    """Put files, pairs of a path and its member name, in a container at destination."""
+    members = []
+    with destination.open("wb") as out:
+        for path, name in files:
+            stat = path.stat()
+            with path.open("rb") as f:
+                checksum = _copy_range(f, 0, stat.st_size, out)
+            members.append(
+                Member(
+                    name=name,
+                    offset=out.tell() - stat.st_size,
+                    size=stat.st_size,
+                    checksum=checksum,
+                    mtime=stat.st_mtime_ns,
+                )
+            )
+            out.write(bytes(-out.tell() % chunksize))
+        index_offset = out.tell()
+        index = "".join(
+            json.dumps(dataclasses.asdict(member)) + "\n" for member in members
+        ).encode("utf-8")
+        out.write(index)
+        out.write(
+            f"{TRAILER_MAGIC} {index_offset:020d} {hashlib.md5(index).hexdigest()}\n".encode(
+                "utf-8"
+            )
+        )
+    return members
+
+
+def pack_directory(path: pathlib.Path) -> pathlib.Path:
+    """Put a directory in a container next to it and return the container's path."""
+    packed = path.with_name(path.name + suffix)
+    create(path, packed)
+    return packed
+
+
+def read_index(path: pathlib.Path) -> typing.List[Member]:
+    """The members of the container at path.
+
+    Raises LTAError when the index is damaged, the whole container has to be
+    repaired then.
+    """
+    with path.open("rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < TRAILER_SIZE:
+            raise common.LTAError(f"{path} is not a container")
+        f.seek(size - TRAILER_SIZE)
+        trailer = f.read(TRAILER_SIZE).decode("utf-8", "replace").split()
+        if len(trailer) != 3 or trailer[0] != TRAILER_MAGIC:
+            raise common.LTAError(f"{path} is not a container or its index is damaged")
+        index_offset = int(trailer[1])
+        f.seek(index_offset)
+        index = f.read(size - TRAILER_SIZE - index_offset)
+    if hashlib.md5(index).hexdigest() != trailer[2]:
+        raise common.LTAError(f"The index of {path} is damaged")
+    return [Member(**json.loads(line)) for line in index.decode("utf-8").splitlines()]
+
+
+def find_member(members: typing.List[Member], name: str) -> Member:
+    for member in members:
+        if member.name == name:
+            return member
+    raise common.LTAError(f"{name} is not in the container")
+
+
+def extract_member(
+    path: pathlib.Path, member: Member, destination: pathlib.Path
+) -> bool:
+    """Copy member out of the container at path, True if its checksum matches."""
+    with path.open("rb") as f, destination.open("wb") as out:
+        checksum = _copy_range(f, member.offset, member.size, out)
+    os.utime(destination, ns=(member.mtime, member.mtime))
+    return checksum == member.checksum
+
+
+def repair_member(
+    path: pathlib.Path,
+    ecc_file_path: pathlib.Path,
+    member: Member,
+    destination: pathlib.Path,
+    chunksize: int = common.chunksize,
+    eccsize: int = common.eccsize,
+):
+    """Write member to destination, repaired with its range of the ECC.
+
+    Only the chunks of the member and their ECC are read and decoded.
+    """
+    first, count = member.chunks(chunksize)
+    ecc_offset, ecc_length = member.ecc_range(chunksize, eccsize)
+    with common.temporary_file(".member") as damaged, common.temporary_file(
+        ".member-ecc"
+    ) as ecc, common.temporary_file(".repaired") as repaired, common.temporary_file(
+        ".repaired-ecc"
+    ) as repaired_ecc:
+        with path.open("rb") as f, damaged.open("wb") as out:
+            _copy_range(f, first * chunksize, count * chunksize, out)
+        with ecc_file_path.open("rb") as f, ecc.open("wb") as out:
+            _copy_range(f, ecc_offset, ecc_length, out)
+        common.decode_ecc(damaged, repaired, ecc, repaired_ecc)
+        with repaired.open("rb") as f, destination.open("wb") as out:
+            checksum = _copy_range(f, 0, member.size, out)
+    if checksum != member.checksum:
+        raise common.LTAError(f"Could not repair {member.name}. Sorry!")
+    os.utime(destination, ns=(member.mtime, member.mtime))
+
+
+def extract(
+    path: pathlib.Path, directory: pathlib.Path, names: typing.Sequence[str] = ()
+) -> typing.List[Member]:
+    """Extract the members called names, all of them without names, under directory.
+
+    Returns the members whose checksum doesn't match.
+    """
+    members = read_index(path)
+    if names:
+        members = [find_member(members, name) for name in names]
+    damaged = []
+    for member in members:
+        destination = directory / member.name
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        if not extract_member(path, member, destination):
+            damaged.append(member)
+    return damaged
+
+
+def run():
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    path = pathlib.Path(arguments["<container>"])
+    try:
+        if arguments["list"]:
+            for member in read_index(path):
+                print(f"{member.size:>12} {member.name}")
+            return
+        damaged = extract(
+            path, pathlib.Path(arguments["<directory>"]), arguments["<member>"]
+        )
+    except common.LTAError as err:
+        common.error(err.args[0])
+    for member in damaged:
+        print(f"{member.name} doesn't match its checksum", file=sys.stderr)
+    if damaged:
+        exit(1)
+
+
+if __name__ == "__main__":
+    run()
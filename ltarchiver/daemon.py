@@ -0,0 +1,233 @@
+"""Archive daemon
+
+Keeps the parsed recordbooks, the device topology and the verified recordbook
+checksums warm between requests and serves store, verify and restore requests
+over a Unix socket. The other commands hand their work to the daemon when they
+run non-interactively and it's listening, and do it themselves otherwise.
+
+Usage:
+  ltarchiver-daemon [--socket=<path>] [--metrics=<file>] [--profile=<file>]
+
+Options:
+  --socket=<path>   Where to listen, ~/.ltarchiver/daemon.sock by default.
+  --metrics=<file>  Record how long each phase of every request took to file,
+                    as JSON lines or as a Prometheus textfile when file ends
+                    in .prom.
+  --profile=<file>  Profile the daemon with cProfile and save the stats to file
+                    when it stops.
+"""
+
+import contextlib
+import io
+import json
+import os
+import pathlib
+import socket
+import socketserver
+import sys
+import typing
+
+from docopt import docopt
+
+from ltarchiver import (
+    common,
+    store,
+    check_and_restore,
+    instrument,
+    progress,
+    transaction,
+)
+
+socket_path = common.recordbook_dir / "daemon.sock"
+
+
+def store_command(request: dict):
+    store.store(
+        pathlib.Path(request["source"]),
+        pathlib.Path(request["destination"]),
+        non_interactive=True,
+        codec=request.get("codec", ""),
+        as_container=request.get("container", False),
+    )
+
+
+def restore_command(request: dict):
+    check_and_restore.restore(
+        pathlib.Path(request["backup"]),
+        pathlib.Path(request["destination"]),
+        non_interactive=True,
+    )
+
+
+def verify_command(request: dict):
+    path = pathlib.Path(request["path"]).resolve()
+    # files with the same name may be on other devices
+    uuid, _ = common.get_device_uuid_and_root_from_path(path)
+    record = next(
+        (
+            record
+            for record in common.get_records(common.recordbook_path)
+            if not record.deleted
+            and record.destination == uuid
+            and record.file_name == path.name
+        ),
+        None,
+    )
+    if record is None:
+        raise common.LTAError(f"{path.name} was not found in the recordbook")
+    validation = record.get_validation()
+    print(f"{path}: {validation}")
+    if validation != common.Validation.VALID:
+        exit(1)
+
+
+def ping_command(request: dict):
+    print("pong")
+
+
+commands: typing.Dict[str, typing.Callable[[dict], None]] = {
+    "ping": ping_command,
+    "store": store_command,
+    "restore": restore_command,
+    "verify": verify_command,
+}
+
+
+class NeedsTerminal(Exception):
+    """A command asked the user something, it must be run standalone."""
+
+
+def _needs_terminal(question: str, choices: typing.List[str]) -> str:
+    raise NeedsTerminal(question)
+
+
+def execute(request: dict) -> dict:
+    """Run a request and describe its outcome.
+
+    The status is "ok", "error" or "interactive", the latter when the command
+    asked the user something and must be run standalone instead. The commands
+    ask before changing anything, so nothing is done twice.
+    """
+    command = commands.get(request.get("command"))
+    if command is None:
+        return {
+            "status": "error",
+            "output": "",
+            "error": f"Unknown command {request.get('command')}",
+        }
+    output = io.StringIO()
+    errors = io.StringIO()
+    status = "ok"
+    cwd = os.getcwd()
+    stdin = sys.stdin
+    # nobody watches the progress of a request while it runs
+    progress_token = progress.sink.set(lambda event: None)
+    prompt_token = common.prompt_hook.set(_needs_terminal)
+    try:
+        os.chdir(request.get("cwd", cwd))
+        # Nobody is there to answer, input() must fail instead of blocking.
+        sys.stdin = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(errors):
+            command(request)
+    except NeedsTerminal:
+        status = "interactive"
+    except SystemExit as err:
+        if err.code not in (0, None):
+            status = "error"
+    except common.LTAError as err:
+        status = "error"
+        errors.write(err.args[0])
+    except Exception as err:
+        status = "error"
+        errors.write(f"{type(err).__name__}: {err}")
+    finally:
+        progress.sink.reset(progress_token)
+        common.prompt_hook.reset(prompt_token)
+        sys.stdin = stdin
+        os.chdir(cwd)
+    return {"status": status, "output": output.getvalue(), "error": errors.getvalue()}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {"status": "error", "output": "", "error": "Bad request"}
+            else:
+                response = execute(request)
+                if instrument.recorder is not None:
+                    instrument.recorder.flush()
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def make_server(path: pathlib.Path = socket_path) -> socketserver.UnixStreamServer:
+    """Create the server and the warm caches it shares between requests.
+
+    Requests are served one at a time since most of them change the recordbook.
+    """
+    transaction.recover()
+    common.warm_cache = common.WarmCache()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    common.remove_file(path)
+    old_umask = os.umask(0o077)
+    try:
+        return socketserver.UnixStreamServer(str(path), RequestHandler)
+    finally:
+        os.umask(old_umask)
+
+
+def request(
+    command: str, socket_file: pathlib.Path = socket_path, **arguments
+) -> typing.Optional[dict]:
+    """Send a request to the daemon. Returns None if no daemon is listening."""
+    message = {"command": command, "cwd": os.getcwd(), **arguments}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(socket_file))
+            sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                response = f.readline()
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    if not response:
+        return None
+    return json.loads(response)
+
+
+def run_remotely(command: str, **arguments) -> bool:
+    """Have the daemon run command and print its output.
+
+    Returns False when the command has to be run standalone, either because
+    there's no daemon or because the command needed to prompt the user.
+    """
+    response = request(command, **arguments)
+    if response is None or response["status"] == "interactive":
+        return False
+    print(response["output"], end="")
+    if response["status"] == "error":
+        common.error(response["error"])
+    return True
+
+
+def run():
+    arguments = docopt(__doc__)
+    if arguments["--socket"]:
+        path = pathlib.Path(arguments["--socket"]).expanduser()
+    else:
+        path = socket_path
+    with instrument.session(
+        "daemon", arguments["--metrics"], arguments["--profile"]
+    ), make_server(path) as server:
+        print(f"Listening on {path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            common.remove_file(path)
+
+
+if __name__ == "__main__":
+    run()
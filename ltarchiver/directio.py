@@ -0,0 +1,90 @@
+"""Reading archived files without going through the page cache.
+
+Verifying a device reads terabytes of data that won't be needed again, which
+would otherwise push everything the rest of the host has cached out of memory.
+When enabled, files are read with O_DIRECT into page-aligned buffers. File
+systems that refuse O_DIRECT are read normally and each block is dropped from
+the page cache right after it's read.
+"""
+
+import errno
+import mmap
+import os
+import pathlib
+import typing
+
+from ltarchiver import governor
+
+enabled = False
+
+
+def _open_direct(path: pathlib.Path) -> typing.Optional[int]:
+    """path opened with O_DIRECT, None if its file system doesn't support it."""
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+    except OSError as err:
+        if err.errno != errno.EINVAL:
+            raise
+        return None
+    # Some file systems accept the flag and only fail on the first read.
+    try:
+        with mmap.mmap(-1, mmap.PAGESIZE) as probe:
+            os.preadv(fd, [probe], 0)
+    except OSError as err:
+        os.close(fd)
+        if err.errno != errno.EINVAL:
+            raise
+        return None
+    return fd
+
+
+class Reader:
+    """A file read from start to end, paced by the governor.
+
+    The buffers given to readinto must be page aligned, as mmap buffers are,
+    because the file may have been opened with O_DIRECT.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        fd = _open_direct(path) if enabled else None
+        self.direct = fd is not None
+        self.fd = fd if fd is not None else os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        self.offset = 0
+        self.eof = False
+
+    def seek(self, offset: int):
+        if self.direct and offset % mmap.PAGESIZE:
+            # O_DIRECT can only read from aligned offsets.
+            os.close(self.fd)
+            self.fd = os.open(self.path, os.O_RDONLY)
+            self.direct = False
+        self.offset = offset
+
+    def readinto(self, buffer) -> int:
+        if self.eof:
+            return 0
+        count = os.preadv(self.fd, [buffer], self.offset)
+        if count <= 0:
+            self.eof = True
+            return 0
+        if governor.current is not None:
+            governor.current.throttle(count)
+        if not self.direct and (enabled or governor.current is not None):
+            os.posix_fadvise(self.fd, self.offset, count, os.POSIX_FADV_DONTNEED)
+        self.offset += count
+        # A short read means the end of the file and O_DIRECT can't read past it
+        # from the unaligned offset where it stopped.
+        self.eof = self.direct and count < len(buffer)
+        return count
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self) -> "Reader":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
@@ -0,0 +1,442 @@
+"""Stripe command
+
+Spreads a file over several devices so that it survives losing whole devices,
+for much less space than a replica on each of them. The file is cut in K data
+shards and M parity shards are computed from them (see ltarchiver.parity), one
+shard per device. Any K of the K+M shards give the file back.
+
+Each shard is stored like any other file, with its own ECC and record, so
+verify and refresh work on shards too. Its record tells which shard it is and
+what the whole file was. Shards are read and written on all devices at once.
+The shards are cut in ~/.ltarchiver/shards before they are stored, which needs
+as much free space there as the shards take.
+
+Usage:
+  ltarchiver-stripe store [--parity=<m>] <source> <device_path>...
+  ltarchiver-stripe restore <name> <destination>
+  ltarchiver-stripe rebuild [--shard=<i>] <name> <device_path>
+
+Options:
+  --parity=<m>  How many of the devices may be lost [default: 1].
+  --shard=<i>   The shard to rebuild, the first one missing by default.
+"""
+
+import concurrent.futures
+import contextvars
+import dataclasses
+import hashlib
+import os
+import pathlib
+import shutil
+import typing
+
+from ltarchiver import common, parity, transaction
+
+unit_size = 1024 * 1024  # bytes of a shard per row
+shards_dir = common.recordbook_dir / "shards"
+SHARD_SUFFIX = ".shard"
+
+
+@dataclasses.dataclass(frozen=True)
+class Stripe:
+    index: int
+    data_shards: int
+    parity_shards: int
+    size: int  # of the whole file
+    checksum: str  # of the whole file
+
+    def format(self) -> str:
+        return (
+            f"{self.index}/{self.data_shards}+{self.parity_shards},"
+            f"{self.size},{self.checksum}"
+        )
+
+    @classmethod
+    def parse(cls, text: str) -> "Stripe":
+        shard, size, checksum = text.split(",")
+        index, counts = shard.split("/")
+        data_shards, parity_shards = counts.split("+")
+        return cls(
+            int(index), int(data_shards), int(parity_shards), int(size), checksum
+        )
+
+    def shard(self, index: int) -> "Stripe":
+        return dataclasses.replace(self, index=index)
+
+
+def shard_name(name: str, index: int) -> str:
+    return f"{name}{SHARD_SUFFIX}{index}"
+
+
+def striped_name(record: common.Record) -> str:
+    return record.file_name.rsplit(SHARD_SUFFIX, 1)[0]
+
+
+def shard_size(size: int, data_shards: int) -> int:
+    """Bytes of each shard of a file of size bytes, see split."""
+    rows = max(-(-size // (data_shards * unit_size)), 1)
+    return rows * unit_size
+
+
+def check_free_space(needed: int):
+    """Fail unless needed bytes can be written to shards_dir."""
+    free = shutil.disk_usage(shards_dir).free
+    if needed > free:
+        raise common.LTAError(
+            f"The shards take {needed} bytes but only {free} are free in {shards_dir}"
+        )
+
+
+def split(
+    source: pathlib.Path,
+    directory: pathlib.Path,
+    data_shards: int,
+    parity_shards: int,
+) -> typing.Tuple[Stripe, typing.List[pathlib.Path]]:
+    """Cut source in shards written to directory.
+
+    Row after row, unit_size bytes of source go to each data shard, the last
+    row padded with zeros, and the parity shards get the parity of the row.
+    """
+    if data_shards < 1 or parity_shards < 1:
+        raise common.LTAError(
+            "At least one data shard and one parity shard are needed"
+        )
+    if data_shards + parity_shards > 256:
+        raise common.LTAError("At most 256 shards are supported")
+    paths = [
+        directory / shard_name(source.name, index)
+        for index in range(data_shards + parity_shards)
+    ]
+    md5 = hashlib.md5()
+    size = 0
+    outs = [path.open("wb") for path in paths]
+    try:
+        with source.open("rb") as f:
+            while True:
+                row = f.read(data_shards * unit_size)
+                if not row and size:
+                    break
+                md5.update(row)
+                size += len(row)
+                units = [
+                    row[start : start + unit_size].ljust(unit_size, b"\0")
+                    for start in range(0, data_shards * unit_size, unit_size)
+                ]
+                for out, unit in zip(
+                    outs, units + parity.encode_stripe(units, parity_shards)
+                ):
+                    out.write(unit)
+                if len(row) < data_shards * unit_size:
+                    break
+    finally:
+        for out in outs:
+            out.close()
+    return Stripe(0, data_shards, parity_shards, size, md5.hexdigest()), paths
+
+
+class ShardReader:
+    """Reads the rows of a file back from any data_shards of its shards.
+
+    The shards are read in parallel and hashed on the way, see damaged().
+    """
+
+    def __init__(
+        self,
+        stripe: Stripe,
+        shards: typing.Dict[int, pathlib.Path],
+        checksums: typing.Dict[int, str],
+    ):
+        # data shards first, nothing has to be decoded while they are all there
+        self.indexes = sorted(shards)[: stripe.data_shards]
+        if len(self.indexes) < stripe.data_shards:
+            raise common.LTAError(
+                f"Only {len(shards)} of the {stripe.data_shards} shards needed are"
+                " available"
+            )
+        self.stripe = stripe
+        self.checksums = checksums
+        self.files = {index: shards[index].open("rb") for index in self.indexes}
+        self.md5s = {index: hashlib.md5() for index in self.indexes}
+        size = os.fstat(self.files[self.indexes[0]].fileno()).st_size
+        self.rows = size // unit_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(len(self.indexes))
+
+    def _read(self, index: int) -> bytes:
+        unit = self.files[index].read(unit_size)
+        self.md5s[index].update(unit)
+        return unit.ljust(unit_size, b"\0")
+
+    def __iter__(self) -> typing.Iterator[typing.List[bytes]]:
+        """The data units of every row."""
+        total = self.stripe.data_shards + self.stripe.parity_shards
+        for _ in range(self.rows):
+            units = self.executor.map(self._read, self.indexes)
+            read = dict(zip(self.indexes, units))
+            units = [read.get(index) for index in range(total)]
+            yield parity.decode_stripe(
+                units[: self.stripe.data_shards], units[self.stripe.data_shards :]
+            )
+
+    def damaged(self) -> typing.List[int]:
+        """The shards read that don't match their checksum."""
+        return [
+            index
+            for index in self.indexes
+            if self.md5s[index].hexdigest() != self.checksums[index]
+        ]
+
+    def close(self):
+        self.executor.shutdown()
+        for f in self.files.values():
+            f.close()
+
+    def __enter__(self) -> "ShardReader":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def join(
+    stripe: Stripe,
+    shards: typing.Dict[int, pathlib.Path],
+    checksums: typing.Dict[int, str],
+    destination: pathlib.Path,
+) -> typing.List[int]:
+    """Write the file back to destination from shards, the available shards by index.
+
+    Returns the damaged shards that were read, the file is only complete without
+    any.
+    """
+    left = stripe.size
+    with ShardReader(stripe, shards, checksums) as reader, destination.open(
+        "wb"
+    ) as out:
+        for units in reader:
+            for unit in units:
+                out.write(unit[:left])
+                left -= min(left, len(unit))
+        return reader.damaged()
+
+
+def rebuild_shard(
+    stripe: Stripe,
+    shards: typing.Dict[int, pathlib.Path],
+    checksums: typing.Dict[int, str],
+    index: int,
+    destination: pathlib.Path,
+) -> typing.List[int]:
+    """Write the shard index to destination from the others, like join."""
+    with ShardReader(stripe, shards, checksums) as reader, destination.open(
+        "wb"
+    ) as out:
+        for units in reader:
+            if index < stripe.data_shards:
+                out.write(units[index])
+            else:
+                parities = parity.encode_stripe(units, stripe.parity_shards)
+                out.write(parities[index - stripe.data_shards])
+        return reader.damaged()
+
+
+def shard_records(name: str) -> typing.Dict[int, common.Record]:
+    """The latest record of every shard of the striped file name."""
+    records = {}
+    for record in common.get_records(common.recordbook_path):
+        if record.stripe and not record.deleted and striped_name(record) == name:
+            records[Stripe.parse(record.stripe).index] = record
+    if not records:
+        raise common.LTAError(f"{name} is not in the recordbook as a striped file")
+    return records
+
+
+def available_shards(
+    records: typing.Dict[int, common.Record]
+) -> typing.Dict[int, pathlib.Path]:
+    """The shards on the devices that are connected."""
+    shards = {}
+    for index, record in records.items():
+        try:
+            path = record.file_path(common.get_root_from_uuid(record.destination))
+        except AttributeError:
+            continue
+        if path.exists():
+            shards[index] = path
+    return shards
+
+
+def _read_shards(
+    records: typing.Dict[int, common.Record],
+    write: typing.Callable[[Stripe, typing.Dict[int, pathlib.Path], dict], list],
+) -> Stripe:
+    """Call write with the available shards until none of those it read is damaged.
+
+    A damaged shard is left out and the next one is read instead. Each shard has
+    its ECC too, so it can also be repaired with ltarchiver-restore.
+    """
+    stripe = Stripe.parse(next(iter(records.values())).stripe)
+    shards = available_shards(records)
+    checksums = {index: record.checksum for index, record in records.items()}
+    while True:
+        damaged = write(stripe, shards, checksums)
+        if not damaged:
+            return stripe
+        for index in damaged:
+            print(f"{shards[index]} is damaged, using another shard instead")
+            del shards[index]
+
+
+def restore_striped(name: str, destination: pathlib.Path):
+    partial_path = destination.with_name(destination.name + ".part")
+    try:
+        stripe = _read_shards(
+            shard_records(name),
+            lambda stripe, shards, checksums: join(
+                stripe, shards, checksums, partial_path
+            ),
+        )
+        if common.get_file_checksum(partial_path) != stripe.checksum:
+            raise common.LTAError(f"{name} doesn't match its checksum. Sorry!")
+        common.fsync_file(partial_path)
+        os.replace(partial_path, destination)
+    finally:
+        common.remove_file(partial_path)
+    print(f"{name} restored to {destination}")
+
+
+def _in_context(function, *args, **kwargs):
+    return contextvars.copy_context().run(function, *args, **kwargs)
+
+
+def store_striped(
+    source: pathlib.Path, destinations: typing.List[pathlib.Path], parity_shards: int
+):
+    """Store source as shards, one on each of destinations, written in parallel."""
+    from ltarchiver import store
+
+    data_shards = len(destinations) - parity_shards
+    if not common.DEBUG:
+        uuids = {common.get_device_uuid_and_root_from_path(d)[0] for d in destinations}
+        if len(uuids) != len(destinations):
+            raise common.LTAError("Every shard must go to a different device")
+    shards_dir.mkdir(parents=True, exist_ok=True)
+    check_free_space(
+        # split rejects fewer than one data shard
+        shard_size(source.stat().st_size, max(data_shards, 1))
+        * (data_shards + parity_shards)
+    )
+    print(f"Cutting {source} in {data_shards}+{parity_shards} shards")
+    stripe, paths = split(source, shards_dir, data_shards, parity_shards)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(len(paths)) as executor:
+            futures = [
+                executor.submit(
+                    _in_context,
+                    store.store,
+                    path,
+                    destination,
+                    non_interactive=True,
+                    keep_source=True,
+                    stripe=stripe.shard(index).format(),
+                )
+                for index, (path, destination) in enumerate(zip(paths, destinations))
+            ]
+            errors = [future.exception() for future in futures]
+    finally:
+        for path in paths:
+            common.remove_file(path)
+    failed = [
+        f"shard {index} on {destination}: {error}"
+        for index, (destination, error) in enumerate(zip(destinations, errors))
+        if error is not None
+    ]
+    if len(failed) > parity_shards:
+        raise common.LTAError("Failed to store " + ", ".join(failed))
+    for failure in failed:
+        print(f"Failed to store {failure}, rebuild it with ltarchiver-stripe rebuild")
+
+
+def rebuild(name: str, device_path: pathlib.Path, index: typing.Optional[int] = None):
+    """Rebuild a missing shard of name on the device of device_path.
+
+    The shards it's rebuilt from are read in parallel.
+    """
+    from ltarchiver import store
+
+    records = shard_records(name)
+    stripe = Stripe.parse(next(iter(records.values())).stripe)
+    if index is None:
+        shards = available_shards(records)
+        missing = [
+            i
+            for i in range(stripe.data_shards + stripe.parity_shards)
+            if i not in shards
+        ]
+        if not missing:
+            print(f"Every shard of {name} is available")
+            return
+        index = missing[0]
+    device_uuid, _ = common.get_device_uuid_and_root_from_path(device_path)
+    old_record = records.get(index)
+    shards_dir.mkdir(parents=True, exist_ok=True)
+    check_free_space(shard_size(stripe.size, stripe.data_shards))
+    path = shards_dir / shard_name(name, index)
+    others = {i: record for i, record in records.items() if i != index}
+    try:
+        print(f"Rebuilding shard {index} of {name}")
+        _read_shards(
+            others,
+            lambda stripe, shards, checksums: rebuild_shard(
+                stripe, shards, checksums, index, path
+            ),
+        )
+        if old_record is not None and old_record.destination == device_uuid:
+            # the shard was lost from this very device
+            transaction.delete_record(old_record)
+            old_record = None
+        store.store(
+            path,
+            device_path,
+            non_interactive=True,
+            keep_source=True,
+            stripe=stripe.shard(index).format(),
+        )
+    finally:
+        common.remove_file(path)
+    if old_record is not None:
+        # the shard on the lost device is replaced by the new one
+        transaction.delete_record(old_record)
+
+
+def run():
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    transaction.recover()
+    try:
+        if arguments["store"]:
+            store_striped(
+                pathlib.Path(arguments["<source>"]).resolve(),
+                [pathlib.Path(path).resolve() for path in arguments["<device_path>"]],
+                int(arguments["--parity"]),
+            )
+        elif arguments["restore"]:
+            destination = pathlib.Path(arguments["<destination>"])
+            if destination.is_dir():
+                destination = destination / arguments["<name>"]
+            restore_striped(arguments["<name>"], destination)
+        else:
+            shard = arguments["--shard"]
+            rebuild(
+                arguments["<name>"],
+                pathlib.Path(arguments["<device_path>"][0]).resolve(),
+                None if shard is None else int(shard),
+            )
+    except common.LTAError as err:
+        common.error(err.args[0])
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,317 @@
+"""Find command
+
+Tells where files were archived. The home recordbook is indexed in a catalog,
+~/.ltarchiver/catalog.sqlite, so queries stay fast with millions of records.
+When the recordbook changes only the records of the generations that came after
+the catalog was updated are indexed. The conditions given are all required.
+
+<name> is a glob, like "*.jpg" or "photos-2020*", matched against the name of
+the archived files, or against their source path when it has a /. A name ending
+in * is looked up in the index as a prefix.
+
+Usage:
+  ltarchiver-find [options] [<name>]
+
+Options:
+  --checksum=<md5>  Only the files with this checksum.
+  --device=<uuid>   Only the files on this device.
+  --since=<date>    Only the files stored on or after date, in ISO 8601, like
+                    2020-01-31 or 2020-01-31T12:00.
+  --until=<date>    Only the files stored before date.
+  --deleted         Also the files that were deleted.
+  --mounted         Also tell whether the device of each file is connected and
+                    where it is mounted.
+  --json            Print a JSON object per file.
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import sqlite3
+import typing
+
+from docopt import docopt
+
+from ltarchiver import common, sparse, verify
+
+catalog_path = common.recordbook_dir / "catalog.sqlite"
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE records (
+    file_name TEXT,
+    source TEXT,
+    destination TEXT,
+    checksum TEXT,
+    ecc_checksum TEXT,
+    stored_at REAL,
+    timestamp TEXT,
+    chunksize INTEGER,
+    eccsize INTEGER,
+    checksum_algorithm TEXT,
+    deleted INTEGER,
+    version INTEGER,
+    generation INTEGER,
+    holes TEXT,
+    compression TEXT,
+    stripe TEXT
+);
+CREATE INDEX records_file_name ON records (file_name);
+CREATE INDEX records_source ON records (source);
+CREATE INDEX records_checksum ON records (checksum);
+CREATE INDEX records_destination ON records (destination);
+CREATE INDEX records_stored_at ON records (stored_at);
+CREATE UNIQUE INDEX records_identity ON records (file_name, destination, checksum);
+"""
+COLUMNS = (
+    "file_name, source, destination, checksum, ecc_checksum, stored_at, timestamp,"
+    " chunksize, eccsize, checksum_algorithm, deleted, version, generation, holes,"
+    " compression, stripe"
+)
+PLACEHOLDERS = ", ".join("?" for _ in COLUMNS.split(","))
+
+
+def _recordbook_key(recordbook: pathlib.Path) -> str:
+    try:
+        return json.dumps(common.stat_key(recordbook))
+    except FileNotFoundError:
+        return ""
+
+
+def _row(record: common.Record) -> tuple:
+    return (
+        record.file_name,
+        str(record.source),
+        record.destination,
+        record.checksum,
+        record.ecc_checksum,
+        record.timestamp.timestamp(),
+        record.timestamp.isoformat(),
+        record.chunksize,
+        record.eccsize,
+        record.checksum_algorithm,
+        record.deleted,
+        record.version,
+        record.generation,
+        sparse.format_holes(record.holes),
+        record.compression,
+        record.stripe,
+    )
+
+
+def _record(row: tuple) -> common.Record:
+    return common.Record(
+        file_name=row[0],
+        source=pathlib.Path(row[1]),
+        destination=row[2],
+        checksum=row[3],
+        ecc_checksum=row[4],
+        timestamp=datetime.datetime.fromisoformat(row[6]),
+        chunksize=row[7],
+        eccsize=row[8],
+        checksum_algorithm=row[9],
+        deleted=bool(row[10]),
+        version=row[11],
+        generation=row[12],
+        holes=sparse.parse_holes(row[13]),
+        compression=row[14],
+        stripe=row[15],
+    )
+
+
+def build(recordbook: pathlib.Path, path: pathlib.Path):
+    """Index the records of recordbook in a new catalog at path.
+
+    Only the last record of each file is kept, as in the recordbook a deletion
+    or a refresh is a new record of the same file.
+    """
+    key = _recordbook_key(recordbook)
+    records = {}
+    generation = 0
+    if key:
+        generation = common.read_recordbook_header(recordbook).generation
+        for record in common.get_records(recordbook):
+            records[record.identity()] = record
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    common.remove_file(temp_path)
+    try:
+        with contextlib.closing(sqlite3.connect(temp_path)) as connection:
+            connection.executescript(SCHEMA)
+            connection.executemany(
+                f"INSERT INTO records ({COLUMNS}) VALUES ({PLACEHOLDERS})",
+                (_row(record) for record in records.values()),
+            )
+            connection.executemany(
+                "INSERT INTO meta VALUES (?, ?)",
+                [("recordbook", key), ("generation", str(generation))],
+            )
+            # statistics for the query planner to choose between the indexes
+            connection.execute("ANALYZE")
+            connection.commit()
+        os.replace(temp_path, path)
+    finally:
+        common.remove_file(temp_path)
+
+
+def update(connection: sqlite3.Connection, recordbook: pathlib.Path) -> bool:
+    """Index the records of recordbook that changed since the catalog was updated.
+
+    A store appends a record and a deletion rewrites one, both with a new
+    generation. Returns False when the catalog must be built again instead,
+    because the recordbook changed in some other way.
+    """
+    key = _recordbook_key(recordbook)
+    meta = dict(connection.execute("SELECT key, value FROM meta"))
+    if meta["recordbook"] == key:
+        return True
+    indexed = int(meta["generation"])
+    if not key:
+        return False
+    generation = common.read_recordbook_header(recordbook).generation
+    if generation <= indexed:
+        return False  # replaced, edited by hand or without generations
+    connection.executemany(
+        f"INSERT OR REPLACE INTO records ({COLUMNS}) VALUES ({PLACEHOLDERS})",
+        (
+            _row(record)
+            for record in common.get_records(recordbook)
+            if record.generation > indexed
+        ),
+    )
+    connection.executemany(
+        "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+        [("recordbook", key), ("generation", str(generation))],
+    )
+    connection.commit()
+    return True
+
+
+def open_catalog(
+    recordbook: pathlib.Path = common.recordbook_path,
+    path: typing.Optional[pathlib.Path] = None,
+) -> sqlite3.Connection:
+    """The catalog of recordbook, updated first if the recordbook changed."""
+    path = path or catalog_path
+    if path.exists():
+        connection = sqlite3.connect(path)
+        try:
+            if update(connection, recordbook):
+                return connection
+        except (sqlite3.DatabaseError, KeyError, ValueError):
+            pass  # damaged or from another version, built again
+        connection.close()
+    build(recordbook, path)
+    return sqlite3.connect(path)
+
+
+def parse_date(text: str) -> float:
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError as err:
+        raise common.LTAError(f"{text} is not a date in ISO 8601") from err
+
+
+def find(
+    connection: sqlite3.Connection,
+    name: typing.Optional[str] = None,
+    checksum: typing.Optional[str] = None,
+    device: typing.Optional[str] = None,
+    since: typing.Optional[float] = None,
+    until: typing.Optional[float] = None,
+    deleted: bool = False,
+) -> typing.List[common.Record]:
+    """The records matching every condition given, oldest first.
+
+    since and until are timestamps, since is included and until isn't.
+    """
+    conditions = []
+    parameters: typing.List[typing.Any] = []
+    if name is not None:
+        # GLOB is case sensitive, so sqlite looks its literal prefix up in the index
+        conditions.append(f"{'source' if '/' in name else 'file_name'} GLOB ?")
+        parameters.append(name)
+    for column, value in (
+        ("checksum", checksum),
+        ("destination", device),
+    ):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            parameters.append(value)
+    if since is not None:
+        conditions.append("stored_at >= ?")
+        parameters.append(since)
+    if until is not None:
+        conditions.append("stored_at < ?")
+        parameters.append(until)
+    if not deleted:
+        conditions.append("NOT deleted")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    # sorted here, an ORDER BY could make sqlite scan the stored_at index instead
+    # of using the one that narrows the search down
+    rows = connection.execute(f"SELECT {COLUMNS} FROM records {where}", parameters)
+    return [_record(row) for row in sorted(rows, key=lambda row: row[5])]
+
+
+def describe(
+    record: common.Record, roots: typing.Optional[verify.DeviceRoots] = None
+) -> dict:
+    """What is printed about record, roots tells where the devices are mounted."""
+    description = {
+        "file": record.file_name,
+        "device": record.destination,
+        "source": str(record.source),
+        "stored": record.timestamp.isoformat(),
+        "checksum": record.checksum,
+    }
+    if record.deleted:
+        description["deleted"] = True
+    if roots is not None:
+        root, _ = roots.get(record.destination)
+        description["mounted"] = str(root) if root is not None else None
+    return description
+
+
+def print_description(description: dict):
+    line = (
+        f"{description['stored']} {description['device']} {description['file']}"
+        f" (from {description['source']})"
+    )
+    if description.get("deleted"):
+        line += " deleted"
+    if "mounted" in description:
+        mounted = description["mounted"]
+        line += f", mounted at {mounted}" if mounted else ", not connected"
+    print(line)
+
+
+def run():
+    arguments = docopt(__doc__)
+    try:
+        since, until = (
+            parse_date(arguments[option]) if arguments[option] else None
+            for option in ("--since", "--until")
+        )
+        with contextlib.closing(open_catalog()) as connection:
+            records = find(
+                connection,
+                arguments["<name>"],
+                arguments["--checksum"],
+                arguments["--device"],
+                since,
+                until,
+                arguments["--deleted"],
+            )
+    except common.LTAError as err:
+        common.error(err.args[0])
+    roots = verify.DeviceRoots() if arguments["--mounted"] else None
+    for record in records:
+        description = describe(record, roots)
+        if arguments["--json"]:
+            print(json.dumps(description))
+        else:
+            print_description(description)
+
+
+if __name__ == "__main__":
+    run()
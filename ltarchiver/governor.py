@@ -0,0 +1,76 @@
+"""Background I/O mode.
+
+When a governor is configured the in-process read and write loops are paced
+to a maximum bandwidth and number of operations per second, and the pages they
+read are dropped from the page cache right away so a long verification doesn't
+evict the cache of the other programs of the host. The process can also be put
+in the idle I/O scheduling class, which the external encoder and decoder
+inherit, so it only gets the disk when nobody else wants it.
+"""
+
+import os
+import threading
+import time
+import typing
+
+burst = 1.0  # seconds of unused budget that may be spent at once
+
+
+class Governor:
+    def __init__(
+        self,
+        max_bytes_per_second: float = 0,
+        max_ops_per_second: float = 0,
+        drop_cache: bool = True,
+    ):
+        self.max_bytes_per_second = max_bytes_per_second
+        self.max_ops_per_second = max_ops_per_second
+        self.drop_cache = drop_cache
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def throttle(self, count: int):
+        """Account for an operation of count bytes, waiting if over budget."""
+        cost = 0.0
+        if self.max_bytes_per_second:
+            cost = max(cost, count / self.max_bytes_per_second)
+        if self.max_ops_per_second:
+            cost = max(cost, 1 / self.max_ops_per_second)
+        if not cost:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next_time = max(self.next_time, now - burst) + cost
+            wait = self.next_time - now
+        if wait > 0:
+            time.sleep(wait)
+
+    def forget(self, f: typing.BinaryIO, offset: int, length: int):
+        """Drop a range of f that won't be needed again from the page cache."""
+        if self.drop_cache:
+            os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_DONTNEED)
+
+
+current: typing.Optional[Governor] = None
+
+
+def configure(
+    max_mb_per_second: float = 0, max_iops: float = 0, idle: bool = False
+) -> Governor:
+    """Start running in background mode."""
+    global current
+    current = Governor(max_mb_per_second * 1024**2, max_iops)
+    if idle:
+        import psutil
+
+        try:
+            psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+        except (AttributeError, psutil.Error) as err:
+            print(f"Could not use the idle I/O scheduling class: {err}")
+    return current
+
+
+def synced(f: typing.BinaryIO, offset: int, length: int):
+    """Drop a range of f that was just flushed to the disk from the page cache."""
+    if current is not None:
+        current.forget(f, offset, length)
@@ -0,0 +1,172 @@
+"""Timing of the phases of the commands.
+
+The slow parts of every command are wrapped in spans named after their phase
+(hash, copy, ecc-encode, ecc-decode, ecc-hash, fsync, recordbook-commit, sync,
+device-lookup). Spans cost next to nothing until a session is started with a
+metrics file, then each of them is recorded with the bytes it processed.
+
+A metrics file ending in .prom is written as a Prometheus textfile with the
+totals of each phase, anything else gets one JSON line per span as soon as the
+span ends so long runs can be followed while they happen.
+
+The LTARCHIVER_METRICS and LTARCHIVER_PROFILE environment variables are used by
+the commands that weren't given --metrics or --profile.
+"""
+
+import contextlib
+import dataclasses
+import json
+import os
+import pathlib
+import sys
+import threading
+import time
+import typing
+
+
+@dataclasses.dataclass
+class Span:
+    phase: str
+    bytes: int = 0
+    start: float = 0.0
+    seconds: float = 0.0
+
+    @property
+    def mb_per_s(self) -> float:
+        if not self.seconds:
+            return 0.0
+        return self.bytes / self.seconds / 1024**2
+
+
+@dataclasses.dataclass
+class PhaseTotal:
+    runs: int = 0
+    seconds: float = 0.0
+    bytes: int = 0
+
+
+class Recorder:
+    def __init__(self, command: str, path: pathlib.Path):
+        self.command = command
+        self.path = path
+        self.prometheus = path.suffix == ".prom"
+        self.totals: typing.Dict[str, PhaseTotal] = {}
+        self.lock = threading.Lock()
+        self.file = None if self.prometheus else path.open("a")
+
+    def add(self, span: Span):
+        with self.lock:
+            total = self.totals.setdefault(span.phase, PhaseTotal())
+            total.runs += 1
+            total.seconds += span.seconds
+            total.bytes += span.bytes
+            if self.file is not None:
+                self.file.write(
+                    json.dumps(
+                        {
+                            "command": self.command,
+                            "phase": span.phase,
+                            "start": span.start,
+                            "seconds": span.seconds,
+                            "bytes": span.bytes,
+                            "mb_per_s": span.mb_per_s,
+                        }
+                    )
+                    + "\n"
+                )
+                self.file.flush()
+
+    def flush(self):
+        if not self.prometheus:
+            return
+        lines = []
+        for metric, help_text, value_of in (
+            ("ltarchiver_phase_seconds_total", "Time spent in the phase.", "seconds"),
+            ("ltarchiver_phase_bytes_total", "Bytes processed by the phase.", "bytes"),
+            ("ltarchiver_phase_runs_total", "Times the phase ran.", "runs"),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            with self.lock:
+                for phase, total in sorted(self.totals.items()):
+                    lines.append(
+                        f'{metric}{{command="{self.command}",phase="{phase}"}}'
+                        f" {getattr(total, value_of)}"
+                    )
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        temp_path.write_text("\n".join(lines) + "\n")
+        os.replace(temp_path, self.path)  # the collector must never see half a file
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+
+    def report(self) -> str:
+        """The totals of each phase as a table, slowest first."""
+        lines = [f"{'phase':<20}{'runs':>6}{'seconds':>12}{'MB':>12}{'MB/s':>10}"]
+        with self.lock:
+            totals = sorted(self.totals.items(), key=lambda item: -item[1].seconds)
+        for phase, total in totals:
+            mb = total.bytes / 1024**2
+            rate = mb / total.seconds if total.seconds and total.bytes else 0.0
+            lines.append(
+                f"{phase:<20}{total.runs:>6}{total.seconds:>12.3f}{mb:>12.1f}{rate:>10.1f}"
+            )
+        return "\n".join(lines)
+
+
+recorder: typing.Optional[Recorder] = None
+
+
+@contextlib.contextmanager
+def span(phase: str, bytes: int = 0) -> typing.Iterator[Span]:
+    """Time the block as phase. The bytes can also be set on the span inside it."""
+    current = Span(phase, bytes, time.time())
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - start
+        if recorder is not None:
+            recorder.add(current)
+
+
+def file_size(path: pathlib.Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+@contextlib.contextmanager
+def session(
+    command: str,
+    metrics: typing.Optional[str] = None,
+    profile: typing.Optional[str] = None,
+):
+    """Record the spans of a command to metrics and profile it to profile.
+
+    The profile is written in the format of cProfile, readable with pstats.
+    """
+    global recorder
+    metrics = metrics or os.environ.get("LTARCHIVER_METRICS")
+    profile = profile or os.environ.get("LTARCHIVER_PROFILE")
+    if metrics:
+        recorder = Recorder(command, pathlib.Path(metrics))
+    profiler = None
+    if profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        if recorder is not None:
+            recorder.close()
+            print(recorder.report(), file=sys.stderr)
+            recorder = None
@@ -0,0 +1,132 @@
+"""Concurrent stores of several sources to several destination devices.
+
+Every destination device gets its own queue of writes so that each disk is only
+written sequentially while different disks are written at the same time. The
+checksum of a source is computed once no matter how many destinations it goes
+to, and its copies are started together so the source is read from the page
+cache after the first pass.
+"""
+
+import asyncio
+import contextvars
+import dataclasses
+import functools
+import pathlib
+import typing
+
+from ltarchiver import common, store
+
+
+@dataclasses.dataclass
+class Job:
+    source: pathlib.Path
+    destinations: typing.List[pathlib.Path]
+
+
+@dataclasses.dataclass
+class Failure:
+    source: pathlib.Path
+    destination: pathlib.Path
+    error: BaseException
+
+    def __str__(self):
+        if isinstance(self.error, common.LTAError):
+            reason = self.error.args[0]
+        else:
+            reason = f"{type(self.error).__name__}: {self.error}"
+        return f"Failed to store {self.source} on {self.destination}: {reason}"
+
+
+class StoreEngine:
+    """Run store jobs with at most writers_per_device writers on each device."""
+
+    def __init__(
+        self,
+        writers_per_device: int = 1,
+        remove_sources: bool = False,
+        codec: str = "",
+        as_container: bool = False,
+    ):
+        self.writers_per_device = writers_per_device
+        self.remove_sources = remove_sources
+        self.codec = codec
+        self.as_container = as_container
+        self._device_slots: typing.Dict[str, asyncio.Semaphore] = {}
+        self._checksums: typing.Dict[pathlib.Path, asyncio.Future] = {}
+
+    async def _in_thread(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # the prompt and progress hooks of the caller apply in the thread too
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            None, functools.partial(context.run, function, *args, **kwargs)
+        )
+
+    async def device_slot(self, destination: pathlib.Path) -> asyncio.Semaphore:
+        device_uuid, _ = await self._in_thread(
+            common.get_device_uuid_and_root_from_path, destination
+        )
+        if device_uuid not in self._device_slots:
+            self._device_slots[device_uuid] = asyncio.Semaphore(
+                self.writers_per_device
+            )
+        return self._device_slots[device_uuid]
+
+    async def checksum(self, source: pathlib.Path) -> str:
+        """md5 of source, computed only once for all of its destinations."""
+        if source not in self._checksums:
+            self._checksums[source] = asyncio.ensure_future(
+                self._in_thread(common.get_file_checksum, source)
+            )
+        return await self._checksums[source]
+
+    async def store_one(self, source: pathlib.Path, destination: pathlib.Path):
+        slot = await self.device_slot(destination)
+        checksum = await self.checksum(source)
+        async with slot:
+            await self._in_thread(
+                store.store,
+                source,
+                destination,
+                non_interactive=True,
+                checksum=checksum,
+                keep_source=True,
+                codec=self.codec,
+            )
+
+    async def run_job(self, job: Job) -> typing.List[Failure]:
+        source = job.source
+        if source.is_dir():
+            source = await self._in_thread(
+                store.pack_directory, source, self.as_container
+            )
+        results = await asyncio.gather(
+            *(self.store_one(source, destination) for destination in job.destinations),
+            return_exceptions=True,
+        )
+        failures = [
+            Failure(job.source, destination, result)
+            for destination, result in zip(job.destinations, results)
+            if isinstance(result, BaseException)
+        ]
+        if source != job.source:
+            common.remove_file(source)
+        if self.remove_sources and not failures:
+            common.remove_file(job.source)
+        return failures
+
+    async def run(self, jobs: typing.Iterable[Job]) -> typing.List[Failure]:
+        results = await asyncio.gather(*(self.run_job(job) for job in jobs))
+        return [failure for failures in results for failure in failures]
+
+
+def run_jobs(
+    jobs: typing.Iterable[Job],
+    writers_per_device: int = 1,
+    remove_sources: bool = False,
+    codec: str = "",
+    as_container: bool = False,
+) -> typing.List[Failure]:
+    """Run jobs to completion and return whatever failed."""
+    engine = StoreEngine(writers_per_device, remove_sources, codec, as_container)
+    return asyncio.run(engine.run(jobs))
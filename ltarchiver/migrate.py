@@ -0,0 +1,87 @@
+"""Migrate command
+
+Moves the ECC files of a device from the legacy layout, all of them directly in
+.ltarchiver/ecc, to their shards. Only directory entries change, the ECC files
+aren't read or copied, and the other commands find ECC files in either layout,
+so the migration can be interrupted and run again at any time.
+
+Other ltarchiver commands don't start storing, refreshing or deleting files
+while a batch of files is being moved, and a batch waits for the ones already
+running to finish. Commands that only read ECC files, like ltarchiver-verify,
+look an ECC file up again when it was moved between finding and reading it.
+
+Usage:
+  ltarchiver-migrate [options] <device_path>
+
+Options:
+  --batch=<n>  ECC files moved at a time [default: 1000].
+  --dry-run    Only count the ECC files that would be moved.
+"""
+
+import os
+import pathlib
+import re
+import typing
+
+from docopt import docopt
+
+from ltarchiver import common, transaction
+
+legacy_name = re.compile(r"[0-9a-f]{32}")
+
+
+def legacy_ecc_files(metadata_dir: pathlib.Path) -> typing.List[pathlib.Path]:
+    ecc_dir = metadata_dir / common.ecc_dir_name
+    if not ecc_dir.is_dir():
+        return []
+    with os.scandir(ecc_dir) as entries:
+        return [
+            pathlib.Path(entry.path)
+            for entry in entries
+            if legacy_name.fullmatch(entry.name) and entry.is_file()
+        ]
+
+
+def migrate(metadata_dir: pathlib.Path, batch: int = 1000) -> int:
+    """Move the ECC files in metadata_dir to their shards, return how many moved."""
+    legacy = legacy_ecc_files(metadata_dir)
+    for start in range(0, len(legacy), batch):
+        with transaction.exclusive():
+            shards = set()
+            for path in legacy[start : start + batch]:
+                sharded = common.sharded_ecc_file_path(metadata_dir, path.name)
+                common.make_ecc_shard(sharded)
+                os.replace(path, sharded)
+                shards.add(sharded.parent)
+            for shard in shards:
+                common.fsync_directory(shard)
+            common.fsync_directory(metadata_dir / common.ecc_dir_name)
+        print(f"Moved {min(start + batch, len(legacy))} of {len(legacy)} ECC files")
+    return len(legacy)
+
+
+def run():
+    arguments = docopt(__doc__)
+    device_path = pathlib.Path(arguments["<device_path>"])
+    if not device_path.exists():
+        common.error(f"{device_path} doesn't exist!")
+    if common.DEBUG:
+        root = device_path
+    else:
+        _, root = common.get_device_uuid_and_root_from_path(device_path)
+    metadata_dir = root / common.METADATA_DIR_NAME
+    if arguments["--dry-run"]:
+        count = len(legacy_ecc_files(metadata_dir))
+        print(f"{count} ECC files would be moved to their shards")
+        return
+    transaction.recover()
+    try:
+        moved = migrate(metadata_dir, int(arguments["--batch"]))
+    except common.LTAError as err:
+        common.error(err.args[0])
+    if not moved:
+        print("Every ECC file is already in its shard")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,139 @@
+"""Packing of small files.
+
+Each stored file costs a record, an ECC file, a run of the encoder and a rewrite
+of both recordbooks, which for tiny files is far more than storing their bytes.
+Files smaller than a threshold are instead put together in packs, containers of
+up to pack_size bytes (see ltarchiver.container), and each pack is stored as a
+single file.
+
+The pack index, a JSON line per packed file in the home directory, says which
+pack and which member of it each source went to, and the record of the pack
+which devices the pack is on. The index is written before the packs are stored,
+so entries of packs without a record, whose store failed, are ignored. Like the
+recordbook, the index is copied to each device a pack is stored on. Should every
+copy be lost, the members of a pack are still named after their sources, see
+ltarchiver-container list.
+"""
+
+import datetime
+import json
+import os
+import pathlib
+import shutil
+import typing
+
+from ltarchiver import common, container
+
+pack_size = 64 * 1024 * 1024  # bytes
+index_file_name = "packs.jsonl"
+index_path = common.recordbook_dir / index_file_name
+packs_dir = common.recordbook_dir / "packs"
+
+
+def split(
+    sources: typing.Iterable[pathlib.Path], threshold: int
+) -> typing.Tuple[typing.List[pathlib.Path], typing.List[pathlib.Path]]:
+    """The sources smaller than threshold, which are packed, and the others."""
+    small, large = [], []
+    for source in sources:
+        if source.is_file() and source.stat().st_size < threshold:
+            small.append(source)
+        else:
+            large.append(source)
+    return small, large
+
+
+def group(sources: typing.List[pathlib.Path]) -> typing.List[typing.List[pathlib.Path]]:
+    """Split sources in groups of at most pack_size bytes (the padding aside)."""
+    groups, size = [[]], 0
+    for source in sources:
+        source_size = source.stat().st_size
+        if groups[-1] and size + source_size > pack_size:
+            groups.append([])
+            size = 0
+        groups[-1].append(source)
+        size += source_size
+    return [sources for sources in groups if sources]
+
+
+def member_name(source: pathlib.Path) -> str:
+    return source.as_posix().lstrip("/")
+
+
+def make_packs(sources: typing.List[pathlib.Path]) -> typing.List[pathlib.Path]:
+    """Put sources, absolute paths, in packs under packs_dir and return the packs.
+
+    The pack index is updated with where every source went.
+    """
+    packs_dir.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+    packs = []
+    entries = []
+    for n, sources in enumerate(group(sources)):
+        pack = packs_dir / f"pack-{stamp}-{n}{container.suffix}"
+        members = container.write(
+            ((source, member_name(source)) for source in sources), pack
+        )
+        packs.append(pack)
+        entries.extend(
+            {
+                "source": str(source),
+                "pack": pack.name,
+                "member": member.name,
+                "checksum": member.checksum,
+            }
+            for source, member in zip(sources, members)
+        )
+    append_entries(index_path, entries)
+    return packs
+
+
+def append_entries(path: pathlib.Path, entries: typing.List[dict]):
+    with path.open("a") as f:
+        f.writelines(json.dumps(entry) + "\n" for entry in entries)
+    common.fsync_file(path)
+
+
+def is_pack(path: pathlib.Path) -> bool:
+    return path.parent == packs_dir
+
+
+def copy_index(metadata_dir: pathlib.Path):
+    """Copy the pack index to the metadata directory of a device."""
+    if not index_path.exists():
+        return
+    device_index_path = metadata_dir / index_file_name
+    temp_path = device_index_path.with_name(f"{index_file_name}.tmp")
+    shutil.copy(index_path, temp_path)
+    common.fsync_file(temp_path)
+    os.replace(temp_path, device_index_path)
+    common.fsync_directory(metadata_dir)
+
+
+def read_index(path: pathlib.Path = index_path) -> typing.Iterator[dict]:
+    if not path.exists():
+        return
+    with path.open() as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash
+
+
+def locate(
+    source: pathlib.Path, recordbook: pathlib.Path = common.recordbook_path
+) -> typing.Optional[dict]:
+    """The latest entry of the pack index for source whose pack was stored."""
+    entries = [entry for entry in read_index() if entry["source"] == str(source)]
+    if not entries or not recordbook.exists():
+        return None
+    stored = {
+        record.file_name
+        for record in common.get_records(recordbook)
+        if not record.deleted
+    }
+    for entry in reversed(entries):
+        if entry["pack"] in stored:
+            return entry
+    return None
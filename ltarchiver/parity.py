@@ -0,0 +1,273 @@
+"""Reed-Solomon parity for the recordbooks.
+
+The code itself, encode_stripe and decode_stripe, also spreads files over
+several devices, see ltarchiver.erasure.
+
+The recordbook is cut in blocks of block_size bytes, each with its CRC, and
+every stripe of data_blocks blocks gets parity_blocks parity blocks from a
+Cauchy Reed-Solomon code over GF(256). The CRCs tell which blocks are damaged
+and any parity_blocks of them in a stripe can be rebuilt from the others, so a
+bit-rotted recordbook is repaired in place, without the other copy.
+
+Multiplying a block by a constant of GF(256) is a bytes.translate and adding two
+blocks a XOR of two integers, so no byte is handled in Python.
+
+The parity file, next to the recordbook, starts with a line holding a magic, the
+CRC of the header and the header itself, JSON with the geometry, the md5 of the
+recordbook it was computed from and the CRCs of all blocks. The parity blocks
+follow.
+"""
+
+import enum
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import typing
+import zlib
+
+MAGIC = "LTARCHIVER-PARITY"
+block_size = 4096  # bytes
+data_blocks = 32  # per stripe
+parity_blocks = 4  # per stripe, how many damaged blocks a stripe survives
+suffix = ".parity"
+
+_PRIMITIVE = 0x11D
+_EXP = [0] * 512
+_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    _EXP[_i] = _x
+    _LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= _PRIMITIVE
+for _i in range(255, 512):
+    _EXP[_i] = _EXP[_i - 255]
+
+
+class Status(enum.Enum):
+    INTACT = "The file matches its parity"
+    REPAIRED = "The file was repaired with its parity"
+    NO_PARITY = "The file has no usable parity"
+    STALE = "The parity is of another version of the file"
+    UNREPAIRABLE = "The file is too damaged to be repaired with its parity"
+
+    def __str__(self):
+        return self.value
+
+
+def _mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+
+def _inverse(a: int) -> int:
+    return _EXP[255 - _LOG[a]]
+
+
+@functools.lru_cache(maxsize=256)
+def _table(c: int) -> bytes:
+    return bytes(_mul(c, value) for value in range(256))
+
+
+def _scaled(block: bytes, c: int) -> int:
+    """block times c as an integer, ready to be XORed."""
+    return int.from_bytes(block.translate(_table(c)), "little")
+
+
+def _coefficient(parity: int, data: int, parity_count: int) -> int:
+    # a Cauchy matrix, every square submatrix of it can be inverted
+    return _inverse(parity ^ (parity_count + data))
+
+
+def _invert(matrix: typing.List[typing.List[int]]) -> typing.List[typing.List[int]]:
+    """Invert a square matrix over GF(256) by Gauss-Jordan elimination."""
+    n = len(matrix)
+    rows = [row[:] + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for column in range(n):
+        pivot = next(row for row in range(column, n) if rows[row][column])
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        scale = _inverse(rows[column][column])
+        rows[column] = [_mul(scale, value) for value in rows[column]]
+        for row in range(n):
+            factor = rows[row][column]
+            if row != column and factor:
+                rows[row] = [
+                    value ^ _mul(factor, pivot_value)
+                    for value, pivot_value in zip(rows[row], rows[column])
+                ]
+    return [row[n:] for row in rows]
+
+
+def encode_stripe(
+    blocks: typing.List[bytes], parity_count: int = parity_blocks
+) -> typing.List[bytes]:
+    """The parity_count parity blocks of blocks, which all have the same size.
+
+    There can be at most 256 blocks and parity blocks together.
+    """
+    size = len(blocks[0])
+    parity = []
+    for i in range(parity_count):
+        accumulator = 0
+        for j, block in enumerate(blocks):
+            accumulator ^= _scaled(block, _coefficient(i, j, parity_count))
+        parity.append(accumulator.to_bytes(size, "little"))
+    return parity
+
+
+def decode_stripe(
+    blocks: typing.List[typing.Optional[bytes]],
+    parity: typing.List[typing.Optional[bytes]],
+) -> typing.List[bytes]:
+    """Rebuild the blocks that are None from the others and the parity.
+
+    parity has all the parity blocks of the stripe, None for the missing ones.
+    Raises ValueError when more blocks are missing than there is parity left.
+    """
+    missing = [j for j, block in enumerate(blocks) if block is None]
+    if not missing:
+        return list(blocks)
+    rows = [i for i, block in enumerate(parity) if block is not None][: len(missing)]
+    if len(rows) < len(missing):
+        raise ValueError("Too many damaged blocks in a stripe")
+    size = len(parity[rows[0]])
+    syndromes = []
+    for i in rows:
+        syndrome = int.from_bytes(parity[i], "little")
+        for j, block in enumerate(blocks):
+            if block is not None:
+                syndrome ^= _scaled(block, _coefficient(i, j, len(parity)))
+        syndromes.append(syndrome.to_bytes(size, "little"))
+    inverse = _invert(
+        [[_coefficient(i, j, len(parity)) for j in missing] for i in rows]
+    )
+    repaired = list(blocks)
+    for t, j in enumerate(missing):
+        accumulator = 0
+        for r, syndrome in enumerate(syndromes):
+            accumulator ^= _scaled(syndrome, inverse[t][r])
+        repaired[j] = accumulator.to_bytes(size, "little")
+    return repaired
+
+
+def _blocks(data: bytes) -> typing.List[bytes]:
+    return [
+        data[start : start + block_size].ljust(block_size, b"\0")
+        for start in range(0, len(data), block_size)
+    ]
+
+
+def _crc(block: bytes) -> int:
+    return zlib.crc32(block)
+
+
+def parity_path(path: pathlib.Path) -> pathlib.Path:
+    return path.with_name(path.name + suffix)
+
+
+def write(path: pathlib.Path):
+    """Compute the parity of path, replacing its old parity."""
+    data = path.read_bytes()
+    blocks = _blocks(data)
+    parity = []
+    for start in range(0, len(blocks), data_blocks):
+        parity.extend(encode_stripe(blocks[start : start + data_blocks]))
+    header = json.dumps(
+        {
+            "size": len(data),
+            "md5": hashlib.md5(data).hexdigest(),
+            "block_size": block_size,
+            "data_blocks": data_blocks,
+            "parity_blocks": parity_blocks,
+            "crcs": [_crc(block) for block in blocks],
+            "parity_crcs": [_crc(block) for block in parity],
+        }
+    )
+    temp_path = path.with_name(path.name + suffix + ".tmp")
+    with temp_path.open("wb") as f:
+        f.write(f"{MAGIC} {zlib.crc32(header.encode()):08x} {header}\n".encode())
+        f.writelines(parity)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, parity_path(path))
+
+
+def _read(path: pathlib.Path) -> typing.Optional[typing.Tuple[dict, bytes]]:
+    """The header and the parity blocks of path, None if they can't be trusted."""
+    try:
+        content = parity_path(path).read_bytes()
+    except FileNotFoundError:
+        return None
+    line, _, parity = content.partition(b"\n")
+    try:
+        magic, crc, header = line.decode().split(" ", 2)
+        if magic != MAGIC or int(crc, 16) != zlib.crc32(header.encode()):
+            return None
+        header = json.loads(header)
+    except ValueError:
+        return None
+    if (header["block_size"], header["data_blocks"], header["parity_blocks"]) != (
+        block_size,
+        data_blocks,
+        parity_blocks,
+    ):
+        return None
+    return header, parity
+
+
+def repair(path: pathlib.Path, expected_md5: typing.Optional[str] = None) -> Status:
+    """Repair path in place with its parity.
+
+    expected_md5, the md5 path should have, keeps an outdated parity from
+    turning the file back into an older version.
+    """
+    parity_file = _read(path)
+    if parity_file is None:
+        return Status.NO_PARITY
+    header, parity = parity_file
+    if expected_md5 is not None and header["md5"] != expected_md5:
+        return Status.STALE
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        data = b""
+    if len(data) == header["size"] and hashlib.md5(data).hexdigest() == header["md5"]:
+        return Status.INTACT
+    # a truncated or extended file shows up as damaged blocks
+    blocks = _blocks(data[: header["size"]].ljust(header["size"], b"\0"))
+    parity = _blocks(parity)
+    repaired = []
+    for stripe, start in enumerate(range(0, len(blocks), data_blocks)):
+        stripe_blocks = [
+            block if _crc(block) == crc else None
+            for block, crc in zip(
+                blocks[start : start + data_blocks],
+                header["crcs"][start : start + data_blocks],
+            )
+        ]
+        first = stripe * parity_blocks
+        crcs = header["parity_crcs"]
+        stripe_parity = [
+            parity[index]
+            if index < len(parity) and _crc(parity[index]) == crcs[index]
+            else None
+            for index in range(first, first + parity_blocks)
+        ]
+        try:
+            repaired.extend(decode_stripe(stripe_blocks, stripe_parity))
+        except ValueError:
+            return Status.UNREPAIRABLE
+    data = b"".join(repaired)[: header["size"]]
+    if hashlib.md5(data).hexdigest() != header["md5"]:
+        return Status.UNREPAIRABLE
+    temp_path = path.with_name(path.name + ".repaired")
+    with temp_path.open("wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return Status.REPAIRED
@@ -0,0 +1,116 @@
+"""Overlapping the reads, the computations and the writes of a copy.
+
+A reader thread fills buffers from the source, the computations (hashing,
+progress) run on each filled buffer in the calling thread and a writer thread
+writes them to the destination before handing them back to the reader. The
+stages only exchange a fixed pool of reusable buffers, so memory use is bounded
+and, as the file operations and hashlib release the GIL, reading one disk,
+hashing and writing another disk all happen at the same time. A copy then goes
+about as fast as the slower of the two disks.
+"""
+
+import mmap
+import queue
+import threading
+import typing
+
+from ltarchiver import directio
+
+block_size = 1024 * 1024  # bytes
+depth = 4  # buffers in flight
+
+
+class _Stopped(Exception):
+    pass
+
+
+def run(
+    reader: directio.Reader,
+    write: typing.Optional[typing.Callable[[memoryview], None]] = None,
+    compute: typing.Sequence[typing.Callable[[memoryview], None]] = (),
+    size: int = block_size,
+) -> int:
+    """Pass every block of reader to the compute functions and then to write.
+
+    write runs in its own thread, one block at a time and in order. Returns how
+    many bytes were read.
+    """
+    # mmap buffers are page aligned, as O_DIRECT requires.
+    free: queue.Queue = queue.Queue()
+    for _ in range(depth):
+        free.put(mmap.mmap(-1, size))
+    filled: queue.Queue = queue.Queue()
+    to_write: queue.Queue = queue.Queue()
+    failed = threading.Event()
+    errors: typing.List[BaseException] = []
+
+    def take(source: queue.Queue):
+        while True:
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                if failed.is_set():
+                    raise _Stopped()
+
+    def stage(loop: typing.Callable[[], None]):
+        def target():
+            try:
+                loop()
+            except _Stopped:
+                pass
+            except BaseException as err:
+                errors.append(err)
+                failed.set()
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        return thread
+
+    def read_loop():
+        while True:
+            buffer = take(free)
+            count = reader.readinto(buffer)
+            if count <= 0:
+                filled.put(None)
+                return
+            filled.put((buffer, count))
+
+    def write_loop():
+        while True:
+            item = take(to_write)
+            if item is None:
+                return
+            buffer, count = item
+            write(memoryview(buffer)[:count])
+            free.put(buffer)
+
+    threads = [stage(read_loop)]
+    if write is not None:
+        threads.append(stage(write_loop))
+    total = 0
+    try:
+        while True:
+            item = take(filled)
+            if item is None:
+                break
+            buffer, count = item
+            block = memoryview(buffer)[:count]
+            for function in compute:
+                function(block)
+            total += count
+            if write is not None:
+                to_write.put(item)
+            else:
+                free.put(buffer)
+        to_write.put(None)
+    except _Stopped:
+        pass
+    except BaseException:
+        failed.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return total
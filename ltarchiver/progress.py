@@ -0,0 +1,249 @@
+"""Progress of long operations.
+
+Read loops report the bytes they processed and the external encoder and decoder
+are followed through the size of the files they write. Nothing is shown for
+operations that end within the first seconds; after that a line with the bytes
+done, the current rate and the ETA is written to stderr. On a terminal the line
+is redrawn in place, otherwise a new line is written at most every log_interval
+seconds so logs stay readable. The line is also redrawn while nothing is
+reported, so when a read or the files of an external program stop growing it
+says for how long, which tells a slow disk from a hung one. A single thread
+redraws every operation of at least min_total bytes, smaller ones end before
+anything would be shown.
+
+Programs using ltarchiver as a library can set sink to receive Events instead,
+nothing is written to stderr then.
+"""
+
+import contextlib
+import contextvars
+import dataclasses
+import pathlib
+import sys
+import threading
+import time
+import typing
+
+from ltarchiver import instrument
+
+enabled = True
+delay = 2.0  # seconds before the first line is shown
+tty_interval = 0.5  # seconds
+log_interval = 30.0  # seconds
+stall_after = 10.0  # seconds
+min_total = 16 * 1024**2  # bytes, smaller operations are only redrawn on updates
+
+
+@dataclasses.dataclass
+class Event:
+    label: str
+    done: int  # bytes
+    total: int  # bytes, 0 when unknown
+    rate: float  # bytes per second
+    eta: typing.Optional[float]  # seconds, None when unknown
+    finished: bool = False
+
+
+sink: contextvars.ContextVar[
+    typing.Optional[typing.Callable[[Event], None]]
+] = contextvars.ContextVar("sink", default=None)
+
+
+def format_bytes(count: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(count) < 1024:
+            return f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} TiB"
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+
+class _Redrawn:
+    """The operations in progress, redrawn by one thread started on first use."""
+
+    def __init__(self):
+        self.progresses: typing.Set["Progress"] = set()
+        self.changed = threading.Condition()
+        self.thread: typing.Optional[threading.Thread] = None
+
+    def add(self, progress: "Progress"):
+        with self.changed:
+            self.progresses.add(progress)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.changed.notify()
+
+    def discard(self, progress: "Progress"):
+        with self.changed:
+            self.progresses.discard(progress)
+
+    def run(self):
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.progresses)
+                progresses = list(self.progresses)
+            now = time.monotonic()
+            for progress in progresses:
+                progress.tick(now)
+            with self.changed:
+                # woken up early by a new operation
+                self.changed.wait(tty_interval)
+
+
+_redrawn = _Redrawn()
+
+
+class Progress:
+    def __init__(
+        self, label: str, total: int, stream: typing.Optional[typing.TextIO] = None
+    ):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        self.start = time.monotonic()
+        self.last_change = self.start
+        self.last_render: typing.Optional[float] = None
+        self.rendered_done = 0
+        self.lock = threading.Lock()
+        # taken now, updates can come from threads that don't share the context
+        self.sink = sink.get()
+        self.stopped = False
+
+    def start_timer(self):
+        """Redraw the progress every tty_interval until it finishes."""
+        if (self.sink is None and not enabled) or 0 < self.total < min_total:
+            return
+        _redrawn.add(self)
+
+    def tick(self, now: float):
+        with self.lock:
+            if not self.stopped and self.should_render(now):
+                self.render(now)
+
+    def advance(self, count: int):
+        """count more bytes were processed."""
+        self.update(self.done + count)
+
+    def update(self, done: int):
+        """done bytes were processed so far."""
+        now = time.monotonic()
+        with self.lock:
+            if done != self.done:
+                self.done = done
+                self.last_change = now
+            if self.should_render(now):
+                self.render(now)
+
+    def should_render(self, now: float) -> bool:
+        if self.sink is not None:
+            return self.last_render is None or now - self.last_render >= tty_interval
+        if not enabled or now - self.start < delay:
+            return False
+        if self.last_render is None:
+            return True
+        interval = tty_interval if self.tty else log_interval
+        return now - self.last_render >= interval
+
+    def rate(self, now: float) -> float:
+        """Bytes per second since the last time the progress was shown."""
+        if self.last_render is None:
+            elapsed = now - self.start
+            return self.done / elapsed if elapsed else 0.0
+        since = now - self.last_render
+        return (self.done - self.rendered_done) / since if since else 0.0
+
+    def eta(self, now: float) -> typing.Optional[float]:
+        if not (self.total and self.done):
+            return None
+        return max((self.total - self.done) * (now - self.start) / self.done, 0)
+
+    def line(self, now: float) -> str:
+        rate = self.rate(now)
+        text = f"{self.label}: {format_bytes(self.done)}"
+        if self.total:
+            percent = 100 * self.done / self.total
+            text += f" of {format_bytes(self.total)} ({percent:.0f}%)"
+        text += f" {rate / 1024**2:.1f} MB/s"
+        if now - self.last_change >= stall_after:
+            text += f", no progress for {format_duration(now - self.last_change)}"
+        elif self.total and self.done:
+            text += f", ETA {format_duration(self.eta(now))}"
+        return text
+
+    def render(self, now: float):
+        if self.sink is not None:
+            self.sink(
+                Event(self.label, self.done, self.total, self.rate(now), self.eta(now))
+            )
+        elif self.tty:
+            self.stream.write(f"\r\033[K{self.line(now)}")
+        else:
+            self.stream.write(self.line(now) + "\n")
+        self.stream.flush()
+        self.last_render = now
+        self.rendered_done = self.done
+
+    def finish(self):
+        """Show the final state if anything was shown at all."""
+        _redrawn.discard(self)
+        with self.lock:
+            self.stopped = True
+            now = time.monotonic()
+            elapsed = now - self.start
+            rate = self.done / elapsed if elapsed else 0.0
+            if self.sink is not None:
+                self.sink(Event(self.label, self.done, self.total, rate, 0.0, True))
+                return
+            if self.last_render is None or not enabled:
+                return
+            text = (
+                f"{self.label}: {format_bytes(self.done)} in {format_duration(elapsed)}"
+                f" {rate / 1024**2:.1f} MB/s"
+            )
+            if self.tty:
+                self.stream.write(f"\r\033[K{text}\n")
+            else:
+                self.stream.write(text + "\n")
+            self.stream.flush()
+
+    def __enter__(self) -> "Progress":
+        self.start_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.finish()
+        return False
+
+
+@contextlib.contextmanager
+def watch_files(
+    label: str,
+    paths: typing.Sequence[pathlib.Path],
+    total: int,
+    poll_interval: float = 1.0,
+) -> typing.Iterator[Progress]:
+    """Follow an external program through the combined size of the files it writes."""
+    progress = Progress(label, total)
+    stop = threading.Event()
+
+    def poll():
+        while not stop.wait(poll_interval):
+            progress.update(sum(instrument.file_size(path) for path in paths))
+
+    thread = threading.Thread(target=poll, daemon=True)
+    thread.start()
+    try:
+        yield progress
+    finally:
+        stop.set()
+        thread.join()
+        progress.update(sum(instrument.file_size(path) for path in paths))
+        progress.finish()
@@ -1,9 +1,28 @@
+"""Refresh command
+
+Checks every file archived on a device, recovers the damaged ones from their ECC
+and rewrites all of them so the device doesn't lose them to bit rot.
+
+Usage:
+  ltarchiver-refresh [options] <device_path>
+
+Options:
+  --max-rate=<MB/s>  Read at most this many megabytes per second.
+  --max-iops=<n>     Do at most this many reads per second.
+  --idle             Only use the disk when nothing else does (idle I/O
+                     scheduling class).
+  --direct-io        Read the files without going through the page cache.
+  --metrics=<file>   Record how long each phase took to file, as JSON lines or
+                     as a Prometheus textfile when file ends in .prom.
+  --profile=<file>   Profile the run with cProfile and save the stats to file.
+"""
+
 import datetime
 import pathlib
-import subprocess
-import sys
 
-from ltarchiver import common
+from docopt import docopt
+
+from ltarchiver import common, directio, governor, instrument, progress, transaction
 
 
 def refresh_record(record: common.Record, device_root: pathlib.Path):
@@ -11,42 +30,93 @@ def refresh_record(record: common.Record, device_root: pathlib.Path):
     original_ecc_path = record.ecc_file_path(device_root)
     recovery_file_path = original_file_path.with_suffix(".rec")
     recovery_ecc_path = original_ecc_path.with_suffix(".rec")
-    validation = record.get_validation()
-    if (
-        validation == common.Validation.DOESNT_EXIST
-        or validation == common.Validation.ECC_DOESNT_EXIST
-    ):
-        raise common.LTAError(f"{validation}. Skipping this file.")
-    elif validation != common.Validation.VALID:
-        print(f"{validation}. Attempting to recover.")
-        subprocess.check_call(
-            [
-                "c-ltarchiver/out/ltarchiver_restore",
-                str(original_file_path),
-                str(recovery_file_path),
-                str(original_ecc_path),
-                str(recovery_ecc_path),
-            ]
+    if not original_file_path.exists():
+        raise common.LTAError(f"{common.Validation.DOESNT_EXIST}. Skipping this file.")
+    if not original_ecc_path.exists():
+        raise common.LTAError(
+            f"{common.Validation.ECC_DOESNT_EXIST}. Skipping this file."
         )
-        print("Checking the results")
-        if common.get_file_checksum(recovery_file_path) != record.checksum:
-            raise common.LTAError(
-                "Checksum of the recovered file doesn't match the records. Sorry!"
-            )
-        if common.get_file_checksum(recovery_ecc_path) != record.ecc_checksum:
-            raise common.LTAError(
-                "Checksum of the recovered ecc doesn't match the records. Sorry!"
-            )
-    else:
-        print(f"No errors found with {record.file_name}. Copying to new location.")
-        subprocess.check_call(["cp", original_file_path, recovery_file_path])
-        subprocess.check_call(["cp", original_ecc_path, recovery_ecc_path])
-    print("Success!\nMoving the created files to the original location.")
-    subprocess.check_call(["mv", recovery_file_path, original_file_path])
-    subprocess.check_call(["mv", recovery_ecc_path, original_ecc_path])
+    with transaction.begin(
+        "refresh",
+        file=str(original_file_path),
+        ecc_file=str(original_ecc_path),
+        recovery_file=str(recovery_file_path),
+        recovery_ecc_file=str(recovery_ecc_path),
+    ) as tx:
+        write_recovery_files(
+            record,
+            original_file_path,
+            original_ecc_path,
+            recovery_file_path,
+            recovery_ecc_path,
+        )
+        with instrument.span("fsync"):
+            common.fsync_file(recovery_file_path)
+            common.fsync_file(recovery_ecc_path)
+        tx.data_synced()
+        print("Success!\nMoving the created files to the original location.")
+        transaction.roll_forward_refresh(tx.payload)
+        tx.commit()
     print(f"Finished processing {record.file_name}.")
 
 
+def write_recovery_files(
+    record: common.Record,
+    original_file_path: pathlib.Path,
+    original_ecc_path: pathlib.Path,
+    recovery_file_path: pathlib.Path,
+    recovery_ecc_path: pathlib.Path,
+):
+    """Write the new copies of the file and of its ECC.
+
+    The checksums are computed while copying so a healthy file is read only once.
+    The decoder reads them again only when something turns out to be damaged.
+    """
+    size = instrument.file_size(original_file_path) + instrument.file_size(
+        original_ecc_path
+    )
+    with instrument.span("copy", size):
+        file_checksum = common.copy_with_checksum(
+            original_file_path, recovery_file_path
+        )
+        ecc_checksum = common.copy_with_checksum(original_ecc_path, recovery_ecc_path)
+    if file_checksum != record.checksum:
+        validation = common.Validation.CORRUPTED
+    elif ecc_checksum != record.ecc_checksum:
+        validation = common.Validation.ECC_CORRUPTED
+    else:
+        print(f"No errors found with {record.file_name}.")
+        return
+    print(f"{validation}. Attempting to recover.")
+    with instrument.span(
+        "ecc-decode", instrument.file_size(original_file_path)
+    ), progress.watch_files(
+        f"Recovering {record.file_name}",
+        [recovery_file_path],
+        instrument.file_size(original_file_path),
+    ):
+        common.decode_ecc(
+            original_file_path,
+            recovery_file_path,
+            original_ecc_path,
+            recovery_ecc_path,
+            record.holes,
+        )
+    print("Checking the results")
+    with instrument.span("hash", instrument.file_size(recovery_file_path)):
+        file_checksum = common.get_file_checksum(recovery_file_path)
+    if file_checksum != record.checksum:
+        raise common.LTAError(
+            "Checksum of the recovered file doesn't match the records. Sorry!"
+        )
+    with instrument.span("ecc-hash", instrument.file_size(recovery_ecc_path)):
+        ecc_checksum = common.get_file_checksum(recovery_ecc_path)
+    if ecc_checksum != record.ecc_checksum:
+        raise common.LTAError(
+            "Checksum of the recovered ecc doesn't match the records. Sorry!"
+        )
+
+
 def refresh_device(device_uuid: str, device_root: pathlib.Path):
     print(f"Attempting to refresh the device {device_uuid}.")
     device_metadata_dir = device_root / common.METADATA_DIR_NAME
@@ -57,29 +127,48 @@ def refresh_device(device_uuid: str, device_root: pathlib.Path):
     home_recordbook = common.RecordBook(
         common.recordbook_path, common.recordbook_checksum_file_path
     )
-    common.validate_and_recover_recordbooks(home_recordbook, device_recordbook)
-    home_recordbook.merge(device_recordbook)
+    with instrument.span("sync"):
+        common.validate_and_recover_recordbooks(home_recordbook, device_recordbook)
+        home_recordbook.merge(device_recordbook)
     for record in home_recordbook.get_records_by_uuid(device_uuid):
         try:
             refresh_record(record, device_root)
             home_recordbook.update_record(record)
         except common.LTAError as err:
             print(err.args[0])
-    device_recordbook.records = home_recordbook.records
-    home_recordbook.write()
-    device_recordbook.write()
+    with instrument.span("recordbook-commit"):
+        home_recordbook.mark_synced_with(device_recordbook, device_uuid)
+        home_recordbook.write()
+        device_recordbook.write()
 
 
 def run():
-    if sys.argv != 2:
-        common.error(f"usage: {sys.argv[0]} <path_to_to_device_to_refresh>")
+    arguments = docopt(__doc__)
+    directio.enabled = arguments["--direct-io"]
+    max_rate = float(arguments["--max-rate"] or 0)
+    max_iops = float(arguments["--max-iops"] or 0)
+    if max_rate or max_iops or arguments["--idle"]:
+        governor.configure(max_rate, max_iops, arguments["--idle"])
+    with instrument.session(
+        "refresh-device", arguments["--metrics"], arguments["--profile"]
+    ):
+        run_command(pathlib.Path(arguments["<device_path>"]))
+
+
+def run_command(device_path: pathlib.Path):
+    transaction.recover()
+    try:
+        refresh_path(device_path)
+    except common.LTAError as err:
+        common.error(err.args[0])
+
+
+def refresh_path(device_path: pathlib.Path):
+    """Refresh the device device_path is on."""
+    if not device_path.exists():
+        raise common.LTAError(f"{device_path} doesn't exist!")
+    uuid, root = common.get_device_uuid_and_root_from_path(device_path)
+    if common.DEBUG:
+        refresh_device(uuid, device_path)
     else:
-        device_path = pathlib.Path(sys.argv[1])
-        if device_path.exists():
-            uuid, root = common.get_device_uuid_and_root_from_path(device_path)
-            if common.DEBUG:
-                refresh_device(uuid, device_path)
-            else:
-                refresh_device(uuid, root)
-        else:
-            common.error(f"{device_path} doesn't exist!")
+        refresh_device(uuid, root)
@@ -0,0 +1,159 @@
+"""Files with holes.
+
+Disk and VM images are mostly holes, ranges that were never written and that
+read as zeros. They are found with SEEK_HOLE and SEEK_DATA, kept in the record
+of the file and left unwritten when the file is copied, so the copies take as
+little space as the original. The ECC of a file with holes only covers its data:
+the encoder and the decoder are given the data ranges packed one after the
+other, through a pipe, so the zeros are neither read nor encoded.
+"""
+
+import bisect
+import errno
+import os
+import pathlib
+import typing
+
+min_hole_size = 64 * 1024  # bytes, smaller holes are stored as zeros
+block_size = 1024 * 1024  # bytes
+
+Holes = typing.Tuple[typing.Tuple[int, int], ...]  # (offset, length) of each hole
+
+
+def find_holes(path: pathlib.Path) -> Holes:
+    """The holes of path, none when the file system can't tell."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        holes = []
+        offset = 0
+        while offset < size:
+            try:
+                hole = os.lseek(fd, offset, os.SEEK_HOLE)
+            except OSError:
+                return ()
+            if hole >= size:
+                break
+            try:
+                data = os.lseek(fd, hole, os.SEEK_DATA)
+            except OSError as err:
+                if err.errno != errno.ENXIO:
+                    return ()
+                data = size  # the file ends with a hole
+            if data - hole >= min_hole_size:
+                holes.append((hole, data - hole))
+            offset = data
+        return tuple(holes)
+    finally:
+        os.close(fd)
+
+
+def data_ranges(size: int, holes: Holes) -> typing.List[typing.Tuple[int, int]]:
+    """(offset, length) of everything that isn't a hole."""
+    ranges = []
+    offset = 0
+    for start, length in holes:
+        if start > offset:
+            ranges.append((offset, start - offset))
+        offset = start + length
+    if offset < size:
+        ranges.append((offset, size - offset))
+    return ranges
+
+
+def data_size(size: int, holes: Holes) -> int:
+    """How many bytes of a file of size bytes aren't holes."""
+    return sum(length for _, length in data_ranges(size, holes))
+
+
+def format_holes(holes: Holes) -> str:
+    return ",".join(f"{start}+{length}" for start, length in holes)
+
+
+def parse_holes(text: str) -> Holes:
+    return tuple(
+        tuple(int(number) for number in hole.split("+"))
+        for hole in text.split(",")
+        if hole
+    )
+
+
+class Writer:
+    """Write a file from start to end, skipping over its holes.
+
+    When packed the data is written one range after the other, as pack does.
+    """
+
+    def __init__(
+        self, f: typing.BinaryIO, holes: Holes, offset: int = 0, packed: bool = False
+    ):
+        self.f = f
+        self.holes = holes
+        self.ends = [start + length for start, length in holes]
+        self.offset = offset
+        self.packed = packed
+
+    def write(self, block: memoryview):
+        start = self.offset
+        end = start + len(block)
+        position = start
+        i = bisect.bisect_right(self.ends, position)
+        while position < end:
+            if i < len(self.holes) and self.holes[i][0] <= position:
+                position = min(end, self.ends[i])
+                i += 1
+                continue
+            data_end = min(end, self.holes[i][0]) if i < len(self.holes) else end
+            if not self.packed:
+                self.f.seek(position)
+            self.f.write(block[position - start : data_end - start])
+            position = data_end
+        self.offset = end
+
+    def finish(self):
+        """Set the size of the file, which ends with a hole when nothing was written."""
+        if not self.packed:
+            self.f.truncate(self.offset)
+
+
+def pack(source: pathlib.Path, holes: Holes, destination: pathlib.Path):
+    """Write the data of source to destination without its holes."""
+    with destination.open("wb") as out:
+        write_packed(source, holes, out)
+
+
+def write_packed(source: pathlib.Path, holes: Holes, out: typing.BinaryIO):
+    """Write the data of source to out without its holes."""
+    buffer = bytearray(block_size)
+    with source.open("rb", buffering=0) as f:
+        for offset, length in data_ranges(os.fstat(f.fileno()).st_size, holes):
+            f.seek(offset)
+            while length:
+                count = f.readinto(memoryview(buffer)[: min(length, block_size)])
+                if not count:
+                    raise EOFError(f"{source} is shorter than expected")
+                out.write(memoryview(buffer)[:count])
+                length -= count
+
+
+def unpack(packed: pathlib.Path, destination: pathlib.Path, holes: Holes, size: int):
+    """Undo pack, writing a file of size bytes with holes to destination."""
+    with packed.open("rb", buffering=0) as f:
+        read_packed(f, destination, holes, size)
+
+
+def read_packed(
+    f: typing.BinaryIO, destination: pathlib.Path, holes: Holes, size: int
+):
+    """Undo write_packed, writing what is read from f to destination."""
+    buffer = bytearray(block_size)
+    with destination.open("wb") as out:
+        for offset, length in data_ranges(size, holes):
+            out.seek(offset)
+            while length:
+                count = f.readinto(memoryview(buffer)[: min(length, block_size)])
+                if not count:
+                    raise EOFError(f"{destination} is shorter than expected")
+                out.write(memoryview(buffer)[:count])
+                length -= count
+        out.truncate(size)
@@ -1,120 +1,479 @@
+import dataclasses
+import hashlib
 import os
 import shlex
 import shutil
 import subprocess
+import sys
 import pathlib
 import datetime
 import optparse
+import threading
+import typing
 
-import yesno
 
-from ltarchiver import common
+from ltarchiver import (
+    common,
+    directio,
+    governor,
+    instrument,
+    parity,
+    pipeline,
+    progress,
+    sparse,
+    transaction,
+)
 
 
-def store(source: pathlib.Path, destination: pathlib.Path, non_interactive: bool):
+# Held while the home recordbook is read and written so stores can run in threads.
+recordbook_lock = threading.RLock()
+
+
+def store(
+    source: pathlib.Path,
+    destination: pathlib.Path,
+    non_interactive: bool,
+    checksum: typing.Optional[str] = None,
+    keep_source: bool = False,
+    codec: str = "",
+    as_container: bool = False,
+    stripe: str = "",
+):
+    """Store source on destination.
+
+    checksum is the md5 of source when the caller already knows it,
+    keep_source prevents the source from being removed afterwards and codec
+    compresses the file, see ltarchiver.compression. A directory is tarred, or
+    put in a container when as_container is set, see ltarchiver.container.
+    stripe goes in the record of a shard, see ltarchiver.erasure.
+    """
     common.recordbook_dir.mkdir(parents=True, exist_ok=True)
     if source == destination:
         raise common.LTAError("Source and destination are the same.")
+    if codec and as_container:
+        # the members of a compressed container couldn't be read on their own
+        raise common.LTAError("A container can't be compressed.")
     dest_uuid, dest_root = common.get_device_uuid_and_root_from_path(destination)
     if not common.DEBUG:
         destination = dest_root
     metadata_dir = destination / common.METADATA_DIR_NAME
     common.file_ok(destination, False)
-    sync_recordbooks(metadata_dir)
+    with recordbook_lock, instrument.span("sync"):
+        sync_recordbooks(metadata_dir, dest_uuid)
     try:
         common.file_ok(source)
         original_source = source
     except common.LTAError as err:
         if err.args[1] == common.FileValidation.IS_DIRECTORY:
             print(f"{source} is a directory.")
-            if non_interactive or yesno.input_until_bool(
-                "Do you want it turned into a tar file before archiving?"
+            kind = "container" if as_container else "tar file"
+            if non_interactive or common.ask_yes_no(
+                f"Do you want it turned into a {kind} before archiving?"
             ):
                 original_source = source
-                source = tar_directory(source)
+                source = pack_directory(source, as_container)
             else:
                 raise common.LTAError("Cannot archive an uncompressed directory.")
         else:
             raise
 
     source_file_name = source.name
+    checkpoint_path = StoreCheckpoint.path_for(dest_uuid, source_file_name)
+    # compressed stores aren't resumable, the compressor can't pick up midway
+    checkpoint = None if codec else StoreCheckpoint.read(checkpoint_path)
+    if checkpoint is not None and not checkpoint.matches(source):
+        print(f"{source} changed since the last attempt to store it. Starting over.")
+        common.remove_file(checkpoint.partial_file)
+        common.remove_file(checkpoint_path)
+        checkpoint = None
     print(f"Backup of: {source}\nTo: ", destination)
     if not non_interactive:
-        input("Press ENTER to continue. Press Ctrl+C to abort.")
+        common.confirm("Press ENTER to continue. Press Ctrl+C to abort.")
     if not destination.is_dir():
-        print(destination, "is not a directory! Aborting.")
-        exit(1)
-    try:
-        print("Calculating checksum", datetime.datetime.now())
-        md5 = common.get_file_checksum(source)
-        print("Checksum calculated", datetime.datetime.now())
-    except subprocess.SubprocessError as err:
-        raise common.LTAError(f"Error calculating the md5 of source: {err}") from err
+        raise common.LTAError(f"{destination} is not a directory! Aborting.")
+    if checkpoint is not None:
+        print(f"Resuming the interrupted store of {source}")
+        md5 = checkpoint.checksum
+    elif checksum is not None:
+        md5 = checksum
+    else:
+        try:
+            print("Calculating checksum")
+            with instrument.span("hash", instrument.file_size(source)):
+                md5 = common.get_file_checksum(source)
+        except OSError as err:
+            raise common.LTAError(
+                f"Error calculating the md5 of source: {err}"
+            ) from err
     destination_file_path = destination / source_file_name
     try:
-        file_not_exists_in_recordbook(md5, source_file_name, destination_file_path)
+        with recordbook_lock:
+            file_not_exists_in_recordbook(
+                md5, source_file_name, destination_file_path, dest_uuid
+            )
     except FileNotFoundError:
         pass
         # Triggered when the recordbook is not found. This usually means that it's the
         # first time that ltarchiver is running if file were to exist on destination's
         # recordbook it would have been already copied during sync
-    if destination_file_path.exists():
+    if destination_file_path.exists() and not (
+        checkpoint is not None and checkpoint.encoded
+    ):
         raise common.LTAError(
             f"{source_file_name} is not in the recordbook but {destination_file_path} already exists. Aborting!"
         )
-    ecc_dir = metadata_dir / common.ecc_dir_name
-    ecc_dir.mkdir(parents=True, exist_ok=True)
-    ecc_file_path = ecc_dir / md5
-
-    print("Encoding and storing file", datetime.datetime.now())
-    subprocess.check_call(
-        [
-            "c-ltarchiver/out/ltarchiver_store",
-            str(source),
-            str(destination_file_path),
-            str(ecc_file_path),
-        ]
-    )
-    os.sync()
-    record = common.Record(
-        timestamp=datetime.datetime.now(),
-        file_name=source_file_name,
-        source=source,
-        destination=dest_uuid,
-        checksum=md5,
-        ecc_checksum=common.get_file_checksum(ecc_file_path),
+    # an interrupted store may have left its ECC in the legacy layout
+    ecc_file_path = common.find_ecc_file(metadata_dir, md5)
+    common.make_ecc_shard(ecc_file_path)
+    holes = () if codec else sparse.find_holes(source)
+    if codec:
+        # renamed after the checksum of the compressed file once it's known
+        ecc_file_path = ecc_file_path.with_name(f"{md5}.{codec}.part")
+    elif (
+        checkpoint is None
+        and source.stat().st_size >= common.resumable_store_min_size
+    ):
+        checkpoint = StoreCheckpoint.start(source, md5, destination_file_path)
+    partial_file_path = destination_file_path.with_name(
+        destination_file_path.name + ".part"
     )
-    record.write(common.RECORD_PATH)
-    try:
-        old_text = common.recordbook_path.read_text() + "\n"
-    except FileNotFoundError:
-        old_text = ""
-    recordbook = common.recordbook_path.open("wt")
-    recordbook.write(old_text + common.RECORD_PATH.read_text())
-    recordbook.close()
-    shutil.copy(common.recordbook_path, metadata_dir)
-    recordbook_checksum_file = common.recordbook_checksum_file_path.open("wt")
-    out = subprocess.check_output(
-        shlex.split(f"md5sum {common.recordbook_path}"), encoding="utf-8"
-    )
-    recordbook_checksum_file.write(out)
-    recordbook_checksum_file.close()
-    pathlib.Path(metadata_dir / "checksum.txt").write_text(
-        out.split(" ", 1)[0] + " " + str(metadata_dir / "recordbook.txt")
-    )
-    os.sync()
+    compressed_as = ""
+    with transaction.begin(
+        "store",
+        partial_file=str(partial_file_path),
+        destination_file=str(destination_file_path),
+        ecc_file=str(ecc_file_path),
+        ecc_existed=ecc_file_path.exists(),
+        metadata_dir=str(metadata_dir),
+        checkpoint=str(checkpoint_path),
+        resumable=checkpoint is not None,
+    ) as tx:
+        if checkpoint is not None:
+            store_resumably(checkpoint, checkpoint_path, ecc_file_path, holes)
+        elif codec:
+            md5, compressed_as = store_compressed(
+                source, md5, partial_file_path, ecc_file_path, codec
+            )
+        elif holes:
+            print("Storing file with holes")
+            copied = []
+            # the encoder is given the data as it's copied, so source is read once
+            common.encode_stream(
+                lambda packed: copied.append(
+                    common.copy_with_checksum(
+                        source,
+                        partial_file_path,
+                        tee=sparse.Writer(packed, holes, packed=True).write,
+                    )
+                ),
+                ecc_file_path,
+                sparse.data_size(instrument.file_size(source), holes),
+                f"Storing {source_file_name}",
+            )
+            if copied != [md5]:
+                raise common.LTAError(f"{source} changed while it was being stored.")
+            with instrument.span("fsync"):
+                common.fsync_file(partial_file_path)
+        else:
+            print("Encoding and storing file")
+            # The encoder copies the file while it encodes it.
+            with instrument.span(
+                "ecc-encode", instrument.file_size(source)
+            ), progress.watch_files(
+                f"Storing {source_file_name}",
+                [partial_file_path],
+                instrument.file_size(source),
+            ):
+                subprocess.check_call(
+                    [
+                        "c-ltarchiver/out/ltarchiver_store",
+                        str(source),
+                        str(partial_file_path),
+                        str(ecc_file_path),
+                    ]
+                )
+            with instrument.span("fsync"):
+                common.fsync_file(partial_file_path)
+        with instrument.span("fsync"):
+            common.fsync_file(ecc_file_path)
+        with instrument.span("ecc-hash", instrument.file_size(ecc_file_path)):
+            ecc_checksum = common.get_file_checksum(ecc_file_path)
+        record = common.Record(
+            timestamp=datetime.datetime.now(),
+            file_name=source_file_name,
+            source=source,
+            destination=dest_uuid,
+            checksum=md5,
+            ecc_checksum=ecc_checksum,
+            holes=holes,
+            compression=compressed_as,
+            stripe=stripe,
+        )
+        final_ecc_file_path = common.find_ecc_file(metadata_dir, md5)
+        common.make_ecc_shard(final_ecc_file_path)
+        tx.data_synced(
+            record=transaction.record_to_dict(record),
+            ecc_file=str(final_ecc_file_path),
+            ecc_partial_file=str(ecc_file_path),
+        )
+        if partial_file_path.exists():
+            os.replace(partial_file_path, destination_file_path)
+            common.fsync_directory(destination)
+        if ecc_file_path != final_ecc_file_path:
+            os.replace(ecc_file_path, final_ecc_file_path)
+            common.fsync_directory(final_ecc_file_path.parent)
+        with recordbook_lock:
+            common.commit_record(record, metadata_dir)
+            from ltarchiver import packing
+
+            if packing.is_pack(source):
+                # what the pack holds is only known from the index
+                packing.copy_index(metadata_dir)
+        common.remove_file(checkpoint_path)
+        tx.commit()
     if original_source != source:
         # the original and the new source are different when a directory was tarred
         # so the source (the tarred file) can (and should!) be safely removed
         common.remove_file(source)
         source = original_source
-    if non_interactive or yesno.input_until_bool(
-        f"Do you want to remove the source?\n{source}"
+    if not keep_source and (
+        non_interactive
+        or common.ask_yes_no(f"Do you want to remove the source?\n{source}")
     ):
         common.remove_file(source)
     print("All done")
 
 
+@dataclasses.dataclass
+class StoreCheckpoint:
+    """How far an interrupted store of a large file got.
+
+    The data is copied to partial_file and every checkpoint_interval bytes the
+    copy is flushed to the disk and the offset reached is saved together with
+    the checksum of the last block written (the tail). Once the copy is complete
+    and its ECC written the checkpoint is marked as encoded.
+    """
+
+    source: pathlib.Path
+    source_size: int
+    source_mtime: int
+    checksum: str
+    partial_file: pathlib.Path
+    offset: int = 0
+    tail_size: int = 0
+    tail_checksum: str = ""
+    encoded: bool = False
+
+    @staticmethod
+    def path_for(device_uuid: str, file_name: str) -> pathlib.Path:
+        return common.RECORD_PATH.with_name(
+            f"{common.RECORD_PATH.stem}.{device_uuid}.{file_name}{common.RECORD_PATH.suffix}"
+        )
+
+    @classmethod
+    def start(
+        cls, source: pathlib.Path, checksum: str, destination_file_path: pathlib.Path
+    ) -> "StoreCheckpoint":
+        stat = source.stat()
+        return cls(
+            source=source,
+            source_size=stat.st_size,
+            source_mtime=stat.st_mtime_ns,
+            checksum=checksum,
+            partial_file=destination_file_path.with_name(
+                destination_file_path.name + ".part"
+            ),
+        )
+
+    @classmethod
+    def read(cls, path: pathlib.Path) -> typing.Optional["StoreCheckpoint"]:
+        try:
+            lines = path.read_text().splitlines()
+        except FileNotFoundError:
+            return None
+        fields = dict(line.split(": ", 1) for line in lines if ": " in line)
+        return cls(
+            source=pathlib.Path(fields["Source"]),
+            source_size=int(fields["Source-Size"]),
+            source_mtime=int(fields["Source-Mtime"]),
+            checksum=fields["Checksum"],
+            partial_file=pathlib.Path(fields["Partial-File"]),
+            offset=int(fields["Offset"]),
+            tail_size=int(fields["Tail-Size"]),
+            tail_checksum=fields["Tail-Checksum"],
+            encoded=fields["Encoded"] == "True",
+        )
+
+    def write(self, path: pathlib.Path):
+        temp_path = path.with_name(path.name + ".tmp")
+        temp_path.write_text(
+            f"Source: {self.source}\n"
+            f"Source-Size: {self.source_size}\n"
+            f"Source-Mtime: {self.source_mtime}\n"
+            f"Checksum: {self.checksum}\n"
+            f"Partial-File: {self.partial_file}\n"
+            f"Offset: {self.offset}\n"
+            f"Tail-Size: {self.tail_size}\n"
+            f"Tail-Checksum: {self.tail_checksum}\n"
+            f"Encoded: {self.encoded}\n"
+        )
+        os.replace(temp_path, path)
+
+    def matches(self, source: pathlib.Path) -> bool:
+        try:
+            stat = source.stat()
+        except FileNotFoundError:
+            return False
+        return (
+            self.source == source
+            and self.source_size == stat.st_size
+            and self.source_mtime == stat.st_mtime_ns
+        )
+
+    def tail_is_intact(self) -> bool:
+        """Whether the last block saved by the checkpoint is still on the disk."""
+        if self.offset == 0:
+            return True
+        try:
+            with self.partial_file.open("rb") as f:
+                f.seek(self.offset - self.tail_size)
+                tail = f.read(self.tail_size)
+        except FileNotFoundError:
+            return False
+        return hashlib.md5(tail).hexdigest() == self.tail_checksum
+
+
+copy_block_size = 1024 * 1024  # bytes
+checkpoint_interval = 256 * 1024 * 1024  # bytes
+
+
+def resumable_copy(
+    checkpoint: StoreCheckpoint,
+    checkpoint_path: pathlib.Path,
+    holes: sparse.Holes = (),
+):
+    """Copy the source of checkpoint to its partial file from where it stopped.
+
+    The source is read and the partial file written at the same time, see
+    ltarchiver.pipeline. The holes are left unwritten.
+    """
+    if not checkpoint.tail_is_intact():
+        print("The partially stored file doesn't match its checkpoint. Starting over.")
+        checkpoint.offset = 0
+    offset = checkpoint.offset
+    synced_offset = offset
+    since_checkpoint = 0
+    mode = "r+b" if offset else "wb"
+    with directio.Reader(checkpoint.source) as source, checkpoint.partial_file.open(
+        mode
+    ) as partial, progress.Progress(
+        f"Copying {checkpoint.source.name}", checkpoint.source_size
+    ) as copying:
+        copying.update(offset)
+        source.seek(offset)
+        partial.seek(offset)
+        partial.truncate()
+        writer = sparse.Writer(partial, holes, offset)
+
+        def write(block: memoryview):
+            nonlocal offset, synced_offset, since_checkpoint
+            writer.write(block)
+            offset += len(block)
+            since_checkpoint += len(block)
+            if since_checkpoint >= checkpoint_interval:
+                writer.finish()  # the tail may be in a hole
+                partial.flush()
+                os.fsync(partial.fileno())
+                governor.synced(partial, synced_offset, offset - synced_offset)
+                synced_offset = offset
+                checkpoint.offset = offset
+                checkpoint.tail_size = len(block)
+                checkpoint.tail_checksum = hashlib.md5(block).hexdigest()
+                checkpoint.write(checkpoint_path)
+                since_checkpoint = 0
+
+        pipeline.run(
+            source,
+            write=write,
+            compute=[lambda block: copying.advance(len(block))],
+            size=copy_block_size,
+        )
+        writer.finish()
+        partial.flush()
+        os.fsync(partial.fileno())
+        governor.synced(partial, synced_offset, offset - synced_offset)
+    checkpoint.offset = offset
+
+
+def store_compressed(
+    source: pathlib.Path,
+    source_md5: str,
+    partial_file_path: pathlib.Path,
+    ecc_file_path: pathlib.Path,
+    codec: str,
+) -> typing.Tuple[str, str]:
+    """Compress source to the partial file and encode it.
+
+    The encoder is given the compressed data as it's written, so the partial
+    file isn't read back. Returns the md5 of the partial file and the
+    Compression line of its record.
+    """
+    from ltarchiver import compression
+
+    print("Compressing and storing file")
+    compressed = []
+    with instrument.span("compress", instrument.file_size(source)):
+        common.encode_stream(
+            lambda out: compressed.append(
+                compression.compress_file(source, partial_file_path, codec, out.write)
+            ),
+            ecc_file_path,
+            0,  # not known until it's compressed
+            f"Storing {source.name}",
+        )
+    ((md5, original_md5),) = compressed
+    if original_md5 != source_md5:
+        raise common.LTAError(f"{source} changed while it was being stored.")
+    with instrument.span("fsync"):
+        common.fsync_file(partial_file_path)
+    return md5, compression.describe(codec, original_md5)
+
+
+def store_resumably(
+    checkpoint: StoreCheckpoint,
+    checkpoint_path: pathlib.Path,
+    ecc_file_path: pathlib.Path,
+    holes: sparse.Holes = (),
+):
+    """Copy and encode the file, skipping what was already done.
+
+    The partial file is made of what each attempt copied, it's hashed once
+    complete and copied again from the start if it doesn't match the source.
+    """
+    if not checkpoint.encoded:
+        for attempt in range(2):
+            if attempt:
+                print("The stored file doesn't match its source. Starting over.")
+                checkpoint.offset = 0
+            print("Storing file")
+            with instrument.span("copy") as copy:
+                start = checkpoint.offset
+                resumable_copy(checkpoint, checkpoint_path, holes)
+                copy.bytes = checkpoint.offset - start
+            with instrument.span("hash", checkpoint.offset):
+                md5 = common.get_file_checksum(checkpoint.partial_file)
+            if md5 == checkpoint.checksum:
+                break
+        else:
+            raise common.LTAError(
+                f"{checkpoint.source} changed while it was being stored."
+            )
+        print("Encoding file")
+        common.encode_ecc(checkpoint.partial_file, ecc_file_path, holes)
+        checkpoint.encoded = True
+        checkpoint.write(checkpoint_path)
+
+
 def get_device_uuid(destination):
     fs = (
         subprocess.check_output(
@@ -130,28 +489,43 @@ def get_device_uuid(destination):
 
 
 def file_not_exists_in_recordbook(
-    md5: str, file_name: str, destination_path: pathlib.Path
+    md5: str,
+    file_name: str,
+    destination_path: pathlib.Path,
+    device_uuid: typing.Optional[str] = None,
 ):
-    """The function fails if the file is in the recordbook and it's not deleted"""
+    """The function fails if the file is in the recordbook and it's not deleted
+
+    When device_uuid is given only the records of that device are considered,
+    so the same file can be stored on several devices. A compressed file is
+    recognized by the md5 it had before it was compressed.
+    """
     if not common.recordbook_path.exists():
         raise FileNotFoundError("The recordbook doesn't exist")
-    record_no = 0
     for record in common.get_records(common.recordbook_path):
-        if record.checksum == md5 and not record.deleted:
+        if device_uuid is not None and record.destination != device_uuid:
+            continue
+        checksums = {record.checksum}
+        if record.compression:
+            from ltarchiver import compression
+
+            checksums.add(compression.parse(record.compression)[1])
+        if md5 in checksums and not record.deleted:
             if destination_path.exists():
                 raise common.LTAError(
                     f"File was already stored in the record book\n{record.source=}\n{record.destination=}"
                 )
             else:
-                common.mark_record_as_deleted(record_no - 1)
+                # The stored file is gone, so is the record.
+                transaction.delete_record(record)
+                continue
         if record.file_name == file_name and not record.deleted:
             raise common.LTAError(
                 f"Another file was already stored with that name{record.source=}\n{record.destination=}\n{record.file_name=}"
             )
-        record_no += 1
 
 
-def sync_recordbooks(bkp_dir: pathlib.Path):
+def sync_recordbooks(bkp_dir: pathlib.Path, device_uuid: str):
     bkp_dir.mkdir(exist_ok=True, parents=True)
     dest_recordbook_path = bkp_dir / common.recordbook_file_name
     dest_recordbook_checksum_path = bkp_dir / "checksum.txt"
@@ -176,8 +550,32 @@ def sync_recordbooks(bkp_dir: pathlib.Path):
     elif not dest_recordbook_path.exists():
         common.check_recordbook_md5(common.recordbook_checksum_file_path)
         shutil.copy(common.recordbook_path, dest_recordbook_path)
+        parity.write(dest_recordbook_path)
     else:
-        if (
+        divergence = common.compare_generations(
+            common.read_recordbook_header(common.recordbook_path),
+            common.read_recordbook_header(dest_recordbook_path),
+            device_uuid,
+        )
+        if divergence == common.Divergence.IN_SYNC:
+            return
+        elif divergence == common.Divergence.HOME_AHEAD:
+            common.replay_recordbook_delta(
+                common.recordbook_path,
+                common.recordbook_checksum_file_path,
+                dest_recordbook_path,
+                dest_recordbook_checksum_path,
+                device_uuid,
+            )
+        elif divergence == common.Divergence.DEVICE_AHEAD:
+            common.replay_recordbook_delta(
+                dest_recordbook_path,
+                dest_recordbook_checksum_path,
+                common.recordbook_path,
+                common.recordbook_checksum_file_path,
+                device_uuid,
+            )
+        elif (
             dest_recordbook_checksum_path.read_text().split()[0]
             != common.recordbook_checksum_file_path.read_text().split()[0]
         ):
@@ -195,31 +593,234 @@ def tar_directory(path: pathlib.Path) -> pathlib.Path:
     return tarred
 
 
+def pack_directory(path: pathlib.Path, as_container: bool) -> pathlib.Path:
+    if as_container:
+        from ltarchiver import container
+
+        return container.pack_directory(path)
+    return tar_directory(path)
+
+
 def get_option_parser():
     parser = optparse.OptionParser(
-        "usage: %prog [options] <source_file>... <destination_directory>"
+        "usage: %prog [options] <source_file>... <destination_directory>\n"
+        "       %prog [options] -d <destination_directory>... <source_file>..."
     )
     parser.add_option(
         "--non-interactive",
         action="store_true",
         help="disable most confirmation dialogs",
     )
+    parser.add_option(
+        "-d",
+        "--destination",
+        action="append",
+        default=[],
+        help="store every source on this destination as well, all destination"
+        " devices are written at the same time; can be repeated",
+    )
+    parser.add_option(
+        "--writers-per-device",
+        type="int",
+        default=1,
+        help="how many files may be written at once to each destination device"
+        " [default: %default]",
+    )
+    parser.add_option(
+        "--compress",
+        metavar="CODEC",
+        default="",
+        help="compress the files with CODEC (lzma) before storing them, by default"
+        " they are stored as they are",
+    )
+    parser.add_option(
+        "--container",
+        action="store_true",
+        help="store directories as containers instead of tar files, so each of"
+        " their files can be restored on its own",
+    )
+    parser.add_option(
+        "--pack-below",
+        type="int",
+        default=0,
+        metavar="BYTES",
+        help="put the files smaller than BYTES together in packs and store the"
+        " packs instead, so they share records and ECC files",
+    )
+    add_governor_options(parser)
+    parser.add_option(
+        "--metrics",
+        metavar="FILE",
+        help="record how long each phase took to FILE, as JSON lines or as a"
+        " Prometheus textfile when FILE ends in .prom",
+    )
+    parser.add_option(
+        "--profile",
+        metavar="FILE",
+        help="profile the run with cProfile and save the stats to FILE",
+    )
     return parser
 
 
+def add_governor_options(parser: optparse.OptionParser):
+    parser.add_option(
+        "--max-rate",
+        type="float",
+        default=0,
+        metavar="MB/S",
+        help="read at most this many megabytes per second",
+    )
+    parser.add_option(
+        "--max-iops",
+        type="float",
+        default=0,
+        help="do at most this many reads per second",
+    )
+    parser.add_option(
+        "--idle",
+        action="store_true",
+        help="only use the disk when nothing else does (idle I/O scheduling class)",
+    )
+
+
 def run():
     parser = get_option_parser()
     (options, args) = parser.parse_args()
+    if options.max_rate or options.max_iops or options.idle:
+        governor.configure(options.max_rate, options.max_iops, options.idle)
+    with instrument.session("store", options.metrics, options.profile):
+        run_command(parser, options, args)
+
+
+def run_command(parser: optparse.OptionParser, options: optparse.Values, args: list):
+    non_interactive = options.non_interactive or common.DEBUG
+    if options.compress:
+        from ltarchiver import compression
+
+        try:
+            compression.check_codec(options.compress)
+        except common.LTAError as err:
+            common.error(err.args[0])
+        if options.container or options.pack_below:
+            common.error("Containers and packs can't be compressed.")
+    if options.destination:
+        if not args:
+            parser.print_help()
+            common.error("No source was provided. Aborting.")
+        sources = [pathlib.Path(source).resolve() for source in args]
+        packed, packs = pack_small_files(sources, options.pack_below)
+        sources = [source for source in sources if source not in packed] + packs
+        transaction.recover()
+        run_concurrently(
+            sources,
+            [pathlib.Path(destination).resolve() for destination in options.destination],
+            non_interactive,
+            options.writers_per_device,
+            options.compress,
+            options.container,
+        )
+        remove_packed(packed, packs, non_interactive)
+        return
     if len(args) < 2:
         parser.print_help()
         common.error("Either the source or the destination was not provided. Aborting.")
     destination = pathlib.Path(args[-1]).resolve()
-    sources = {pathlib.Path(source).resolve() for source in args[:-1]}
-    for source in sources:
+    sources = list(
+        dict.fromkeys(pathlib.Path(source).resolve() for source in args[:-1])
+    )
+    packed, packs = pack_small_files(sources, options.pack_below)
+    sources = [source for source in sources if source not in packed] + packs
+    remaining = sources
+    if non_interactive:
+        # Handing the sources to a running daemon spares all the setup below.
+        from ltarchiver import daemon
+
+        remaining = [
+            source
+            for source in sources
+            if not daemon.run_remotely(
+                "store",
+                source=str(source),
+                destination=str(destination),
+                codec=options.compress,
+                container=options.container,
+            )
+        ]
+    if remaining:
+        transaction.recover()
+    for source in remaining:
         try:
-            store(source, destination, options.non_interactive or common.DEBUG)
+            store(
+                source,
+                destination,
+                non_interactive,
+                codec=options.compress,
+                as_container=options.container,
+                keep_source=source in packs,
+            )
         except common.LTAError as err_:
             common.error(err_.args[0])
+    remove_packed(packed, packs, non_interactive)
+
+
+def pack_small_files(
+    sources: typing.List[pathlib.Path], threshold: int
+) -> typing.Tuple[typing.List[pathlib.Path], typing.List[pathlib.Path]]:
+    """Pack the sources smaller than threshold, return them and the packs."""
+    if not threshold:
+        return [], []
+    from ltarchiver import packing
+
+    small, _ = packing.split(sources, threshold)
+    if not small:
+        return [], []
+    packs = packing.make_packs(small)
+    print(f"Packed {len(small)} small files in {len(packs)} packs")
+    return small, packs
+
+
+def remove_packed(
+    packed: typing.List[pathlib.Path],
+    packs: typing.List[pathlib.Path],
+    non_interactive: bool,
+):
+    """Remove the packs once stored and, if wanted, the files packed in them."""
+    if not packed:
+        return
+    for pack in packs:
+        common.remove_file(pack)
+    if non_interactive or common.ask_yes_no(
+        f"Do you want to remove the {len(packed)} packed sources?"
+    ):
+        for source in packed:
+            common.remove_file(source)
+
+
+def run_concurrently(
+    sources: typing.List[pathlib.Path],
+    destinations: typing.List[pathlib.Path],
+    non_interactive: bool,
+    writers_per_device: int,
+    codec: str = "",
+    as_container: bool = False,
+):
+    print("Backup of:", *sources, sep="\n  ")
+    print("To:", *destinations, sep="\n  ")
+    if not non_interactive:
+        common.confirm("Press ENTER to continue. Press Ctrl+C to abort.")
+    from ltarchiver import jobs  # asyncio is slow to import
+
+    failures = jobs.run_jobs(
+        [jobs.Job(source, destinations) for source in dict.fromkeys(sources)],
+        writers_per_device,
+        remove_sources=non_interactive,
+        codec=codec,
+        as_container=as_container,
+    )
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if failures:
+        exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,354 @@
+"""Write-ahead log of the changes made to archived files and recordbooks.
+
+Every store, refresh and delete first logs its intent, then logs when the data
+it produced is safely on disk and finally logs its commit. A process that starts
+while no other ltarchiver process is running replays the log: transactions whose
+data reached the disk are rolled forward and the others rolled back. Once nothing
+is pending the log is emptied, so recovery only ever looks at the transactions
+that were interrupted. Long running processes, like the daemon, only keep others
+from recovering while one of their transactions is in progress.
+
+Each log line is the transaction id, its phase and a JSON payload.
+"""
+
+import contextlib
+import dataclasses
+import datetime
+import fcntl
+import itertools
+import json
+import os
+import pathlib
+import threading
+import time
+import typing
+
+from ltarchiver import common
+
+log_path = common.recordbook_dir / "transactions.log"
+exclusive_timeout = 600.0  # seconds
+
+INTENT = "intent"
+DATA_SYNCED = "data-synced"
+COMMITTED = "committed"
+ABORTED = "aborted"
+
+
+def record_to_dict(record: common.Record) -> dict:
+    fields = dataclasses.asdict(record)
+    fields["timestamp"] = record.timestamp.isoformat()
+    fields["source"] = str(record.source)
+    return fields
+
+
+def record_from_dict(fields: dict) -> common.Record:
+    fields = dict(fields)
+    fields["timestamp"] = datetime.datetime.fromisoformat(fields["timestamp"])
+    fields["source"] = pathlib.Path(fields["source"])
+    fields["holes"] = tuple(tuple(hole) for hole in fields.get("holes", ()))
+    return common.Record(**fields)
+
+
+def record_is_committed(record: common.Record) -> bool:
+    if not common.recordbook_path.exists():
+        return False
+    return any(
+        other.identity() == record.identity() and other.deleted == record.deleted
+        for other in common.get_records(common.recordbook_path)
+    )
+
+
+def apply_deletion(record: common.Record):
+    """Mark record as deleted on the home recordbook."""
+    header = common.read_recordbook_header(common.recordbook_path)
+    header.generation += 1
+    records = [
+        dataclasses.replace(other, deleted=True, generation=header.generation)
+        if other.identity() == record.identity() and not other.deleted
+        else other
+        for other in common.get_records(common.recordbook_path)
+    ]
+    common.write_records(common.recordbook_path, header, records)
+    common.write_recordbook_checksum(
+        common.recordbook_path, common.recordbook_checksum_file_path
+    )
+    common.fsync_file(common.recordbook_checksum_file_path)
+
+
+def roll_forward_store(payload: dict):
+    partial_file = pathlib.Path(payload["partial_file"])
+    if partial_file.exists():
+        os.replace(partial_file, payload["destination_file"])
+        common.fsync_directory(partial_file.parent)
+    # the ECC of a compressed file is written before its name is known
+    ecc_file = pathlib.Path(payload["ecc_file"])
+    ecc_partial_file = pathlib.Path(payload.get("ecc_partial_file", ecc_file))
+    if ecc_partial_file != ecc_file and ecc_partial_file.exists():
+        os.replace(ecc_partial_file, ecc_file)
+        common.fsync_directory(ecc_file.parent)
+    record = record_from_dict(payload["record"])
+    if not record_is_committed(record):
+        common.commit_record(record, pathlib.Path(payload["metadata_dir"]))
+    common.remove_file(pathlib.Path(payload["checkpoint"]))
+
+
+def roll_back_store(payload: dict):
+    if payload["resumable"]:
+        return  # the checkpoint still knows how to finish the copy
+    common.remove_file(pathlib.Path(payload["partial_file"]))
+    # ECC files are named after the checksum, the same file may be archived already
+    if not payload.get("ecc_existed", False):
+        common.remove_file(pathlib.Path(payload["ecc_file"]))
+
+
+def roll_forward_refresh(payload: dict):
+    for recovered, original in (
+        (payload["recovery_file"], payload["file"]),
+        (payload["recovery_ecc_file"], payload["ecc_file"]),
+    ):
+        if pathlib.Path(recovered).exists():
+            os.replace(recovered, original)
+            common.fsync_directory(pathlib.Path(original).parent)
+
+
+def roll_back_refresh(payload: dict):
+    common.remove_file(pathlib.Path(payload["recovery_file"]))
+    common.remove_file(pathlib.Path(payload["recovery_ecc_file"]))
+
+
+def roll_forward_delete(payload: dict):
+    record = record_from_dict(payload["record"])
+    if not record_is_committed(dataclasses.replace(record, deleted=True)):
+        apply_deletion(record)
+
+
+def roll_back_delete(payload: dict):
+    pass  # nothing is written before the intent is logged
+
+
+@dataclasses.dataclass
+class Operation:
+    roll_forward: typing.Callable[[dict], None]
+    roll_back: typing.Callable[[dict], None]
+    # Whether the intent alone has everything needed to finish the operation.
+    forward_from_intent: bool = False
+
+
+operations: typing.Dict[str, Operation] = {
+    "store": Operation(roll_forward_store, roll_back_store),
+    "refresh": Operation(roll_forward_refresh, roll_back_refresh),
+    "delete": Operation(roll_forward_delete, roll_back_delete, True),
+}
+
+
+class Transaction:
+    def __init__(self, log: "TransactionLog", txid: str, operation: str, payload: dict):
+        self.log = log
+        self.txid = txid
+        self.operation = operation
+        self.payload = payload
+        self.synced = False
+        self.finished = False
+
+    def data_synced(self, **payload):
+        """Log that the data of the transaction is on disk, with whatever is needed to finish it."""
+        self.payload.update(payload)
+        self.log.append(self.txid, DATA_SYNCED, payload)
+        self.synced = True
+
+    def commit(self):
+        self.log.append(self.txid, COMMITTED, {})
+        self.log.finish(self)
+
+    def abort(self):
+        operations[self.operation].roll_back(self.payload)
+        self.log.append(self.txid, ABORTED, {})
+        self.log.finish(self)
+
+    def __enter__(self) -> "Transaction":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Once the data is on disk the transaction is left for recovery to finish.
+        if not self.finished:
+            if self.synced:
+                self.log.release(self)
+            else:
+                self.abort()
+        return False
+
+
+class TransactionLog:
+    """The log of one process.
+
+    A process holds a shared lock on the log while it has transactions in
+    progress. Recovery and the emptying of the log need the exclusive lock so
+    they never touch the transactions of another process that is still running.
+    """
+
+    def __init__(self, path: pathlib.Path = log_path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = self.path.open("a+")
+        self.lock = threading.Lock()
+        self.pending: typing.Set[str] = set()
+        self.ids = itertools.count()
+
+    def close(self):
+        self.file.close()
+
+    def append(self, txid: str, phase: str, payload: dict):
+        with self.lock:
+            self.file.write(f"{txid} {phase} {json.dumps(payload)}\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def begin(self, operation: str, **payload) -> Transaction:
+        txid = f"{os.getpid()}-{datetime.datetime.now().timestamp()}-{next(self.ids)}"
+        transaction = Transaction(self, txid, operation, payload)
+        with self.lock:
+            if not self.pending:
+                fcntl.flock(self.file, fcntl.LOCK_SH)
+            self.pending.add(txid)
+        self.append(txid, INTENT, {"operation": operation, **payload})
+        return transaction
+
+    def finish(self, transaction: Transaction):
+        transaction.finished = True
+        with self.lock:
+            self.pending.discard(transaction.txid)
+            if not self.pending:
+                self._truncate_if_alone()
+                self._unlock()
+
+    def release(self, transaction: Transaction):
+        """Leave transaction for recovery, other processes may recover it."""
+        with self.lock:
+            self.pending.discard(transaction.txid)
+            if not self.pending:
+                self._unlock()
+
+    def _unlock(self):
+        """Back to the lock held while no exclusive access is needed."""
+        fcntl.flock(self.file, fcntl.LOCK_SH if self.pending else fcntl.LOCK_UN)
+
+    def _truncate_if_alone(self):
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # other processes may still have pending transactions
+        self.file.truncate(0)
+        os.fsync(self.file.fileno())
+
+    def unfinished(self) -> typing.List[typing.Tuple[str, dict, bool]]:
+        """Transactions without a commit, with their payload and whether their data was synced."""
+        transactions: typing.Dict[str, typing.Tuple[dict, bool]] = {}
+        self.file.seek(0)
+        for line in self.file:
+            try:
+                txid, phase, payload = line.split(" ", 2)
+                payload = json.loads(payload)
+            except ValueError:
+                continue  # a line cut short by a crash
+            if phase == INTENT:
+                transactions[txid] = (payload, False)
+            elif txid not in transactions:
+                continue
+            elif phase == DATA_SYNCED:
+                transactions[txid] = ({**transactions[txid][0], **payload}, True)
+            elif phase in (COMMITTED, ABORTED):
+                del transactions[txid]
+        return [
+            (txid, payload, synced) for txid, (payload, synced) in transactions.items()
+        ]
+
+    @contextlib.contextmanager
+    def exclusive(self, timeout: typing.Optional[float] = None):
+        """Keep other ltarchiver processes from starting transactions in the block.
+
+        Waits for the running ones to finish first, for timeout seconds at most
+        (exclusive_timeout by default) before giving up with an LTAError.
+        """
+        if timeout is None:
+            timeout = exclusive_timeout
+        deadline = time.monotonic() + timeout
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                self._unlock()  # a failed conversion drops the shared lock
+            if time.monotonic() >= deadline:
+                raise common.LTAError(
+                    f"Other ltarchiver commands were still running after {timeout:.0f}"
+                    " seconds, try again once they finish"
+                )
+            if not waiting:
+                print("Waiting for the other ltarchiver commands to finish")
+                waiting = True
+            time.sleep(0.1)
+        try:
+            yield
+        finally:
+            self._unlock()
+
+    def recover(self) -> int:
+        """Finish or undo the transactions interrupted by a crash.
+
+        Does nothing while other processes have transactions in progress. Returns
+        the number of transactions recovered.
+        """
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._unlock()  # a failed conversion drops the shared lock
+            return 0
+        try:
+            recovered = self.unfinished()
+            for txid, payload, synced in recovered:
+                operation = operations[payload["operation"]]
+                if synced or operation.forward_from_intent:
+                    print(f"Finishing the interrupted {payload['operation']} {txid}")
+                    operation.roll_forward(payload)
+                else:
+                    print(f"Undoing the interrupted {payload['operation']} {txid}")
+                    operation.roll_back(payload)
+            self.file.truncate(0)
+            os.fsync(self.file.fileno())
+        finally:
+            self._unlock()
+        return len(recovered)
+
+
+_log: typing.Optional[TransactionLog] = None
+_log_lock = threading.Lock()
+
+
+def get_log() -> TransactionLog:
+    global _log
+    with _log_lock:
+        if _log is None or not _log.path.exists():
+            if _log is not None:
+                _log.close()
+            _log = TransactionLog()
+        return _log
+
+
+def begin(operation: str, **payload) -> Transaction:
+    return get_log().begin(operation, **payload)
+
+
+def recover() -> int:
+    return get_log().recover()
+
+
+def exclusive(timeout: typing.Optional[float] = None):
+    return get_log().exclusive(timeout)
+
+
+def delete_record(record: common.Record):
+    """Mark record as deleted on the home recordbook."""
+    with begin("delete", record=record_to_dict(record)) as transaction:
+        apply_deletion(record)
+        transaction.commit()
@@ -0,0 +1,241 @@
+"""Verify command
+
+Checks that archived files and their ECC still match the recordbook without
+changing anything. Without paths every file in the recordbook is checked, a path
+may be an archived file or a device, in which case all of its files are checked.
+Files on devices that aren't connected are reported as skipped.
+
+Exits with 0 when every file checked is intact, 1 when a file is damaged,
+missing or unreadable, and 2 when every file was skipped, so nothing was
+checked at all.
+
+Usage:
+  ltarchiver-verify [options] [<path>...]
+
+Options:
+  --jobs=<n>         Files checked at the same time [default: 4].
+  --per-device=<n>   Files checked at the same time on each device [default: 1].
+  --json             Print the report as JSON.
+  --direct-io        Read the files without going through the page cache.
+  --max-rate=<MB/s>  Read at most this many megabytes per second.
+  --idle             Only use the disk when nothing else does (idle I/O
+                     scheduling class).
+  --metrics=<file>   Record how long each phase took to file, as JSON lines or
+                     as a Prometheus textfile when file ends in .prom.
+  --profile=<file>   Profile the run with cProfile and save the stats to file.
+"""
+
+import collections
+import concurrent.futures
+import contextvars
+import dataclasses
+import itertools
+import json
+import pathlib
+import threading
+import time
+import typing
+
+from docopt import docopt
+
+from ltarchiver import common, directio, governor, instrument
+
+SKIPPED = "SKIPPED"  # the device isn't connected
+ERROR = "ERROR"  # the file couldn't be read
+
+
+@dataclasses.dataclass
+class Result:
+    record: common.Record
+    status: str
+    seconds: float = 0.0
+    detail: str = ""
+
+    @property
+    def ok(self) -> bool:
+        """Nothing wrong was found, which a skipped file also is."""
+        return self.status in (common.Validation.VALID.name, SKIPPED)
+
+    def to_dict(self) -> dict:
+        return {
+            "file": self.record.file_name,
+            "device": self.record.destination,
+            "status": self.status,
+            "seconds": self.seconds,
+            "detail": self.detail,
+        }
+
+
+class DeviceRoots:
+    """Where each device is mounted, looked up once per device."""
+
+    def __init__(self):
+        self._roots: typing.Dict[str, typing.Optional[pathlib.Path]] = {}
+        self._errors: typing.Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def add(self, uuid: str, root: pathlib.Path):
+        self._roots[uuid] = root
+
+    def get(self, uuid: str) -> typing.Tuple[typing.Optional[pathlib.Path], str]:
+        with self._lock:
+            if uuid not in self._roots:
+                try:
+                    self._roots[uuid] = common.get_root_from_uuid(uuid)
+                except (AttributeError, OSError) as err:
+                    self._roots[uuid] = None
+                    self._errors[uuid] = str(err)
+            return self._roots[uuid], self._errors.get(uuid, "")
+
+
+def current_records() -> typing.List[common.Record]:
+    """The records of the home recordbook that weren't deleted."""
+    records = {}
+    for record in common.get_records(common.recordbook_path):
+        records[record.identity()] = record
+    return [record for record in records.values() if not record.deleted]
+
+
+def select_records(
+    records: typing.List[common.Record],
+    paths: typing.List[pathlib.Path],
+    roots: DeviceRoots,
+) -> typing.List[common.Record]:
+    """The records of the files or devices at paths, all of them without paths."""
+    if not paths:
+        return records
+    selected = []
+    for path in paths:
+        path = path.resolve()
+        uuid, root = common.get_device_uuid_and_root_from_path(path)
+        if path.is_dir():
+            # in debug mode the test directory stands for the device
+            roots.add(uuid, path if common.DEBUG else root)
+            matches = [record for record in records if record.destination == uuid]
+        else:
+            roots.add(uuid, path.parent if common.DEBUG else root)
+            matches = [
+                record
+                for record in records
+                if record.destination == uuid and record.file_name == path.name
+            ]
+            if not matches:
+                raise common.LTAError(f"{path} was not found in the recordbook")
+        selected.extend(matches)
+    return selected
+
+
+def interleave_devices(
+    records: typing.List[common.Record],
+) -> typing.List[common.Record]:
+    """Order records so the workers spread over all the devices from the start."""
+    by_device = collections.defaultdict(list)
+    for record in records:
+        by_device[record.destination].append(record)
+    return [
+        record
+        for records_of_turn in itertools.zip_longest(*by_device.values())
+        for record in records_of_turn
+        if record is not None
+    ]
+
+
+def verify_records(
+    records: typing.List[common.Record],
+    roots: DeviceRoots,
+    jobs: int = 4,
+    per_device: int = 1,
+) -> typing.List[Result]:
+    """Check every record with jobs hashers, at most per_device on each device.
+
+    Hashing one file at a time per device keeps a disk reading sequentially while
+    several disks are read at the same time.
+    """
+    device_slots = collections.defaultdict(lambda: threading.Semaphore(per_device))
+    slots_lock = threading.Lock()
+
+    def check(record: common.Record) -> Result:
+        root, error = roots.get(record.destination)
+        if root is None:
+            return Result(record, SKIPPED, detail=error)
+        with slots_lock:
+            slot = device_slots[record.destination]
+        with slot:
+            start = time.perf_counter()
+            try:
+                validation = record.get_validation(root)
+            except OSError as err:
+                return Result(record, ERROR, time.perf_counter() - start, str(err))
+            return Result(
+                record, validation.name, time.perf_counter() - start, str(validation)
+            )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, check, record)
+            for record in interleave_devices(records)
+        ]
+        return [future.result() for future in futures]
+
+
+def summarize(results: typing.List[Result]) -> typing.Dict[str, int]:
+    return dict(collections.Counter(result.status for result in results))
+
+
+def print_report(results: typing.List[Result], as_json: bool):
+    if as_json:
+        print(
+            json.dumps(
+                {
+                    "files": [result.to_dict() for result in results],
+                    "summary": summarize(results),
+                },
+                indent=2,
+            )
+        )
+        return
+    for result in results:
+        if not result.ok:
+            record = result.record
+            print(f"{record.destination}/{record.file_name}: {result.detail}")
+    for status, count in sorted(summarize(results).items()):
+        print(f"{status}: {count}")
+
+
+def exit_code(results: typing.List[Result]) -> int:
+    if not all(result.ok for result in results):
+        return 1
+    if results and all(result.status == SKIPPED for result in results):
+        return 2
+    return 0
+
+
+def run():
+    arguments = docopt(__doc__)
+    directio.enabled = arguments["--direct-io"]
+    max_rate = float(arguments["--max-rate"] or 0)
+    if max_rate or arguments["--idle"]:
+        governor.configure(max_rate, idle=arguments["--idle"])
+    with instrument.session("verify", arguments["--metrics"], arguments["--profile"]):
+        roots = DeviceRoots()
+        try:
+            records = select_records(
+                current_records(),
+                [pathlib.Path(path) for path in arguments["<path>"]],
+                roots,
+            )
+        except common.LTAError as err:
+            common.error(err.args[0])
+        except (AttributeError, FileNotFoundError) as err:
+            common.error(str(err))
+        results = verify_records(
+            records, roots, int(arguments["--jobs"]), int(arguments["--per-device"])
+        )
+    print_report(results, arguments["--json"])
+    code = exit_code(results)
+    if code:
+        exit(code)
+
+
+if __name__ == "__main__":
+    run()
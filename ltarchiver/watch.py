@@ -0,0 +1,305 @@
+"""Watch command
+
+Stores the files dropped in a staging directory as soon as they are complete,
+instead of running ltarchiver-store from cron. inotify tells when a file is
+closed after being written or moved in, where it isn't available the directory
+is scanned every --poll seconds. A file is stored once it stayed unchanged for
+--settle seconds and the files ready at the same time are stored together, on
+all destinations at once. Stored files are removed from the staging directory,
+unless they changed while they were stored, then they're stored again. A file
+that couldn't be stored stays there and is tried again after a minute, then
+after twice as long each time it fails, up to an hour, or once it changes.
+
+Only the regular files directly in the staging directory are stored. Files
+whose name starts with a dot, like the temporary files of rsync, are left alone.
+
+Usage:
+  ltarchiver-watch [options] <staging_directory> <destination_directory>...
+
+Options:
+  --settle=<seconds>        How long a file must stay unchanged [default: 2].
+  --batch=<n>               Files stored at a time at most [default: 64].
+  --writers-per-device=<n>  Files written at once to each destination device
+                            [default: 1].
+  --compress=<codec>        Compress the files with codec (lzma).
+  --poll=<seconds>          Scan the directory every seconds instead of using
+                            inotify.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import pathlib
+import select
+import stat
+import struct
+import sys
+import threading
+import time
+import typing
+
+from docopt import docopt
+
+from ltarchiver import common, transaction
+
+poll_interval = 10.0  # seconds, when inotify isn't available
+wake_interval = 1.0  # seconds, how often a stop is noticed
+retry_delay = 60.0  # seconds before a file that couldn't be stored is tried again
+max_retry_delay = 3600.0  # seconds, the delay doubles on each failure up to this
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+_EVENT = struct.Struct("iIII")  # struct inotify_event without its name
+
+Signature = typing.Tuple[int, int]  # size and modification time of a file
+
+
+def signature(path: pathlib.Path) -> typing.Optional[Signature]:
+    """What changes when path is written, None unless it's a regular file."""
+    try:
+        info = path.lstat()
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISREG(info.st_mode):
+        return None
+    return info.st_size, info.st_mtime_ns
+
+
+def staged_files(directory: pathlib.Path) -> typing.Dict[pathlib.Path, Signature]:
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                continue
+            info = entry.stat(follow_symlinks=False)
+            files[pathlib.Path(entry.path)] = (info.st_size, info.st_mtime_ns)
+    return files
+
+
+class Inotify:
+    """The files of a directory closed after being written or moved into it."""
+
+    def __init__(self, directory: pathlib.Path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.directory = directory
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not start inotify")
+        if (
+            libc.inotify_add_watch(
+                self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO
+            )
+            < 0
+        ):
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"Could not watch {directory}")
+
+    def changed(self, timeout: float) -> typing.Optional[typing.List[pathlib.Path]]:
+        """The files written within timeout seconds, None if some were missed."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size : offset + _EVENT.size + length]
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if not mask & IN_ISDIR:
+                paths.append(self.directory / os.fsdecode(name.rstrip(b"\0")))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """The files of a directory that changed, found by scanning it every interval."""
+
+    def __init__(self, directory: pathlib.Path, interval: float = poll_interval):
+        self.directory = directory
+        self.interval = interval
+        self._next_scan = 0.0
+        self._seen: typing.Dict[pathlib.Path, Signature] = {}
+
+    def changed(self, timeout: float) -> typing.Optional[typing.List[pathlib.Path]]:
+        wait = self._next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        self._next_scan = time.monotonic() + self.interval
+        files = staged_files(self.directory)
+        changed = [path for path, seen in files.items() if self._seen.get(path) != seen]
+        self._seen = files
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(
+    directory: pathlib.Path, interval: typing.Optional[float] = None
+) -> typing.Union[Inotify, Poller]:
+    """inotify on directory, a Poller when interval is given or inotify fails."""
+    if interval is None:
+        try:
+            return Inotify(directory)
+        except (OSError, AttributeError) as err:
+            # AttributeError when the C library has no inotify
+            print(f"inotify isn't available ({err}), scanning {directory} instead")
+        interval = poll_interval
+    return Poller(directory, interval)
+
+
+class Ingester:
+    """Store the files of a staging directory once they stopped changing."""
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        destinations: typing.List[pathlib.Path],
+        settle: float = 2.0,
+        batch_size: int = 64,
+        writers_per_device: int = 1,
+        codec: str = "",
+    ):
+        self.directory = directory
+        self.destinations = destinations
+        self.settle = settle
+        self.batch_size = batch_size
+        self.writers_per_device = writers_per_device
+        self.codec = codec
+        # when each file may be stored, unless it changes before
+        self.pending: typing.Dict[pathlib.Path, typing.Tuple[float, Signature]] = {}
+        # how long the files that couldn't be stored wait for the next try
+        self.failed: typing.Dict[pathlib.Path, float] = {}
+
+    def scan(self):
+        """Notice every file of the directory, on start or after missing events."""
+        self.notice(staged_files(self.directory))
+
+    def notice(self, paths: typing.Iterable[pathlib.Path]):
+        deadline = time.monotonic() + self.settle
+        for path in paths:
+            if path.name.startswith(".") or path.parent != self.directory:
+                continue
+            current = signature(path)
+            if current is None:
+                continue
+            if path in self.failed and self.pending.get(path, (0, None))[1] == current:
+                continue  # unchanged, keeps waiting for its next try
+            self.pending[path] = deadline, current
+
+    def ready(self) -> typing.List[pathlib.Path]:
+        """The pending files that didn't change for settle seconds."""
+        now = time.monotonic()
+        ready = []
+        for path, (deadline, seen) in list(self.pending.items()):
+            if deadline > now:
+                continue
+            current = signature(path)
+            if current == seen:
+                ready.append(path)
+                del self.pending[path]
+            elif current is None:
+                del self.pending[path]
+            else:
+                self.pending[path] = now + self.settle, current
+        return ready
+
+    def timeout(self) -> float:
+        """How long to wait for changes before a pending file may be ready."""
+        if not self.pending:
+            return wake_interval
+        earliest = min(deadline for deadline, _ in self.pending.values())
+        return min(max(earliest - time.monotonic(), 0), wake_interval)
+
+    def store(self, sources: typing.List[pathlib.Path]):
+        from ltarchiver import jobs  # asyncio is slow to import
+
+        signatures = {source: signature(source) for source in sources}
+        print(f"Storing {len(sources)} files from {self.directory}")
+        failures = jobs.run_jobs(
+            [jobs.Job(source, self.destinations) for source in sources],
+            self.writers_per_device,
+            remove_sources=False,
+            codec=self.codec,
+        )
+        for failure in failures:
+            print(failure, file=sys.stderr)
+        failed = {failure.source for failure in failures}
+        now = time.monotonic()
+        for source in sources:
+            if source not in failed:
+                self.failed.pop(source, None)
+            current = signature(source)
+            if current is None:
+                self.failed.pop(source, None)
+            elif current != signatures[source]:
+                # changed while it was stored, so it's stored again
+                self.pending[source] = now + self.settle, current
+            elif source not in failed:
+                common.remove_file(source)
+            else:
+                delay = self.failed.get(source)
+                delay = min(delay * 2, max_retry_delay) if delay else retry_delay
+                self.failed[source] = delay
+                self.pending[source] = now + delay, current
+                print(f"{source} will be tried again in {delay:.0f} seconds")
+
+    def run(self, watcher: typing.Union[Inotify, Poller], stop: threading.Event):
+        """Store the files reported by watcher until stop is set."""
+        self.scan()
+        while not stop.is_set():
+            changed = watcher.changed(self.timeout())
+            if changed is None:
+                self.scan()
+            else:
+                self.notice(changed)
+            ready = self.ready()
+            for start in range(0, len(ready), self.batch_size):
+                self.store(ready[start : start + self.batch_size])
+
+
+def run():
+    arguments = docopt(__doc__)
+    directory = pathlib.Path(arguments["<staging_directory>"]).resolve()
+    if not directory.is_dir():
+        common.error(f"{directory} is not a directory")
+    codec = arguments["--compress"] or ""
+    if codec:
+        from ltarchiver import compression
+
+        try:
+            compression.check_codec(codec)
+        except common.LTAError as err:
+            common.error(err.args[0])
+    ingester = Ingester(
+        directory,
+        [pathlib.Path(path).resolve() for path in arguments["<destination_directory>"]],
+        float(arguments["--settle"]),
+        int(arguments["--batch"]),
+        int(arguments["--writers-per-device"]),
+        codec,
+    )
+    transaction.recover()
+    poll = arguments["--poll"]
+    watcher = open_watcher(directory, float(poll) if poll else None)
+    print(f"Watching {directory}, press Ctrl+C to stop")
+    try:
+        ingester.run(watcher, threading.Event())
+    except KeyboardInterrupt:
+        print("Stopped")
+    finally:
+        watcher.close()
+
+
+if __name__ == "__main__":
+    run()
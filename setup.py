@@ -33,6 +33,13 @@ setup(
             "ltarchiver-store=ltarchiver.store:run",
             "ltarchiver-restore=ltarchiver.check_and_restore:run",
             "ltarchiver-refresh=ltarchiver.refresh_device:run",
+            "ltarchiver-daemon=ltarchiver.daemon:run",
+            "ltarchiver-verify=ltarchiver.verify:run",
+            "ltarchiver-container=ltarchiver.container:run",
+            "ltarchiver-migrate=ltarchiver.migrate:run",
+            "ltarchiver-stripe=ltarchiver.erasure:run",
+            "ltarchiver-find=ltarchiver.find:run",
+            "ltarchiver-watch=ltarchiver.watch:run",
         ],
     },
     data_files=[
@@ -0,0 +1,358 @@
+"""Benchmarks of store, get_records, Record.get_validation, restore and refresh
+
+Generates files and recordbooks of the requested sizes under test_data/benchmark,
+times each operation and writes the results as JSON. When a baseline saved by an
+earlier run is given, every result slower than the baseline by more than the
+tolerance is reported as a regression and the exit code is 1.
+
+Operations that need the C encoder or a real device are reported as skipped when
+those aren't available, and as failed when they raise an error. A result that
+was ok in the baseline and isn't anymore is also a regression. Run it from the
+root of the repository with python -m test.benchmark.
+
+Usage:
+  benchmark [options]
+
+Options:
+  --sizes=<sizes>        File sizes to test [default: 4K,1M,64M].
+  --records=<counts>     Number of entries of the recordbooks [default: 1000,10000,100000].
+  --errors=<densities>   Corrupted bytes per 253 byte chunk on restores [default: 0,1].
+  --repeat=<n>           Times each measurement is repeated [default: 3].
+  --only=<names>         Run only these benchmarks, comma separated.
+  --output=<path>        Where to write the JSON results [default: -].
+  --baseline=<path>      Results of an earlier run to compare to.
+  --tolerance=<ratio>    How much slower than the baseline is acceptable [default: 0.2].
+
+The program must run with the DEBUG environment variable set so the recordbooks
+in the home directory are never touched.
+"""
+
+import dataclasses
+import datetime
+import json
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import sys
+import time
+import typing
+
+from docopt import docopt
+
+import test
+from ltarchiver import check_and_restore, common, refresh_device, store
+
+BENCHMARK_DIRECTORY = test.TEST_DIRECTORY / "benchmark"
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+ENCODER = pathlib.Path("c-ltarchiver/out/ltarchiver_store")
+DECODER = pathlib.Path("c-ltarchiver/out/ltarchiver_restore")
+DEVICES = pathlib.Path("/dev/disk/by-uuid")
+
+
+@dataclasses.dataclass
+class Result:
+    name: str
+    params: typing.Dict[str, typing.Any]
+    seconds: typing.List[float] = dataclasses.field(default_factory=list)
+    bytes: int = 0
+    status: str = "ok"
+
+    @property
+    def key(self) -> str:
+        return self.name + json.dumps(self.params, sort_keys=True)
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.seconds) if self.seconds else 0.0
+
+    def to_dict(self) -> dict:
+        fields = dataclasses.asdict(self)
+        fields["median_seconds"] = self.median
+        if self.bytes and self.median:
+            fields["mb_per_s"] = self.bytes / self.median / 1024**2
+        return fields
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def make_file(path: pathlib.Path, size: int):
+    """Random file of size bytes, written a block at a time so any size fits in memory."""
+    block_size = 1024 * 1024
+    with path.open("wb") as f:
+        while size > 0:
+            f.write(os.urandom(min(block_size, size)))
+            size -= block_size
+
+
+def make_recordbook(path: pathlib.Path, entries: int, destination: str):
+    timestamp = datetime.datetime.now().isoformat()
+    with path.open("w") as f:
+        f.write(common.RecordbookHeader(entries).text())
+        for i in range(entries):
+            f.write(
+                "Item\n"
+                "Version: 1\n"
+                f"Generation: {i + 1}\n"
+                "Deleted: False\n"
+                f"File-Name: file_{i}\n"
+                f"Source: /archive/source/file_{i}\n"
+                f"Destination: {destination}\n"
+                f"Bytes-per-chunk: {common.chunksize}\n"
+                f"EC-bytes-per-chunk: {common.eccsize}\n"
+                f"Timestamp: {timestamp}\n"
+                "Checksum-Algorithm: md5\n"
+                f"Checksum: {i:032x}\n"
+                f"ECC-Checksum: {i:032x}\n"
+            )
+
+
+def measure(
+    result: Result,
+    repeat: int,
+    function,
+    setup=None,
+    requires: typing.Sequence[pathlib.Path] = (),
+) -> Result:
+    """Time function repeat times, running setup untimed before each one.
+
+    The result is skipped when one of the paths it requires doesn't exist.
+    """
+    for path in requires:
+        if not path.exists():
+            result.status = f"skipped: {path} doesn't exist"
+            return result
+    for _ in range(repeat):
+        try:
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            function()
+        except (Exception, SystemExit) as err:
+            result.status = f"failed: {type(err).__name__}: {err}"
+            result.seconds.clear()
+            return result
+        result.seconds.append(time.perf_counter() - start)
+    return result
+
+
+def reset_directories():
+    test.setup_test_files()
+    BENCHMARK_DIRECTORY.mkdir(parents=True, exist_ok=True)
+
+
+def bench_get_records(options) -> typing.Iterable[Result]:
+    for entries in options["records"]:
+        reset_directories()
+        recordbook = BENCHMARK_DIRECTORY / "recordbook.txt"
+        make_recordbook(recordbook, entries, "uuid")
+        yield measure(
+            Result("get_records", {"entries": entries}, bytes=recordbook.stat().st_size),
+            options["repeat"],
+            lambda: sum(1 for _ in common.get_records(recordbook)),
+        )
+
+
+def fake_stored_file(size: int) -> common.Record:
+    """A file and ECC as they would be laid out on a device, without the encoder."""
+    reset_directories()
+    make_file(test.TEST_DESTINATION_FILE, size)
+    checksum = common.get_file_checksum(test.TEST_DESTINATION_FILE)
+    ecc = common.sharded_ecc_file_path(
+        test.TEST_DESTINATION_DIRECTORY / common.METADATA_DIR_NAME, checksum
+    )
+    ecc.parent.mkdir(parents=True)
+    make_file(ecc, max(1, size * common.eccsize // common.chunksize))
+    return common.Record(
+        timestamp=datetime.datetime.now(),
+        source=test.TEST_SOURCE_FILE,
+        destination="uuid",
+        file_name=test.TEST_DESTINATION_FILE.name,
+        checksum=checksum,
+        ecc_checksum=common.get_file_checksum(ecc),
+    )
+
+
+def bench_get_validation(options) -> typing.Iterable[Result]:
+    old_get_root = common.get_root_from_uuid
+    common.get_root_from_uuid = lambda uuid: test.TEST_DESTINATION_DIRECTORY
+    try:
+        for size in options["sizes"]:
+            record = fake_stored_file(size)
+            yield measure(
+                Result("get_validation", {"size": size}, bytes=size),
+                options["repeat"],
+                record.get_validation,
+            )
+    finally:
+        common.get_root_from_uuid = old_get_root
+
+
+def bench_store(options) -> typing.Iterable[Result]:
+    for size in options["sizes"]:
+
+        def setup():
+            reset_directories()
+            make_file(test.TEST_SOURCE_FILE, size)
+
+        yield measure(
+            Result("store", {"size": size}, bytes=size),
+            options["repeat"],
+            lambda: store.store(
+                test.TEST_SOURCE_FILE, test.TEST_DESTINATION_DIRECTORY, True
+            ),
+            setup,
+            (ENCODER, DEVICES),
+        )
+
+
+def bench_restore(options) -> typing.Iterable[Result]:
+    for size in options["sizes"]:
+        for errors in options["errors"]:
+
+            def setup():
+                reset_directories()
+                make_file(test.TEST_SOURCE_FILE, size)
+                test.store_test_file()
+                if errors:
+                    test.add_errors_to_file(test.TEST_DESTINATION_FILE, errors)
+                common.remove_file(test.TEST_RECOVERY_FILE)
+
+            def restore():
+                check_and_restore.restore(
+                    test.TEST_DESTINATION_FILE.resolve(),
+                    test.TEST_RECOVERY_FILE,
+                    non_interactive=True,
+                )
+
+            yield measure(
+                Result("restore", {"size": size, "errors": errors}, bytes=size),
+                options["repeat"],
+                restore,
+                setup,
+                (ENCODER, DECODER, DEVICES),
+            )
+
+
+def bench_refresh_device(options) -> typing.Iterable[Result]:
+    for size in options["sizes"]:
+
+        def setup():
+            reset_directories()
+            make_file(test.TEST_SOURCE_FILE, size)
+            test.store_test_file()
+
+        def refresh():
+            uuid, _ = common.get_device_uuid_and_root_from_path(
+                test.TEST_DESTINATION_DIRECTORY
+            )
+            refresh_device.refresh_device(uuid, test.TEST_DESTINATION_DIRECTORY)
+
+        yield measure(
+            Result("refresh_device", {"size": size}, bytes=size),
+            options["repeat"],
+            refresh,
+            setup,
+            (ENCODER, DECODER, DEVICES),
+        )
+
+
+benchmarks = {
+    "get_records": bench_get_records,
+    "get_validation": bench_get_validation,
+    "store": bench_store,
+    "restore": bench_restore,
+    "refresh_device": bench_refresh_device,
+}
+
+
+def compare(
+    results: typing.List[Result], baseline: dict, tolerance: float
+) -> typing.List[str]:
+    """Describe every result that got slower than the baseline by more than tolerance.
+
+    Results that were ok in the baseline and aren't anymore are described too.
+    """
+    previous = {
+        entry["name"] + json.dumps(entry["params"], sort_keys=True): entry
+        for entry in baseline["results"]
+    }
+    regressions = []
+    for result in results:
+        entry = previous.get(result.key)
+        if entry is None or entry["status"] != "ok":
+            continue
+        if result.status != "ok":
+            regressions.append(f"{result.name} {result.params}: {result.status}")
+            continue
+        if result.median > entry["median_seconds"] * (1 + tolerance):
+            regressions.append(
+                f"{result.name} {result.params}: {result.median:.4f}s,"
+                f" was {entry['median_seconds']:.4f}s"
+            )
+    return regressions
+
+
+def parse_options(arguments: dict) -> dict:
+    return {
+        "sizes": [parse_size(size) for size in arguments["--sizes"].split(",")],
+        "records": [int(count) for count in arguments["--records"].split(",")],
+        "errors": [int(errors) for errors in arguments["--errors"].split(",")],
+        "repeat": int(arguments["--repeat"]),
+    }
+
+
+def run():
+    arguments = docopt(__doc__)
+    if not common.DEBUG:
+        common.error("Set the DEBUG environment variable to run the benchmarks.")
+    options = parse_options(arguments)
+    names = arguments["--only"].split(",") if arguments["--only"] else benchmarks
+    unknown = [name for name in names if name not in benchmarks]
+    if unknown:
+        common.error(
+            f"Unknown benchmarks: {', '.join(unknown)}."
+            f" Choose from {', '.join(benchmarks)}."
+        )
+    results = []
+    try:
+        for name in names:
+            for result in benchmarks[name](options):
+                print(
+                    f"{result.name} {result.params}: {result.median:.4f}s {result.status}",
+                    file=sys.stderr,
+                )
+                results.append(result)
+    finally:
+        shutil.rmtree(BENCHMARK_DIRECTORY, ignore_errors=True)
+    report = {
+        "timestamp": datetime.datetime.now().isoformat(),
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": [result.to_dict() for result in results],
+    }
+    text = json.dumps(report, indent=2)
+    if arguments["--output"] == "-":
+        print(text)
+    else:
+        pathlib.Path(arguments["--output"]).write_text(text)
+    if arguments["--baseline"]:
+        baseline = json.loads(pathlib.Path(arguments["--baseline"]).read_text())
+        regressions = compare(results, baseline, float(arguments["--tolerance"]))
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,66 @@
+import datetime
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import common
+from ltarchiver.api import Archiver
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        test.TEST_DESTINATION_FILE.write_text("hello world")
+        test.TEST_CHECKSUM_FILE.parent.mkdir(parents=True)
+        test.TEST_CHECKSUM_FILE.write_text("hello world")
+        common.Record(
+            timestamp=datetime.datetime.now(),
+            source=test.TEST_SOURCE_FILE,
+            destination="uuid",
+            file_name="test_source",
+            checksum=test.TEST_FILE_CHECKSUM,
+            ecc_checksum=test.TEST_FILE_CHECKSUM,
+        ).write(common.recordbook_path)
+
+    def test_verify_with_progress(self):
+        events = []
+        archiver = Archiver(on_progress=events.append)
+        with mock.patch.object(
+            common, "get_root_from_uuid", return_value=test.TEST_DESTINATION_DIRECTORY
+        ):
+            results = archiver.verify()
+        self.assertEqual([result.status for result in results], ["VALID"])
+        # the file and its ECC are hashed
+        finished = [event for event in events if event.finished]
+        self.assertEqual(len(finished), 2)
+        self.assertEqual(finished[0].done, len("hello world"))
+
+    def test_verify_unknown_file(self):
+        with self.assertRaises(common.LTAError):
+            Archiver().verify([test.TEST_SOURCE_FILE])
+
+    def test_restore_onto_itself(self):
+        backup = test.TEST_DESTINATION_FILE.resolve()
+        with self.assertRaises(common.LTAError):
+            Archiver().restore(backup, backup)
+
+    def test_prompt(self):
+        questions = []
+
+        def prompt(question, choices):
+            questions.append(choices)
+            return "abort"
+
+        with Archiver(prompt=prompt)._session():
+            self.assertRaises(common.LTAError, common.confirm, "Continue?")
+        self.assertEqual(questions, [["continue", "abort"]])
+
+    def test_no_prompt(self):
+        with Archiver()._session():
+            self.assertRaises(common.LTAError, common.ask_yes_no, "Remove?")
+        # the terminal is used again outside of the archiver
+        self.assertIsNone(common.prompt_hook.get())
+
+
+if __name__ == "__main__":
+    unittest.main()
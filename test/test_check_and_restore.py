@@ -1,6 +1,15 @@
+import datetime
+import hashlib
+import os
 import pathlib
+import shutil
+import subprocess
+import sys
 import unittest
-from ltarchiver import common
+from unittest import mock
+
+import test
+from ltarchiver import check_and_restore, common
 
 
 class MyTestCase(unittest.TestCase):
@@ -12,5 +21,119 @@ class MyTestCase(unittest.TestCase):
         pass
 
 
+# writes a header and the md5 of every chunk, as the encoder writes their ECC
+FAKE_ENCODER = f"""
+import hashlib, sys
+with open(sys.argv[1], "rb") as f, open(sys.argv[3], "wb") as out:
+    out.write(b"ECC")
+    for chunk in iter(lambda: f.read({common.chunksize}), b""):
+        out.write(hashlib.md5(chunk).digest()[:{common.eccsize}])
+"""
+
+
+def fake_encoder_command(source, ecc_file_path):
+    return [
+        sys.executable,
+        "-c",
+        FAKE_ENCODER,
+        str(source),
+        os.devnull,
+        str(ecc_file_path),
+    ]
+
+
+class ReplicaTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.data = os.urandom(10 * common.chunksize + 7)
+        self.checksum = hashlib.md5(self.data).hexdigest()
+        patcher = mock.patch.object(common, "encoder_command", fake_encoder_command)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ecc_data = test.TEST_DIRECTORY / "ecc"
+        (test.TEST_DIRECTORY / "original").write_bytes(self.data)
+        subprocess.check_call(
+            fake_encoder_command(test.TEST_DIRECTORY / "original", ecc_data)
+        )
+        self.devices = []
+        for index in range(3):
+            device = test.TEST_DIRECTORY / f"device{index}"
+            (device / common.METADATA_DIR_NAME).mkdir(parents=True)
+            (device / "image").write_bytes(self.data)
+            self.devices.append(device)
+            common.Record(
+                timestamp=datetime.datetime.now(),
+                source=pathlib.Path("image").absolute(),
+                destination=f"uuid{index}",
+                file_name="image",
+                checksum=self.checksum,
+                ecc_checksum=common.get_file_checksum(ecc_data),
+            ).write(common.recordbook_path)
+        ecc = common.sharded_ecc_file_path(
+            self.devices[0] / common.METADATA_DIR_NAME, self.checksum
+        )
+        common.make_ecc_shard(ecc)
+        shutil.copy(ecc_data, ecc)
+        common.write_recordbook_checksum(
+            common.recordbook_path, common.recordbook_checksum_file_path
+        )
+        shutil.copy(
+            common.recordbook_path,
+            self.devices[0] / common.METADATA_DIR_NAME / common.recordbook_file_name,
+        )
+        self.destination = test.TEST_DIRECTORY / "restored"
+        patcher = mock.patch.object(
+            common,
+            "get_root_from_uuid",
+            lambda uuid: self.devices[int(uuid[4:])],
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def damage(self, device: int, *chunks: int):
+        path = self.devices[device] / "image"
+        data = bytearray(path.read_bytes())
+        for chunk in chunks:
+            data[chunk * common.chunksize] ^= 0xFF
+        path.write_bytes(data)
+
+    def restore(self):
+        check_and_restore.restore(
+            (self.devices[0] / "image").resolve(), self.destination, True
+        )
+        self.assertEqual(self.destination.read_bytes(), self.data)
+
+    def test_replica_paths(self):
+        record = next(iter(common.get_records(common.recordbook_path)))
+        paths = check_and_restore.replica_paths(
+            record, (self.devices[0] / "image").resolve()
+        )
+        self.assertEqual(paths, [device / "image" for device in self.devices[1:]])
+
+    def test_intact_replica(self):
+        self.damage(0, 3)
+        self.damage(1, 5)
+        self.restore()
+        self.assertEqual(list(test.TEST_DIRECTORY.glob("restored.*")), [])
+
+    def test_chunks_checked_against_the_ecc(self):
+        # most copies have chunk 2 damaged the same way
+        self.damage(0, 2)
+        self.damage(2, 2)
+        self.restore()
+
+    def test_two_copies(self):
+        (self.devices[2] / "image").unlink()
+        self.damage(0, 1, 4)
+        self.damage(1, 6)
+        self.restore()
+
+    def test_merge_damaged_replicas(self):
+        self.damage(0, 0, 9)
+        self.damage(1, 3)
+        self.damage(2, 4, 10)
+        self.restore()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,10 +1,12 @@
 import pathlib
 import shutil
 import unittest
+import dataclasses
 import datetime
+from unittest import mock
 
 import test
-from ltarchiver import common
+from ltarchiver import common, sparse
 
 from test import (
     TEST_FILE_CHECKSUM,
@@ -18,6 +20,105 @@ from test import (
 )
 
 
+def baseline_parse_records(recordbook_path: pathlib.Path):
+    """The line by line parser that common.parse_records replaced, as an oracle."""
+    recordbook = recordbook_path.open("r")
+    source = None
+    destination = None
+    file_name = None
+    deleted = None
+    version = None
+    chunksize_ = None
+    eccsize_ = None
+    timestamp = None
+    checksum = None
+    checksum_alg = None
+    first_item = True
+    ecc_checksum = None
+    generation = 0
+    holes = ()
+    compression = ""
+    stripe = ""
+    for line in recordbook:
+        line = line.strip()
+        parts = line.split(" ")
+        if parts[0] == "Item":
+            if first_item:
+                first_item = False
+            else:
+                yield common.Record(
+                    source=pathlib.Path(source),
+                    destination=destination,
+                    file_name=file_name,
+                    deleted=deleted,
+                    version=version,
+                    chunksize=chunksize_,
+                    eccsize=eccsize_,
+                    timestamp=timestamp,
+                    checksum=checksum,
+                    checksum_algorithm=checksum_alg,
+                    ecc_checksum=ecc_checksum,
+                    generation=generation,
+                    holes=holes,
+                    compression=compression,
+                    stripe=stripe,
+                )
+                holes = ()
+                compression = ""
+                stripe = ""
+        elif parts[0] == "Deleted:":
+            deleted = parts[1].lower() == "true"
+        elif parts[0] == "Source:":
+            source = parts[1]
+        elif parts[0] == "Destination:":
+            destination = parts[1]
+        elif parts[0] == "Checksum:":
+            checksum = parts[1]
+        elif parts[0] == "File-Name:":
+            file_name = parts[1]
+        elif parts[0] == "Bytes-per-chunk:":
+            chunksize_ = int(parts[1])
+        elif parts[0] == "EC-bytes-per-chunk:":
+            eccsize_ = int(parts[1])
+        elif parts[0] == "Timestamp:":
+            timestamp = datetime.datetime.fromisoformat(parts[1])
+        elif parts[0] == "Checksum-Algorithm:":
+            checksum_alg = parts[1]
+        elif parts[0] == "ECC-Checksum:":
+            ecc_checksum = parts[1]
+        elif parts[0] == "Version:":
+            version = int(parts[1])
+        elif parts[0] == "Generation:":
+            generation = int(parts[1])
+        elif parts[0] == "Holes:":
+            holes = sparse.parse_holes(parts[1])
+        elif parts[0] == "Compression:":
+            compression = parts[1]
+        elif parts[0] == "Stripe:":
+            stripe = parts[1]
+    recordbook.close()
+    if first_item:
+        return []
+    else:
+        yield common.Record(
+            source=pathlib.Path(source),
+            destination=destination,
+            file_name=file_name,
+            deleted=deleted,
+            version=version,
+            chunksize=chunksize_,
+            eccsize=eccsize_,
+            timestamp=timestamp,
+            checksum=checksum,
+            checksum_algorithm=checksum_alg,
+            ecc_checksum=ecc_checksum,
+            generation=generation,
+            holes=holes,
+            compression=compression,
+            stripe=stripe,
+        )
+
+
 class MyTestCase(unittest.TestCase):
     def setUp(self) -> None:
         setup_test_files()
@@ -162,6 +263,139 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(record.checksum_algorithm, "sha1")
         self.assertEqual(record.checksum, "4321")
 
+    def assert_parsed_like_lines(self, path: pathlib.Path):
+        """Records are parsed as the original line by line parser does."""
+        records = [dataclasses.astuple(r) for r in common.parse_records(path)]
+        by_lines = [dataclasses.astuple(r) for r in baseline_parse_records(path)]
+        self.assertEqual(records, by_lines)
+        return records
+
+    def test_parse_records_fields(self):
+        self.assertEqual(
+            {name for name, _ in common._LINE_FIELDS.values()},
+            {field.name for field in dataclasses.fields(common.Record)},
+        )
+
+    def test_parse_records_like_lines(self):
+        record = common.Record(
+            timestamp=datetime.datetime.now(),
+            source=TEST_SOURCE_FILE.absolute(),
+            destination="some-uuid",
+            file_name="test_source",
+            checksum=TEST_FILE_CHECKSUM,
+            ecc_checksum="1234",
+        )
+        common.write_recordbook_header(
+            common.recordbook_path, common.RecordbookHeader(3, {"some-uuid": 2})
+        )
+        for index, changes in enumerate(
+            [
+                {},
+                {"holes": ((0, 4096), (8192, 4096)), "deleted": True},
+                {"compression": "lzma", "generation": 3},
+                {"stripe": "1/3+2,100,abcd", "compression": "lzma"},
+                {"source": pathlib.Path("/same/source")},
+                {"source": pathlib.Path("/same/source"), "version": 2},
+            ]
+        ):
+            changes.setdefault("file_name", f"file{index}")
+            dataclasses.replace(record, **changes).write(common.recordbook_path)
+        with mock.patch.object(common, "parse_read_size", 100):
+            records = self.assert_parsed_like_lines(common.recordbook_path)
+        self.assertEqual(len(records), 6)
+        # all of them took the fast path
+        text = common.recordbook_path.read_text()
+        self.assertEqual(len(common._RECORD.findall(text)), 6)
+        self.assertEqual(self.assert_parsed_like_lines(common.recordbook_path), records)
+
+    def test_parse_records_edited_by_hand(self):
+        TEST_RECORD_FILE.write_text(
+            "Recordbook-Generation: 2\n"
+            "Compression: lzma\n"
+            "Item\n"
+            "Deleted: false\n"
+            "File-Name: first  \n"
+            "Source: /a/b\n"
+            "Timestamp: 2020-01-01T00:00:00\n"
+            "Item \r\n"
+            "  File-Name: second extra\n"
+            "Unknown: 1\n"
+            "\n"
+        )
+        records = self.assert_parsed_like_lines(TEST_RECORD_FILE)
+        self.assertEqual([r[3] for r in records], ["first", "second"])
+        # a field missing from a record keeps its value from the one before
+        self.assertEqual(records[1][1], pathlib.Path("/a/b"))
+
+    def test_recordbook_header(self):
+        write_test_recorbook()
+        header = common.read_recordbook_header(common.recordbook_path)
+        self.assertEqual(header, common.RecordbookHeader())
+        header.generation = 3
+        header.high_water_marks["some-uuid"] = 2
+        common.write_recordbook_header(common.recordbook_path, header)
+        self.assertEqual(common.read_recordbook_header(common.recordbook_path), header)
+        records = list(common.get_records(common.recordbook_path))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].checksum, TEST_FILE_CHECKSUM)
+
+    def test_recordbook_moved_with_its_device(self):
+        mounted_before = TEST_DIRECTORY / "mounted_before"
+        mounted_now = TEST_DIRECTORY / "mounted_now"
+        mounted_before.mkdir()
+        recordbook = mounted_before / common.recordbook_file_name
+        write_test_recorbook(recordbook)
+        common.write_recordbook_checksum(recordbook, mounted_before / "checksum.txt")
+        content = recordbook.read_bytes()
+        mounted_before.rename(mounted_now)
+        recordbook = mounted_now / common.recordbook_file_name
+        checksum_file = mounted_now / "checksum.txt"
+        with mock.patch.object(common.parity, "repair") as repair:
+            self.assertTrue(common.RecordBook(recordbook, checksum_file).valid)
+        repair.assert_not_called()
+        with recordbook.open("r+b") as f:
+            f.write(b"Junk")
+        self.assertTrue(common.RecordBook(recordbook, checksum_file).valid)
+        self.assertEqual(recordbook.read_bytes(), content)
+
+    def test_record_generation(self):
+        write_test_recorbook()
+        record = list(common.get_records(common.recordbook_path))[0]
+        self.assertEqual(record.generation, 0)
+        dataclasses.replace(record, generation=7).write(common.recordbook_path)
+        records = list(common.get_records(common.recordbook_path))
+        self.assertEqual([r.generation for r in records], [0, 7])
+        self.assertEqual(records[1].timestamp, record.timestamp)
+
+    def test_compare_generations(self):
+        def header(generation, mark):
+            return common.RecordbookHeader(generation, {"uuid": mark})
+
+        self.assertEqual(
+            common.compare_generations(header(2, 2), header(2, 2), "uuid"),
+            common.Divergence.IN_SYNC,
+        )
+        self.assertEqual(
+            common.compare_generations(header(3, 2), header(2, 2), "uuid"),
+            common.Divergence.HOME_AHEAD,
+        )
+        self.assertEqual(
+            common.compare_generations(header(2, 2), header(4, 2), "uuid"),
+            common.Divergence.DEVICE_AHEAD,
+        )
+        self.assertEqual(
+            common.compare_generations(header(3, 2), header(4, 2), "uuid"),
+            common.Divergence.DIVERGED,
+        )
+        self.assertEqual(
+            common.compare_generations(header(3, 2), header(3, 3), "uuid"),
+            common.Divergence.UNKNOWN,
+        )
+        self.assertEqual(
+            common.compare_generations(header(3, 2), header(3, 2), "other"),
+            common.Divergence.UNKNOWN,
+        )
+
     def test_get_device_uuid_from_path(self):
         print(common.get_device_uuid_and_root_from_path(pathlib.Path("/")))
         self.assertTrue(True)
@@ -174,10 +408,22 @@ class MyTestCase(unittest.TestCase):
     def test_ecc_file_path(self):
         write_test_recorbook()
         record = list(common.get_records(common.recordbook_path))[0]
-        self.assertEqual(
-            record.ecc_file_path(TEST_DIRECTORY),
-            TEST_DIRECTORY / common.METADATA_DIR_NAME / "ecc" / TEST_FILE_CHECKSUM,
+        sharded = (
+            TEST_DIRECTORY
+            / common.METADATA_DIR_NAME
+            / "ecc"
+            / TEST_FILE_CHECKSUM[:2]
+            / TEST_FILE_CHECKSUM[2:4]
+            / TEST_FILE_CHECKSUM
         )
+        self.assertEqual(record.ecc_file_path(TEST_DIRECTORY), sharded)
+        legacy = TEST_DIRECTORY / common.METADATA_DIR_NAME / "ecc" / TEST_FILE_CHECKSUM
+        legacy.parent.mkdir(parents=True)
+        legacy.write_text("ecc")
+        self.assertEqual(record.ecc_file_path(TEST_DIRECTORY), legacy)
+        common.make_ecc_shard(sharded)
+        sharded.write_text("ecc")
+        self.assertEqual(record.ecc_file_path(TEST_DIRECTORY), sharded)
 
     def test_get_validation_valid(self):
         uuid, _ = common.get_device_uuid_and_root_from_path(pathlib.Path("."))
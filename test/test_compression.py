@@ -0,0 +1,82 @@
+import datetime
+import lzma
+import os
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import common, compression
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.source = test.TEST_DIRECTORY / "text"
+        self.data = b"".join(
+            f"line {i} of a text that compresses well\n".encode() for i in range(20000)
+        ) + os.urandom(1000)
+        self.source.write_bytes(self.data)
+        self.compressed = test.TEST_DIRECTORY / "compressed"
+        self.decompressed = test.TEST_DIRECTORY / "decompressed"
+
+    def test_round_trip(self):
+        teed = bytearray()
+        with mock.patch.object(compression, "chunk_size", 64 * 1024):
+            checksum, original = compression.compress_file(
+                self.source, self.compressed, "lzma", teed.extend
+            )
+        self.assertEqual(bytes(teed), self.compressed.read_bytes())
+        self.assertEqual(checksum, common.get_file_checksum(self.compressed))
+        self.assertEqual(original, common.get_file_checksum(self.source))
+        self.assertLess(self.compressed.stat().st_size, len(self.data) / 3)
+        with self.compressed.open("rb") as f:
+            self.assertGreater(len(compression.xz_streams(f)), 1)
+        # the streams make up a regular xz file
+        self.assertEqual(lzma.decompress(self.compressed.read_bytes()), self.data)
+        compression.decompress_file(
+            self.compressed, self.decompressed, "lzma", original
+        )
+        self.assertEqual(self.decompressed.read_bytes(), self.data)
+        with self.assertRaises(common.LTAError):
+            compression.decompress_file(
+                self.compressed, self.decompressed, "lzma", "0" * 32
+            )
+
+    def test_empty_file(self):
+        self.source.write_bytes(b"")
+        compression.compress_file(self.source, self.compressed, "lzma")
+        compression.decompress_file(self.compressed, self.decompressed, "lzma")
+        self.assertEqual(self.decompressed.read_bytes(), b"")
+
+    def test_damaged(self):
+        compression.compress_file(self.source, self.compressed, "lzma")
+        with self.compressed.open("r+b") as f:
+            f.seek(-2, os.SEEK_END)
+            f.write(b"XX")
+        with self.assertRaises(common.LTAError):
+            compression.decompress_file(self.compressed, self.decompressed, "lzma")
+
+    def test_unknown_codec(self):
+        with self.assertRaises(common.LTAError):
+            compression.compress_file(self.source, self.compressed, "rar")
+
+    def test_record(self):
+        common.Record(
+            timestamp=datetime.datetime.now(),
+            source=self.source,
+            destination="uuid",
+            file_name="text",
+            checksum="c",
+            ecc_checksum="e",
+            compression=compression.describe("lzma", test.TEST_FILE_CHECKSUM),
+        ).write(common.recordbook_path)
+        (record,) = common.parse_records(common.recordbook_path)
+        self.assertEqual(
+            compression.parse(record.compression), ("lzma", test.TEST_FILE_CHECKSUM)
+        )
+        # records written before the original md5 was kept
+        self.assertEqual(compression.parse("lzma"), ("lzma", ""))
+
+
+if __name__ == "__main__":
+    unittest.main()
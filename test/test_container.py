@@ -0,0 +1,85 @@
+import datetime
+import shutil
+import unittest
+
+import test
+from ltarchiver import check_and_restore, common, container
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.directory = test.TEST_DIRECTORY / "photos"
+        (self.directory / "2020").mkdir(parents=True)
+        (self.directory / "a.txt").write_text("hello world")
+        (self.directory / "2020" / "b.bin").write_bytes(bytes(range(256)) * 10)
+        (self.directory / "empty").write_bytes(b"")
+        self.path = test.TEST_DESTINATION_DIRECTORY / "photos.lta"
+        self.members = container.create(self.directory, self.path)
+
+    def test_index(self):
+        self.assertEqual(
+            [member.name for member in self.members],
+            ["photos/2020/b.bin", "photos/a.txt", "photos/empty"],
+        )
+        self.assertEqual(container.read_index(self.path), self.members)
+        for member in self.members:
+            self.assertEqual(member.offset % common.chunksize, 0)
+        b, a, _ = self.members
+        self.assertEqual(b.chunks(), (0, 3))
+        self.assertEqual(a.ecc_range(), (3 * common.eccsize, common.eccsize))
+
+    def test_extract(self):
+        out = test.TEST_DIRECTORY / "out"
+        self.assertEqual(container.extract(self.path, out), [])
+        for path in ("a.txt", "2020/b.bin", "empty"):
+            self.assertEqual(
+                (out / "photos" / path).read_bytes(),
+                (self.directory / path).read_bytes(),
+            )
+        shutil.rmtree(out)
+        container.extract(self.path, out, ["photos/a.txt"])
+        self.assertEqual(
+            [path.name for path in out.rglob("*") if path.is_file()], ["a.txt"]
+        )
+
+    def test_damaged_member(self):
+        with self.path.open("r+b") as f:
+            f.seek(self.members[1].offset)
+            f.write(b"j")
+        damaged = container.extract(self.path, test.TEST_DIRECTORY / "out")
+        self.assertEqual(damaged, [self.members[1]])
+
+    def test_damaged_index(self):
+        with self.path.open("r+b") as f:
+            f.seek(-container.TRAILER_SIZE - 5, 2)
+            f.write(b"j")
+        with self.assertRaises(common.LTAError):
+            container.read_index(self.path)
+
+    def test_not_a_container(self):
+        with self.assertRaises(common.LTAError):
+            container.read_index(test.TEST_SOURCE_FILE)
+
+    def test_restore_member(self):
+        common.Record(
+            timestamp=datetime.datetime.now(),
+            source=self.directory,
+            destination="uuid",
+            file_name=self.path.name,
+            checksum=common.get_file_checksum(self.path),
+            ecc_checksum="e",
+        ).write(common.recordbook_path)
+        destination = test.TEST_DIRECTORY / "a.txt"
+        check_and_restore.restore_member(
+            self.path.resolve(), "photos/a.txt", destination
+        )
+        self.assertEqual(destination.read_text(), "hello world")
+        with self.assertRaises(common.LTAError):
+            check_and_restore.restore_member(
+                self.path.resolve(), "photos/c.txt", destination
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
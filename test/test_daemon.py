@@ -0,0 +1,114 @@
+import datetime
+import pathlib
+import threading
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import common, daemon, progress
+
+SOCKET_PATH = test.TEST_DIRECTORY / "daemon.sock"
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.server = daemon.make_server(SOCKET_PATH)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        common.warm_cache = None
+
+    def test_ping(self):
+        response = daemon.request("ping", SOCKET_PATH)
+        self.assertEqual(response["status"], "ok")
+        self.assertEqual(response["output"], "pong\n")
+
+    def test_progress_silenced_per_request(self):
+        seen = []
+        token = progress.sink.set(seen.append)
+        try:
+            daemon.execute({"command": "ping"})
+            with progress.Progress("Hashing", 10) as hashing:
+                hashing.update(10)
+        finally:
+            progress.sink.reset(token)
+        self.assertTrue(progress.enabled)
+        self.assertTrue(seen)
+
+    def test_unknown_command(self):
+        response = daemon.request("bogus", SOCKET_PATH)
+        self.assertEqual(response["status"], "error")
+
+    def test_verify_not_in_recordbook(self):
+        test.write_test_recorbook()
+        with mock.patch.object(
+            common,
+            "get_device_uuid_and_root_from_path",
+            return_value=("uuid", test.TEST_DESTINATION_DIRECTORY),
+        ):
+            response = daemon.request(
+                "verify", SOCKET_PATH, path="test_data/other_file"
+            )
+        self.assertEqual(response["status"], "error")
+        self.assertIn("other_file", response["error"])
+
+    def test_interactive_command(self):
+        def prompt(request):
+            common.confirm("Are you sure?")
+
+        def read(request):
+            input()
+
+        daemon.commands.update(prompt=prompt, read=read)
+        try:
+            response = daemon.request("prompt", SOCKET_PATH)
+            self.assertEqual(response["status"], "interactive")
+            # not run again standalone, it may have done something already
+            response = daemon.request("read", SOCKET_PATH)
+            self.assertEqual(response["status"], "error")
+        finally:
+            del daemon.commands["prompt"], daemon.commands["read"]
+
+    def test_verify_picks_the_record_of_the_device(self):
+        for uuid in ("other-uuid", "uuid"):
+            common.Record(
+                timestamp=datetime.datetime.now(),
+                source=test.TEST_SOURCE_FILE,
+                destination=uuid,
+                file_name=test.TEST_DESTINATION_FILE.name,
+                checksum=test.TEST_FILE_CHECKSUM,
+                ecc_checksum="e",
+            ).write(common.recordbook_path)
+
+        def get_validation(record):
+            self.assertEqual(record.destination, "uuid")
+            return common.Validation.VALID
+
+        with mock.patch.object(
+            common,
+            "get_device_uuid_and_root_from_path",
+            return_value=("uuid", test.TEST_DESTINATION_DIRECTORY),
+        ), mock.patch.object(common.Record, "get_validation", get_validation):
+            response = daemon.execute(
+                {"command": "verify", "path": str(test.TEST_DESTINATION_FILE)}
+            )
+        self.assertEqual(response["status"], "ok", response["error"])
+
+    def test_no_daemon(self):
+        self.assertIsNone(daemon.request("ping", pathlib.Path("test_data/nothing")))
+
+    def test_records_cache(self):
+        test.write_test_recorbook()
+        first = list(common.get_records(common.recordbook_path))
+        self.assertIs(list(common.get_records(common.recordbook_path))[0], first[0])
+        first[0].write(common.recordbook_path)
+        self.assertEqual(len(list(common.get_records(common.recordbook_path))), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
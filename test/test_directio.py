@@ -0,0 +1,59 @@
+import os
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import common, directio, pipeline
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.path = test.TEST_DIRECTORY / "data"
+        self.data = os.urandom(3 * 4096 + 17)
+        self.path.write_bytes(self.data)
+
+    def tearDown(self) -> None:
+        directio.enabled = False
+
+    def read(self, offset: int = 0) -> bytes:
+        blocks = []
+        with directio.Reader(self.path) as reader:
+            reader.seek(offset)
+            pipeline.run(reader, compute=[lambda block: blocks.append(bytes(block))])
+        return b"".join(blocks)
+
+    def test_cached(self):
+        self.assertEqual(self.read(), self.data)
+
+    def test_direct(self):
+        directio.enabled = True
+        with directio.Reader(self.path) as reader:
+            self.assertTrue(reader.direct)
+        self.assertEqual(self.read(), self.data)
+
+    def test_direct_unaligned_seek(self):
+        directio.enabled = True
+        self.assertEqual(self.read(5), self.data[5:])
+
+    def test_direct_unsupported(self):
+        directio.enabled = True
+        with mock.patch.object(directio, "_open_direct", return_value=None):
+            self.assertEqual(self.read(), self.data)
+
+    def test_checksum(self):
+        directio.enabled = True
+        self.assertEqual(
+            common.get_file_checksum(test.TEST_SOURCE_FILE), test.TEST_FILE_CHECKSUM
+        )
+
+    def test_copy_with_checksum(self):
+        directio.enabled = True
+        copy = test.TEST_DIRECTORY / "copy"
+        checksum = common.copy_with_checksum(test.TEST_SOURCE_FILE, copy)
+        self.assertEqual(checksum, test.TEST_FILE_CHECKSUM)
+        self.assertEqual(copy.read_text(), "hello world")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import datetime
+import os
+import shutil
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import common, erasure
+
+K, M = 3, 2
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        patcher = mock.patch.object(erasure, "unit_size", 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.source = test.TEST_DIRECTORY / "image"
+        self.data = os.urandom(10 * 1024 + 17)
+        self.source.write_bytes(self.data)
+        self.shards_dir = test.TEST_DIRECTORY / "shards"
+        self.shards_dir.mkdir()
+        self.stripe, self.paths = erasure.split(self.source, self.shards_dir, K, M)
+        self.checksums = {
+            index: common.get_file_checksum(path)
+            for index, path in enumerate(self.paths)
+        }
+        self.destination = test.TEST_DIRECTORY / "joined"
+
+    def join(self, indexes) -> list:
+        shards = {index: self.paths[index] for index in indexes}
+        return erasure.join(self.stripe, shards, self.checksums, self.destination)
+
+    def test_split(self):
+        self.assertEqual(self.stripe.size, len(self.data))
+        self.assertEqual(self.stripe.checksum, common.get_file_checksum(self.source))
+        # 4 rows of 3 units
+        self.assertEqual({path.stat().st_size for path in self.paths}, {4 * 1024})
+
+    def test_shard_size(self):
+        self.assertEqual(erasure.shard_size(len(self.data), K), 4 * 1024)
+        self.assertEqual(erasure.shard_size(3 * 1024, K), 1024)
+        self.assertEqual(erasure.shard_size(0, K), 1024)
+
+    def test_store_without_space(self):
+        destinations = [test.TEST_DIRECTORY / f"device{i}" for i in range(K + M)]
+        with mock.patch.object(
+            erasure.shutil, "disk_usage", return_value=mock.Mock(free=0)
+        ), mock.patch.object(erasure, "split") as split:
+            with self.assertRaises(common.LTAError):
+                erasure.store_striped(self.source, destinations, M)
+        split.assert_not_called()
+
+    def test_join_from_any_shards(self):
+        for indexes in ([0, 1, 2], [2, 3, 4], [0, 3, 4], [1, 2, 3, 4]):
+            self.assertEqual(self.join(indexes), [])
+            self.assertEqual(self.destination.read_bytes(), self.data)
+        with self.assertRaises(common.LTAError):
+            self.join([0, 4])
+
+    def test_damaged_shard(self):
+        with self.paths[1].open("r+b") as f:
+            f.write(b"junk")
+        self.assertEqual(self.join([0, 1, 2]), [1])
+
+    def test_rebuild_shard(self):
+        rebuilt = test.TEST_DIRECTORY / "rebuilt"
+        for index in (1, 4):
+            others = {i: path for i, path in enumerate(self.paths) if i != index}
+            erasure.rebuild_shard(self.stripe, others, self.checksums, index, rebuilt)
+            self.assertEqual(rebuilt.read_bytes(), self.paths[index].read_bytes())
+
+    def test_restore_striped(self):
+        devices = []
+        for index, path in enumerate(self.paths):
+            device = test.TEST_DIRECTORY / f"device{index}"
+            device.mkdir()
+            shutil.copy(path, device)
+            devices.append(device)
+            common.Record(
+                timestamp=datetime.datetime.now(),
+                source=path,
+                destination=f"uuid{index}",
+                file_name=path.name,
+                checksum=self.checksums[index],
+                ecc_checksum="e",
+                stripe=self.stripe.shard(index).format(),
+            ).write(common.recordbook_path)
+        (record,) = [
+            record
+            for record in common.get_records(common.recordbook_path)
+            if record.stripe and erasure.Stripe.parse(record.stripe).index == 2
+        ]
+        self.assertEqual(erasure.striped_name(record), "image")
+        # device 0 is lost and the shard on device 1 rotted
+        with (devices[1] / self.paths[1].name).open("r+b") as f:
+            f.write(b"junk")
+
+        def root_from_uuid(uuid):
+            if uuid == "uuid0":
+                raise AttributeError("not connected")
+            return devices[int(uuid[4:])]
+
+        with mock.patch.object(common, "get_root_from_uuid", root_from_uuid):
+            erasure.restore_striped("image", self.destination)
+        self.assertEqual(self.destination.read_bytes(), self.data)
+
+    def test_stripe_format(self):
+        self.assertEqual(
+            erasure.Stripe.parse(self.stripe.shard(3).format()), self.stripe.shard(3)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
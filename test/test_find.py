@@ -0,0 +1,119 @@
+import contextlib
+import dataclasses
+import datetime
+import pathlib
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import common, find, verify
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.records = [
+            common.Record(
+                timestamp=datetime.datetime(2020, month, 1),
+                source=pathlib.Path(f"/home/user/{directory}/{name}"),
+                destination=device,
+                file_name=name,
+                checksum=f"{month:032x}",
+                ecc_checksum="e",
+            )
+            for month, directory, name, device in (
+                (1, "photos", "beach.jpg", "uuid1"),
+                (2, "photos", "bean.jpg", "uuid2"),
+                (3, "music", "beans.mp3", "uuid1"),
+                (4, "photos", "cat.png", "uuid2"),
+            )
+        ]
+        for record in self.records:
+            record.write(common.recordbook_path)
+
+    def find(self, **conditions):
+        with contextlib.closing(find.open_catalog()) as connection:
+            return [r.file_name for r in find.find(connection, **conditions)]
+
+    def test_find(self):
+        self.assertEqual(self.find(), ["beach.jpg", "bean.jpg", "beans.mp3", "cat.png"])
+        self.assertEqual(self.find(name="bea*"), ["beach.jpg", "bean.jpg", "beans.mp3"])
+        self.assertEqual(self.find(name="*.jpg"), ["beach.jpg", "bean.jpg"])
+        self.assertEqual(self.find(name="BEA*"), [])
+        self.assertEqual(self.find(name="/home/user/music/*"), ["beans.mp3"])
+        self.assertEqual(self.find(checksum=f"{4:032x}"), ["cat.png"])
+        self.assertEqual(self.find(device="uuid1"), ["beach.jpg", "beans.mp3"])
+        self.assertEqual(self.find(name="bea*", device="uuid2"), ["bean.jpg"])
+        self.assertEqual(
+            self.find(
+                since=find.parse_date("2020-02-01"), until=find.parse_date("2020-04-01")
+            ),
+            ["bean.jpg", "beans.mp3"],
+        )
+
+    def test_round_trip(self):
+        record = dataclasses.replace(
+            self.records[0], holes=((0, 4096),), compression="lzma", generation=3
+        )
+        record.write(common.recordbook_path)
+        with contextlib.closing(find.open_catalog()) as connection:
+            (found,) = find.find(connection, name="beach.jpg")
+        self.assertEqual(dataclasses.astuple(found), dataclasses.astuple(record))
+
+    def test_catalog_follows_the_recordbook(self):
+        self.assertEqual(self.find(name="cat.png"), ["cat.png"])
+        # a deletion is a new record of the same file
+        deleted = dataclasses.replace(self.records[3], deleted=True)
+        deleted.write(common.recordbook_path)
+        self.assertEqual(self.find(name="cat.png"), [])
+        self.assertEqual(self.find(name="cat.png", deleted=True), ["cat.png"])
+
+    def test_catalog_updated_with_new_generations(self):
+        header = common.RecordbookHeader(1)
+        records = [dataclasses.replace(record, generation=1) for record in self.records]
+        common.write_records(common.recordbook_path, header, records)
+        self.assertEqual(len(self.find()), 4)
+        header.generation = 2
+        stored = dataclasses.replace(
+            records[0],
+            timestamp=datetime.datetime(2020, 5, 1),
+            file_name="dog.png",
+            checksum="d",
+            generation=2,
+        )
+        common.write_recordbook_header(common.recordbook_path, header, [stored])
+        header.generation = 3
+        records[3] = dataclasses.replace(records[3], deleted=True, generation=3)
+        common.write_records(common.recordbook_path, header, records + [stored])
+        with mock.patch.object(find, "build", side_effect=AssertionError):
+            self.assertEqual(
+                self.find(), ["beach.jpg", "bean.jpg", "beans.mp3", "dog.png"]
+            )
+            self.assertEqual(self.find(name="cat.png", deleted=True), ["cat.png"])
+
+    def test_damaged_catalog(self):
+        find.open_catalog().close()
+        find.catalog_path.write_bytes(b"junk")
+        self.assertEqual(self.find(name="cat.png"), ["cat.png"])
+
+    def test_bad_date(self):
+        with self.assertRaises(common.LTAError):
+            find.parse_date("yesterday")
+
+    def test_mounted(self):
+        def root_from_uuid(uuid):
+            if uuid == "uuid2":
+                raise AttributeError("not connected")
+            return pathlib.Path("/media/archive")
+
+        with mock.patch.object(common, "get_root_from_uuid", root_from_uuid):
+            roots = verify.DeviceRoots()
+            descriptions = [
+                find.describe(record, roots) for record in self.records[:2]
+            ]
+        self.assertEqual(descriptions[0]["mounted"], "/media/archive")
+        self.assertIsNone(descriptions[1]["mounted"])
+
+
+if __name__ == "__main__":
+    unittest.main()
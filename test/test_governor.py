@@ -0,0 +1,40 @@
+import time
+import unittest
+
+import test
+from ltarchiver import common, governor
+
+
+class MyTestCase(test.BaseTestCase):
+    def tearDown(self) -> None:
+        governor.current = None
+
+    def test_ops_limit(self):
+        limited = governor.Governor(max_ops_per_second=50)
+        start = time.monotonic()
+        for _ in range(10):
+            limited.throttle(1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    def test_bandwidth_limit(self):
+        limited = governor.Governor(max_bytes_per_second=1000)
+        start = time.monotonic()
+        limited.throttle(100)
+        limited.throttle(100)
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    def test_unlimited(self):
+        start = time.monotonic()
+        for _ in range(1000):
+            governor.Governor().throttle(1024**3)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_checksum_in_background_mode(self):
+        governor.configure(max_mb_per_second=100)
+        self.assertEqual(
+            common.get_file_checksum(test.TEST_SOURCE_FILE), test.TEST_FILE_CHECKSUM
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
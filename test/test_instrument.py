@@ -0,0 +1,57 @@
+import contextlib
+import io
+import json
+import pstats
+import unittest
+
+import test
+from ltarchiver import instrument
+
+
+class MyTestCase(test.BaseTestCase):
+    def run_session(self, **kwargs):
+        with contextlib.redirect_stderr(io.StringIO()) as report:
+            with instrument.session("store", **kwargs):
+                with instrument.span("hash", 2048):
+                    pass
+                with instrument.span("copy") as span:
+                    span.bytes = 1024
+                with instrument.span("hash", 2048):
+                    pass
+        return report.getvalue()
+
+    def test_span_without_session(self):
+        with instrument.span("hash", 10) as span:
+            pass
+        self.assertEqual(span.bytes, 10)
+        self.assertGreaterEqual(span.seconds, 0)
+        self.assertIsNone(instrument.recorder)
+
+    def test_json_lines(self):
+        path = test.TEST_DIRECTORY / "metrics.jsonl"
+        report = self.run_session(metrics=str(path))
+        spans = [json.loads(line) for line in path.read_text().splitlines()]
+        self.assertEqual([span["phase"] for span in spans], ["hash", "copy", "hash"])
+        self.assertEqual(spans[1]["bytes"], 1024)
+        self.assertEqual(spans[0]["command"], "store")
+        self.assertIn("hash", report)
+        self.assertIsNone(instrument.recorder)
+
+    def test_prometheus(self):
+        path = test.TEST_DIRECTORY / "metrics.prom"
+        self.run_session(metrics=str(path))
+        text = path.read_text()
+        self.assertIn("# TYPE ltarchiver_phase_seconds_total counter", text)
+        self.assertIn(
+            'ltarchiver_phase_bytes_total{command="store",phase="hash"} 4096', text
+        )
+        self.assertIn('ltarchiver_phase_runs_total{command="store",phase="hash"} 2', text)
+
+    def test_profile(self):
+        path = test.TEST_DIRECTORY / "store.prof"
+        self.run_session(profile=str(path))
+        self.assertTrue(pstats.Stats(str(path)).total_calls > 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
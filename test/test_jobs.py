@@ -0,0 +1,93 @@
+import pathlib
+import threading
+import time
+import unittest
+
+import test
+from ltarchiver import common, jobs, store
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.lock = threading.Lock()
+        self.running = {}
+        self.max_running = {}
+        self.stored = []
+        self.checksums = 0
+        self.old_store = store.store
+        self.old_uuid = common.get_device_uuid_and_root_from_path
+        self.old_checksum = common.get_file_checksum
+
+        def fake_store(
+            source, destination, non_interactive, checksum, keep_source, codec=""
+        ):
+            device = destination.parent.name
+            with self.lock:
+                self.running[device] = self.running.get(device, 0) + 1
+                self.max_running[device] = max(
+                    self.max_running.get(device, 0), self.running[device]
+                )
+            time.sleep(0.05)
+            with self.lock:
+                self.running[device] -= 1
+                self.stored.append((source, destination, checksum))
+            if destination.name == "broken":
+                raise common.LTAError("broken destination")
+
+        def fake_uuid(path: pathlib.Path):
+            return path.parent.name, path.parent
+
+        def fake_checksum(source):
+            with self.lock:
+                self.checksums += 1
+            return test.TEST_FILE_CHECKSUM
+
+        store.store = fake_store
+        common.get_device_uuid_and_root_from_path = fake_uuid
+        common.get_file_checksum = fake_checksum
+
+    def tearDown(self) -> None:
+        store.store = self.old_store
+        common.get_device_uuid_and_root_from_path = self.old_uuid
+        common.get_file_checksum = self.old_checksum
+
+    def test_one_writer_per_device(self):
+        destinations = [
+            pathlib.Path("disk1/a"),
+            pathlib.Path("disk1/b"),
+            pathlib.Path("disk2/a"),
+        ]
+        failures = jobs.run_jobs([jobs.Job(test.TEST_SOURCE_FILE, destinations)])
+        self.assertEqual(failures, [])
+        self.assertEqual(len(self.stored), 3)
+        self.assertEqual(self.max_running, {"disk1": 1, "disk2": 1})
+        self.assertEqual(self.checksums, 1)
+        self.assertTrue(test.TEST_SOURCE_FILE.exists())
+
+    def test_devices_written_concurrently(self):
+        destinations = [pathlib.Path(f"disk{i}/a") for i in range(4)]
+        start = time.monotonic()
+        jobs.run_jobs([jobs.Job(test.TEST_SOURCE_FILE, destinations)])
+        self.assertLess(time.monotonic() - start, 0.05 * len(destinations))
+
+    def test_failure_keeps_source(self):
+        destinations = [pathlib.Path("disk1/a"), pathlib.Path("disk2/broken")]
+        failures = jobs.run_jobs(
+            [jobs.Job(test.TEST_SOURCE_FILE, destinations)], remove_sources=True
+        )
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0].destination, destinations[1])
+        self.assertIn("broken destination", str(failures[0]))
+        self.assertTrue(test.TEST_SOURCE_FILE.exists())
+
+    def test_remove_sources(self):
+        jobs.run_jobs(
+            [jobs.Job(test.TEST_SOURCE_FILE, [pathlib.Path("disk1/a")])],
+            remove_sources=True,
+        )
+        self.assertFalse(test.TEST_SOURCE_FILE.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import hashlib
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import common, migrate, transaction
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.metadata_dir = test.TEST_DESTINATION_DIRECTORY / common.METADATA_DIR_NAME
+        self.checksums = [f"{i:02x}" * 16 for i in range(5)]
+        for checksum in self.checksums:
+            path = common.legacy_ecc_file_path(self.metadata_dir, checksum)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(checksum)
+        # not an ECC file
+        (self.metadata_dir / common.ecc_dir_name / "notes.txt").write_text("")
+
+    def test_migrate(self):
+        self.assertEqual(len(migrate.legacy_ecc_files(self.metadata_dir)), 5)
+        self.assertEqual(migrate.migrate(self.metadata_dir, batch=2), 5)
+        for checksum in self.checksums:
+            path = common.find_ecc_file(self.metadata_dir, checksum)
+            self.assertEqual(
+                path, common.sharded_ecc_file_path(self.metadata_dir, checksum)
+            )
+            self.assertEqual(path.read_text(), checksum)
+        self.assertEqual(migrate.legacy_ecc_files(self.metadata_dir), [])
+        self.assertEqual(migrate.migrate(self.metadata_dir), 0)
+        notes = self.metadata_dir / common.ecc_dir_name / "notes.txt"
+        self.assertTrue(notes.exists())
+
+    def test_ecc_file_moved_while_read(self):
+        find_ecc_file = common.find_ecc_file
+
+        def find_then_migrate(metadata_dir, checksum):
+            path = find_ecc_file(metadata_dir, checksum)
+            migrate.migrate(metadata_dir)
+            return path
+
+        checksum = self.checksums[0]
+        with mock.patch.object(common, "find_ecc_file", find_then_migrate):
+            path, md5 = common.hash_ecc_file(self.metadata_dir, checksum)
+        self.assertEqual(
+            path, common.sharded_ecc_file_path(self.metadata_dir, checksum)
+        )
+        self.assertEqual(md5, hashlib.md5(checksum.encode()).hexdigest())
+
+    def test_other_command_running(self):
+        transaction.get_log()  # opened anew, the last one was removed with test_data
+        other = transaction.TransactionLog(transaction.log_path)
+        try:
+            other.begin("delete", record={})
+            with mock.patch.object(transaction, "exclusive_timeout", 0.2):
+                with self.assertRaises(common.LTAError):
+                    migrate.migrate(self.metadata_dir)
+        finally:
+            other.close()
+        self.assertEqual(len(migrate.legacy_ecc_files(self.metadata_dir)), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import datetime
+import os
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import check_and_restore, common, container, packing
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.sources = []
+        for i in range(5):
+            source = (test.TEST_DIRECTORY / f"small_{i}").resolve()
+            source.write_bytes(os.urandom(100 * (i + 1)))
+            self.sources.append(source)
+        self.large = (test.TEST_DIRECTORY / "large").resolve()
+        self.large.write_bytes(os.urandom(5000))
+
+    def test_split_and_group(self):
+        small, large = packing.split(self.sources + [self.large], 1000)
+        self.assertEqual(small, self.sources)
+        self.assertEqual(large, [self.large])
+        with mock.patch.object(packing, "pack_size", 700):
+            groups = packing.group(self.sources)
+        # 100 + 200 + 300, 400, 500
+        self.assertEqual([len(sources) for sources in groups], [3, 1, 1])
+
+    def record_pack(self, pack, checksum="c"):
+        common.Record(
+            timestamp=datetime.datetime.now(),
+            source=pack,
+            destination="uuid",
+            file_name=pack.name,
+            checksum=checksum,
+            ecc_checksum="e",
+        ).write(common.recordbook_path)
+
+    def test_make_packs(self):
+        with mock.patch.object(packing, "pack_size", 700):
+            packs = packing.make_packs(self.sources)
+        self.assertEqual(len(packs), 3)
+        for pack in packs:
+            self.record_pack(pack)
+        members = container.read_index(packs[0])
+        self.assertEqual(members[0].name, self.sources[0].as_posix().lstrip("/"))
+        entry = packing.locate(self.sources[4])
+        self.assertEqual(entry["pack"], packs[2].name)
+        self.assertEqual(entry["checksum"], common.get_file_checksum(self.sources[4]))
+        self.assertIsNone(packing.locate(self.large))
+
+    def test_locate_stored_packs_only(self):
+        (stored,) = packing.make_packs(self.sources)
+        self.record_pack(stored)
+        # packed again but the store failed
+        (failed,) = packing.make_packs(self.sources)
+        self.assertEqual(packing.locate(self.sources[0])["pack"], stored.name)
+        self.record_pack(failed)
+        self.assertEqual(packing.locate(self.sources[0])["pack"], failed.name)
+
+    def test_index_copied_to_device(self):
+        (pack,) = packing.make_packs(self.sources)
+        self.assertTrue(packing.is_pack(pack))
+        self.assertFalse(packing.is_pack(self.large))
+        metadata_dir = test.TEST_DESTINATION_DIRECTORY / common.METADATA_DIR_NAME
+        metadata_dir.mkdir(parents=True)
+        packing.copy_index(metadata_dir)
+        copied = list(packing.read_index(metadata_dir / packing.index_file_name))
+        self.assertEqual(copied, list(packing.read_index()))
+        self.assertEqual(len(copied), len(self.sources))
+
+    def test_restore_packed(self):
+        (pack,) = packing.make_packs(self.sources)
+        stored = test.TEST_DESTINATION_DIRECTORY / pack.name
+        os.replace(pack, stored)
+        self.record_pack(pack, common.get_file_checksum(stored))
+        destination = test.TEST_DIRECTORY / "restored"
+        entry = packing.locate(self.sources[2])
+        with mock.patch.object(
+            common,
+            "get_root_from_uuid",
+            return_value=test.TEST_DESTINATION_DIRECTORY.resolve(),
+        ):
+            check_and_restore.restore_packed(entry, destination)
+        self.assertEqual(destination.read_bytes(), self.sources[2].read_bytes())
+        with mock.patch.object(
+            common, "get_root_from_uuid", side_effect=AttributeError
+        ), self.assertRaises(common.LTAError):
+            check_and_restore.restore_packed(entry, destination)
+
+
+if __name__ == "__main__":
+    unittest.main()
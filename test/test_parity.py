@@ -0,0 +1,67 @@
+import os
+import unittest
+
+import test
+from ltarchiver import common, parity
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.path = common.recordbook_path
+        self.data = os.urandom(40 * parity.block_size + 123)
+        self.path.write_bytes(self.data)
+        common.write_recordbook_checksum(
+            self.path, common.recordbook_checksum_file_path
+        )
+
+    def damage(self, *offsets: int):
+        data = bytearray(self.path.read_bytes())
+        for offset in offsets:
+            data[offset] ^= 0xFF
+        self.path.write_bytes(data)
+
+    def test_intact(self):
+        self.assertEqual(parity.repair(self.path), parity.Status.INTACT)
+
+    def test_repair(self):
+        block = parity.block_size
+        # as many damaged blocks as there is parity in the first stripe
+        self.damage(0, block + 1, 2 * block + 2, 31 * block, len(self.data) - 1)
+        self.assertEqual(parity.repair(self.path), parity.Status.REPAIRED)
+        self.assertEqual(self.path.read_bytes(), self.data)
+
+    def test_truncated(self):
+        self.path.write_bytes(self.data[: -parity.block_size])
+        self.assertEqual(parity.repair(self.path), parity.Status.REPAIRED)
+        self.assertEqual(self.path.read_bytes(), self.data)
+
+    def test_too_damaged(self):
+        self.damage(*(i * parity.block_size for i in range(parity.parity_blocks + 1)))
+        self.assertEqual(parity.repair(self.path), parity.Status.UNREPAIRABLE)
+
+    def test_stale(self):
+        self.damage(0)
+        self.assertEqual(parity.repair(self.path, "0" * 32), parity.Status.STALE)
+
+    def test_no_parity(self):
+        os.remove(parity.parity_path(self.path))
+        self.assertEqual(parity.repair(self.path), parity.Status.NO_PARITY)
+
+    def test_check_recordbook_md5_repairs(self):
+        self.damage(100)
+        common.check_recordbook_md5(common.recordbook_checksum_file_path)
+        self.assertEqual(self.path.read_bytes(), self.data)
+
+    def test_damaged_parity_header(self):
+        parity_path = parity.parity_path(self.path)
+        content = bytearray(parity_path.read_bytes())
+        content[30] ^= 0xFF
+        parity_path.write_bytes(content)
+        self.damage(0)
+        with self.assertRaises(common.LTAError):
+            common.check_recordbook_md5(common.recordbook_checksum_file_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
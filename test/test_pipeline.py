@@ -0,0 +1,53 @@
+import hashlib
+import os
+import unittest
+
+import test
+from ltarchiver import directio, pipeline
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.path = test.TEST_DIRECTORY / "data"
+        self.data = os.urandom(100 * 1000 + 7)
+        self.path.write_bytes(self.data)
+
+    def test_copy(self):
+        written = []
+        md5 = hashlib.md5()
+        with directio.Reader(self.path) as reader:
+            total = pipeline.run(
+                reader,
+                write=lambda block: written.append(bytes(block)),
+                compute=[md5.update],
+                size=1000,
+            )
+        self.assertEqual(total, len(self.data))
+        self.assertEqual(b"".join(written), self.data)
+        self.assertEqual(md5.hexdigest(), hashlib.md5(self.data).hexdigest())
+
+    def test_empty_file(self):
+        self.path.write_bytes(b"")
+        with directio.Reader(self.path) as reader:
+            self.assertEqual(pipeline.run(reader, write=lambda block: None), 0)
+
+    def test_writer_error(self):
+        def write(block):
+            raise OSError("disk full")
+
+        with directio.Reader(self.path) as reader:
+            with self.assertRaisesRegex(OSError, "disk full"):
+                pipeline.run(reader, write=write, size=1000)
+
+    def test_compute_error(self):
+        def compute(block):
+            raise ValueError("bad block")
+
+        with directio.Reader(self.path) as reader:
+            with self.assertRaisesRegex(ValueError, "bad block"):
+                pipeline.run(reader, write=lambda block: None, compute=[compute])
+
+
+if __name__ == "__main__":
+    unittest.main()
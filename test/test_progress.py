@@ -0,0 +1,70 @@
+import io
+import threading
+import time
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import progress
+
+
+class MyTestCase(test.BaseTestCase):
+    def test_quiet_before_delay(self):
+        stream = io.StringIO()
+        with progress.Progress("Hashing", 100, stream) as hashing:
+            hashing.advance(50)
+        self.assertEqual(stream.getvalue(), "")
+
+    def test_rate_limited_lines(self):
+        stream = io.StringIO()
+        with mock.patch.object(progress, "delay", 0):
+            with progress.Progress("Hashing", 100, stream) as hashing:
+                hashing.advance(50)
+                hashing.advance(25)
+        lines = stream.getvalue().splitlines()
+        # the second update comes before log_interval so only the final line follows
+        self.assertEqual(len(lines), 2)
+        self.assertIn("Hashing: 50.0 B of 100.0 B (50%)", lines[0])
+        self.assertIn("ETA", lines[0])
+        self.assertIn("Hashing: 75.0 B in", lines[1])
+
+    def test_stall(self):
+        stream = io.StringIO()
+        with mock.patch.object(progress, "delay", 0), mock.patch.object(
+            progress, "stall_after", 0
+        ):
+            progress.Progress("Encoding", 100, stream).update(0)
+        self.assertIn("no progress for", stream.getvalue())
+
+    def test_stall_without_updates(self):
+        stream = io.StringIO()
+        with mock.patch.object(progress, "delay", 0), mock.patch.object(
+            progress, "stall_after", 0
+        ), mock.patch.object(progress, "tty_interval", 0.01), mock.patch.object(
+            progress, "min_total", 0
+        ):
+            with progress.Progress("Hashing", 100, stream):
+                # a read that hangs reports nothing
+                time.sleep(0.1)
+        self.assertIn("no progress for", stream.getvalue())
+
+    def test_one_thread_for_every_progress(self):
+        with progress.Progress("Hashing", 2 * progress.min_total):
+            threads = threading.active_count()
+            for _ in range(10):
+                with progress.Progress("Hashing", 2 * progress.min_total):
+                    pass
+                with progress.Progress("Hashing", 100):
+                    self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(len(progress._redrawn.progresses), 0)
+
+    def test_watch_files(self):
+        path = test.TEST_DIRECTORY / "growing"
+        path.write_bytes(b"x" * 10)
+        with progress.watch_files("Storing", [path], 20, poll_interval=0.01) as storing:
+            path.write_bytes(b"x" * 20)
+        self.assertEqual(storing.done, 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
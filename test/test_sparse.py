@@ -0,0 +1,113 @@
+import datetime
+import hashlib
+import os
+import pathlib
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import common, sparse, transaction
+
+MiB = 1024 * 1024
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.path = test.TEST_DIRECTORY / "image"
+        with self.path.open("wb") as f:
+            f.write(b"a" * 5000)
+            f.seek(3 * MiB)
+            f.write(b"b" * 100)
+            f.truncate(8 * MiB)
+        self.holes = sparse.find_holes(self.path)
+        if not self.holes:
+            self.skipTest("the file system doesn't report holes")
+
+    def test_find_holes(self):
+        self.assertEqual(self.holes[-1][0] + self.holes[-1][1], 8 * MiB)
+        ranges = sparse.data_ranges(8 * MiB, self.holes)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertLessEqual(ranges[1][0], 3 * MiB)
+        self.assertGreaterEqual(sum(ranges[1]), 3 * MiB + 100)
+
+    def test_format(self):
+        self.assertEqual(
+            sparse.parse_holes(sparse.format_holes(self.holes)), self.holes
+        )
+
+    def test_copy_keeps_holes(self):
+        copy = test.TEST_DIRECTORY / "copy"
+        checksum = common.copy_with_checksum(self.path, copy)
+        self.assertEqual(checksum, hashlib.md5(self.path.read_bytes()).hexdigest())
+        self.assertEqual(copy.read_bytes(), self.path.read_bytes())
+        self.assertLess(os.stat(copy).st_blocks * 512, MiB)
+
+    def test_pack_and_unpack(self):
+        packed = test.TEST_DIRECTORY / "packed"
+        sparse.pack(self.path, self.holes, packed)
+        self.assertLess(packed.stat().st_size, MiB)
+        unpacked = test.TEST_DIRECTORY / "unpacked"
+        sparse.unpack(packed, unpacked, self.holes, 8 * MiB)
+        self.assertEqual(unpacked.read_bytes(), self.path.read_bytes())
+
+    def test_ecc_streamed_without_holes(self):
+        def program(arguments):
+            # copies its input to its output, like the encoder and the decoder
+            *_, source, destination, ecc = arguments[:4]
+            with open(source, "rb") as f, open(destination, "wb") as out:
+                out.write(f.read())
+            if len(arguments) == 5:
+                pathlib.Path(arguments[4]).write_bytes(pathlib.Path(ecc).read_bytes())
+            else:
+                pathlib.Path(ecc).write_text("ecc")
+
+        packed = test.TEST_DIRECTORY / "packed"
+        sparse.pack(self.path, self.holes, packed)
+        ecc = test.TEST_DIRECTORY / "ecc"
+        repaired = test.TEST_DIRECTORY / "repaired"
+        before = sorted(common.recordbook_dir.iterdir())
+        with mock.patch.object(common.subprocess, "check_call", program):
+            common.encode_ecc(self.path, ecc, self.holes)
+            common.decode_ecc(
+                self.path, repaired, ecc, test.TEST_DIRECTORY / "new", self.holes
+            )
+        self.assertEqual(repaired.read_bytes(), self.path.read_bytes())
+        self.assertLess(os.stat(repaired).st_blocks * 512, MiB)
+        # nothing was written next to the recordbook
+        self.assertEqual(sorted(common.recordbook_dir.iterdir()), before)
+
+    def test_encoder_not_reading(self):
+        with mock.patch.object(common.subprocess, "check_call"):
+            with self.assertRaises((OSError, common.LTAError)):
+                common.encode_ecc(self.path, test.TEST_DIRECTORY / "ecc", self.holes)
+
+    def test_record(self):
+        record = common.Record(
+            timestamp=datetime.datetime.now(),
+            source=self.path,
+            destination="uuid",
+            file_name="image",
+            checksum="c",
+            ecc_checksum="e",
+            holes=self.holes,
+        )
+        record.write(common.recordbook_path)
+        dense = common.Record(
+            timestamp=datetime.datetime.now(),
+            source=self.path,
+            destination="uuid",
+            file_name="dense",
+            checksum="d",
+            ecc_checksum="e",
+        )
+        dense.write(common.recordbook_path)
+        records = list(common.parse_records(common.recordbook_path))
+        self.assertEqual([record.holes for record in records], [self.holes, ()])
+        self.assertEqual(
+            transaction.record_from_dict(transaction.record_to_dict(record)), record
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
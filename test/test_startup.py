@@ -0,0 +1,51 @@
+import subprocess
+import sys
+import typing
+import unittest
+
+import test
+
+COMMANDS = [
+    "ltarchiver.store",
+    "ltarchiver.check_and_restore",
+    "ltarchiver.refresh_device",
+    "ltarchiver.verify",
+]
+# only needed by some runs of a command, imported when they happen
+LAZY = ["psutil", "yesno", "asyncio", "cProfile", "socketserver", "ltarchiver.jobs"]
+BUDGET = 0.5  # seconds to import a command, generous to stay clear of noise
+
+
+def import_times(module: str) -> typing.Dict[str, float]:
+    """Cumulative import time in seconds of every module imported by module."""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative) / 1_000_000
+    return times
+
+
+class MyTestCase(test.BaseTestCase):
+    def test_heavy_modules_are_lazy(self):
+        for command in COMMANDS:
+            times = import_times(command)
+            for module in LAZY:
+                with self.subTest(command=command, module=module):
+                    self.assertNotIn(module, times)
+
+    def test_budget(self):
+        for command in COMMANDS:
+            with self.subTest(command=command):
+                self.assertLess(import_times(command)[command], BUDGET)
+
+
+if __name__ == "__main__":
+    unittest.main()
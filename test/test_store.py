@@ -1,6 +1,11 @@
+import dataclasses
+import datetime
+import hashlib
 import pathlib
+import shutil
 import subprocess
 import unittest
+from unittest import mock
 
 import test
 from ltarchiver import common, store
@@ -43,6 +48,52 @@ class MyTestCase(test.BaseTestCase):
             "bogus md5", "bogus name", pathlib.Path("test_data/bogus_file")
         )  # test that no error is raised
 
+    def test_file_compressed_in_recordbook(self):
+        common.Record(
+            timestamp=datetime.datetime.now(),
+            source=TEST_SOURCE_FILE,
+            destination="uuid",
+            file_name="compressed",
+            checksum="compressed md5",
+            ecc_checksum="e",
+            compression=f"lzma:{TEST_FILE_CHECKSUM}",
+        ).write(common.recordbook_path)
+        stored = test.TEST_DESTINATION_DIRECTORY / "compressed"
+        stored.write_bytes(b"xz")
+        with self.assertRaises(common.LTAError):
+            store.file_not_exists_in_recordbook(TEST_FILE_CHECKSUM, "other", stored)
+
+    def test_store_compressed_encodes_while_compressing(self):
+        def encoder(arguments):
+            _, source, _, ecc = arguments
+            with open(source, "rb") as f:
+                pathlib.Path(ecc).write_bytes(f.read())
+
+        partial = test.TEST_DESTINATION_DIRECTORY / "test_source.part"
+        ecc = test.TEST_DIRECTORY / "ecc"
+        with mock.patch.object(common.subprocess, "check_call", encoder):
+            md5, compressed_as = store.store_compressed(
+                TEST_SOURCE_FILE, TEST_FILE_CHECKSUM, partial, ecc, "lzma"
+            )
+        # the encoder was given what was written to the partial file
+        self.assertEqual(ecc.read_bytes(), partial.read_bytes())
+        self.assertEqual(md5, common.get_file_checksum(partial))
+        self.assertEqual(compressed_as, f"lzma:{TEST_FILE_CHECKSUM}")
+
+    def test_file_not_exists_on_other_device(self):
+        write_test_recorbook(common.recordbook_path)
+        store.file_not_exists_in_recordbook(
+            TEST_FILE_CHECKSUM, TEST_SOURCE_FILE.name, TEST_SOURCE_FILE, "other uuid"
+        )  # test that no error is raised
+        self.assertRaises(
+            common.LTAError,
+            store.file_not_exists_in_recordbook,
+            TEST_FILE_CHECKSUM,
+            TEST_SOURCE_FILE.name,
+            TEST_SOURCE_FILE,
+            str(test.TEST_DESTINATION_DIRECTORY.absolute()),
+        )
+
     def test_check_recordbook_file_not_found(self):
         remove_file(common.recordbook_checksum_file_path)
         self.assertRaises(
@@ -77,6 +128,129 @@ class MyTestCase(test.BaseTestCase):
             common.recordbook_checksum_file_path,
         )
 
+    def test_sync_recordbooks_home_ahead(self):
+        metadata_dir = test.TEST_DESTINATION_DIRECTORY / common.METADATA_DIR_NAME
+        device_recordbook = metadata_dir / common.recordbook_file_name
+        device_checksum = metadata_dir / "checksum.txt"
+        metadata_dir.mkdir(parents=True)
+        header = common.RecordbookHeader(1, {"uuid": 1})
+        write_test_recorbook(common.recordbook_path)
+        common.write_recordbook_header(common.recordbook_path, header)
+        shutil.copy(common.recordbook_path, device_recordbook)
+        common.write_recordbook_checksum(device_recordbook, device_checksum)
+        record = list(common.get_records(common.recordbook_path))[0]
+        new_record = dataclasses.replace(
+            record, file_name="other_file", checksum="1234", generation=2
+        )
+        new_record.write(common.recordbook_path)
+        header.generation = 2
+        common.write_recordbook_header(common.recordbook_path, header)
+        common.write_recordbook_checksum(
+            common.recordbook_path, common.recordbook_checksum_file_path
+        )
+        # new records are appended, the records of the device aren't rewritten
+        with mock.patch.object(common, "write_records", side_effect=AssertionError):
+            store.sync_recordbooks(metadata_dir, "uuid")
+        device_records = list(common.get_records(device_recordbook))
+        self.assertEqual(len(device_records), 2)
+        self.assertEqual(device_records[1].file_name, new_record.file_name)
+        self.assertEqual(device_records[1].checksum, new_record.checksum)
+        self.assertEqual(device_records[1].generation, 2)
+        self.assertEqual(
+            common.read_recordbook_header(device_recordbook),
+            common.RecordbookHeader(2, {"uuid": 2}),
+        )
+        self.assertEqual(
+            common.read_recordbook_header(common.recordbook_path),
+            common.RecordbookHeader(2, {"uuid": 2}),
+        )
+        common.check_recordbook_md5(device_checksum)
+        common.check_recordbook_md5(common.recordbook_checksum_file_path)
+
+    def test_sync_recordbooks_in_sync(self):
+        metadata_dir = test.TEST_DESTINATION_DIRECTORY / common.METADATA_DIR_NAME
+        device_recordbook = metadata_dir / common.recordbook_file_name
+        metadata_dir.mkdir(parents=True)
+        write_test_recorbook(common.recordbook_path)
+        common.write_recordbook_header(
+            common.recordbook_path, common.RecordbookHeader(1, {"uuid": 1})
+        )
+        shutil.copy(common.recordbook_path, device_recordbook)
+        # the checksum files are not even looked at when the generations agree
+        store.sync_recordbooks(metadata_dir, "uuid")
+        self.assertEqual(
+            device_recordbook.read_text(), common.recordbook_path.read_text()
+        )
+
+    def make_checkpoint(self, partial_content: bytes, offset: int):
+        content = TEST_SOURCE_FILE.read_bytes()
+        checkpoint = store.StoreCheckpoint.start(
+            TEST_SOURCE_FILE, TEST_FILE_CHECKSUM, test.TEST_DESTINATION_FILE
+        )
+        checkpoint.partial_file.write_bytes(partial_content)
+        checkpoint.offset = offset
+        checkpoint.tail_size = 4
+        checkpoint.tail_checksum = hashlib.md5(
+            content[offset - 4 : offset]
+        ).hexdigest()
+        return checkpoint
+
+    def test_resumable_copy(self):
+        checkpoint_path = test.TEST_DIRECTORY / "checkpoint.txt"
+        old_block_size = store.copy_block_size
+        old_interval = store.checkpoint_interval
+        store.copy_block_size = 4
+        store.checkpoint_interval = 4
+        try:
+            checkpoint = self.make_checkpoint(b"hellXXXXXXXXXX", 4)
+            store.resumable_copy(checkpoint, checkpoint_path)
+            self.assertEqual(checkpoint.partial_file.read_text(), "hello world")
+            self.assertEqual(checkpoint.offset, 11)
+            saved = store.StoreCheckpoint.read(checkpoint_path)
+            self.assertEqual(saved.offset, 8)
+            self.assertTrue(saved.tail_is_intact())
+            self.assertTrue(saved.matches(TEST_SOURCE_FILE))
+        finally:
+            store.copy_block_size = old_block_size
+            store.checkpoint_interval = old_interval
+
+    def test_resumable_copy_bad_tail(self):
+        checkpoint_path = test.TEST_DIRECTORY / "checkpoint.txt"
+        checkpoint = self.make_checkpoint(b"hellXXXXXX", 8)
+        self.assertFalse(checkpoint.tail_is_intact())
+        store.resumable_copy(checkpoint, checkpoint_path)
+        self.assertEqual(checkpoint.partial_file.read_text(), "hello world")
+
+    def test_store_resumably_damaged_partial_file(self):
+        checkpoint_path = test.TEST_DIRECTORY / "checkpoint.txt"
+        ecc_file_path = test.TEST_DIRECTORY / "ecc"
+        # the tail is intact but the start of the partial file isn't
+        checkpoint = self.make_checkpoint(b"jello wo", 8)
+        with mock.patch.object(common, "encode_ecc") as encode_ecc:
+            store.store_resumably(checkpoint, checkpoint_path, ecc_file_path)
+        self.assertEqual(checkpoint.partial_file.read_text(), "hello world")
+        encode_ecc.assert_called_once()
+        self.assertTrue(checkpoint.encoded)
+
+    def test_store_resumably_changed_source(self):
+        checkpoint_path = test.TEST_DIRECTORY / "checkpoint.txt"
+        checkpoint = self.make_checkpoint(b"hello wo", 8)
+        checkpoint.checksum = "0" * 32
+        with mock.patch.object(common, "encode_ecc") as encode_ecc:
+            with self.assertRaises(common.LTAError):
+                store.store_resumably(
+                    checkpoint, checkpoint_path, test.TEST_DIRECTORY / "ecc"
+                )
+        encode_ecc.assert_not_called()
+
+    def test_checkpoint_changed_source(self):
+        checkpoint_path = test.TEST_DIRECTORY / "checkpoint.txt"
+        checkpoint = self.make_checkpoint(b"hello wo", 8)
+        checkpoint.write(checkpoint_path)
+        self.assertEqual(store.StoreCheckpoint.read(checkpoint_path), checkpoint)
+        TEST_SOURCE_FILE.write_text("hello world, again")
+        self.assertFalse(checkpoint.matches(TEST_SOURCE_FILE))
+
     def test_tar_archive(self):
         mydir = test.TEST_DIRECTORY / "mydir"
         mydir.mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,148 @@
+import datetime
+import unittest
+
+import test
+from ltarchiver import common, store, transaction
+
+LOG_PATH = test.TEST_DIRECTORY / "transactions.log"
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.log = transaction.TransactionLog(LOG_PATH)
+        self.metadata_dir = test.TEST_DESTINATION_DIRECTORY / common.METADATA_DIR_NAME
+        self.ecc_file = self.metadata_dir / common.ecc_dir_name / test.TEST_FILE_CHECKSUM
+        self.ecc_file.parent.mkdir(parents=True)
+        self.partial_file = test.TEST_DESTINATION_DIRECTORY / "test_source.part"
+        self.record = common.Record(
+            timestamp=datetime.datetime.now(),
+            source=test.TEST_SOURCE_FILE,
+            destination="uuid",
+            file_name=test.TEST_SOURCE_FILE.name,
+            checksum=test.TEST_FILE_CHECKSUM,
+            ecc_checksum=test.TEST_ECC_CHECKSUM,
+        )
+
+    def tearDown(self) -> None:
+        self.log.close()
+
+    def crash_and_recover(self) -> int:
+        self.log.close()
+        self.log = transaction.TransactionLog(LOG_PATH)
+        return self.log.recover()
+
+    def begin_store(self, ecc_existed: bool = False) -> transaction.Transaction:
+        self.partial_file.write_text("hello world")
+        self.ecc_file.write_text("ecc")
+        return self.log.begin(
+            "store",
+            partial_file=str(self.partial_file),
+            destination_file=str(test.TEST_DESTINATION_FILE),
+            ecc_file=str(self.ecc_file),
+            ecc_existed=ecc_existed,
+            metadata_dir=str(self.metadata_dir),
+            checkpoint=str(test.TEST_DIRECTORY / "checkpoint.txt"),
+            resumable=False,
+        )
+
+    def test_store_rolled_forward(self):
+        tx = self.begin_store()
+        tx.data_synced(record=transaction.record_to_dict(self.record))
+        self.assertEqual(self.crash_and_recover(), 1)
+        self.assertFalse(self.partial_file.exists())
+        self.assertEqual(test.TEST_DESTINATION_FILE.read_text(), "hello world")
+        records = list(common.get_records(common.recordbook_path))
+        self.assertEqual([r.identity() for r in records], [self.record.identity()])
+        self.assertTrue((self.metadata_dir / common.recordbook_file_name).exists())
+        common.check_recordbook_md5(common.recordbook_checksum_file_path)
+        self.assertEqual(LOG_PATH.read_text(), "")
+
+    def test_store_rolled_back(self):
+        self.begin_store()
+        self.assertEqual(self.crash_and_recover(), 1)
+        self.assertFalse(self.partial_file.exists())
+        self.assertFalse(self.ecc_file.exists())
+        self.assertFalse(test.TEST_DESTINATION_FILE.exists())
+        self.assertFalse(common.recordbook_path.exists())
+
+    def test_store_rolled_back_keeps_ecc_of_same_content(self):
+        # another file with the same content was archived with this ECC
+        self.begin_store(ecc_existed=True)
+        self.assertEqual(self.crash_and_recover(), 1)
+        self.assertFalse(self.partial_file.exists())
+        self.assertEqual(self.ecc_file.read_text(), "ecc")
+
+    def test_refresh(self):
+        recovery_file = test.TEST_DESTINATION_DIRECTORY / "test_source.rec"
+        payload = dict(
+            file=str(test.TEST_DESTINATION_FILE),
+            ecc_file=str(self.ecc_file),
+            recovery_file=str(recovery_file),
+            recovery_ecc_file=str(self.ecc_file.with_suffix(".rec")),
+        )
+        for synced in (False, True):
+            test.TEST_DESTINATION_FILE.write_text("old")
+            recovery_file.write_text("new")
+            self.ecc_file.with_suffix(".rec").write_text("new ecc")
+            tx = self.log.begin("refresh", **payload)
+            if synced:
+                tx.data_synced()
+            self.crash_and_recover()
+            self.assertFalse(recovery_file.exists())
+            self.assertEqual(
+                test.TEST_DESTINATION_FILE.read_text(), "new" if synced else "old"
+            )
+
+    def test_aborted_on_error(self):
+        with self.assertRaises(common.LTAError):
+            with self.begin_store():
+                raise common.LTAError("failed")
+        self.assertFalse(self.partial_file.exists())
+        self.assertEqual(LOG_PATH.read_text(), "")
+        self.assertEqual(self.crash_and_recover(), 0)
+
+    def test_delete(self):
+        test.write_test_recorbook()
+        record = list(common.get_records(common.recordbook_path))[0]
+        self.log.begin("delete", record=transaction.record_to_dict(record))
+        self.crash_and_recover()
+        record = list(common.get_records(common.recordbook_path))[0]
+        self.assertTrue(record.deleted)
+        self.assertEqual(
+            common.read_recordbook_header(common.recordbook_path).generation,
+            record.generation,
+        )
+
+    def test_stale_record_deleted(self):
+        test.write_test_recorbook()
+        store.file_not_exists_in_recordbook(
+            test.TEST_FILE_CHECKSUM,
+            test.TEST_SOURCE_FILE.name,
+            test.TEST_DIRECTORY / "gone",
+        )
+        records = list(common.get_records(common.recordbook_path))
+        self.assertEqual(len(records), 1)
+        self.assertTrue(records[0].deleted)
+
+    def test_no_recovery_while_other_process_runs(self):
+        self.begin_store()
+        other = transaction.TransactionLog(LOG_PATH)
+        try:
+            self.assertEqual(other.recover(), 0)
+        finally:
+            other.close()
+        self.assertTrue(self.partial_file.exists())
+
+    def test_recovery_while_other_process_is_idle(self):
+        idle = transaction.TransactionLog(LOG_PATH)
+        try:
+            self.begin_store()
+            # idle doesn't keep the interrupted store from being recovered
+            self.assertEqual(self.crash_and_recover(), 1)
+        finally:
+            idle.close()
+        self.assertFalse(self.partial_file.exists())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import dataclasses
+import datetime
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import common, verify
+
+
+def make_record(destination: str = "uuid", file_name: str = "test_source"):
+    return common.Record(
+        timestamp=datetime.datetime.now(),
+        source=test.TEST_SOURCE_FILE,
+        destination=destination,
+        file_name=file_name,
+        checksum=test.TEST_FILE_CHECKSUM,
+        ecc_checksum=test.TEST_FILE_CHECKSUM,
+    )
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        test.TEST_DESTINATION_FILE.write_text("hello world")
+        # any file works as the ECC as long as the record has its checksum
+        test.TEST_CHECKSUM_FILE.parent.mkdir(parents=True)
+        test.TEST_CHECKSUM_FILE.write_text("hello world")
+        self.roots = verify.DeviceRoots()
+        self.roots.add("uuid", test.TEST_DESTINATION_DIRECTORY)
+
+    def test_valid(self):
+        results = verify.verify_records([make_record()], self.roots)
+        self.assertEqual([result.status for result in results], ["VALID"])
+        self.assertTrue(results[0].ok)
+
+    def test_corrupted(self):
+        test.TEST_DESTINATION_FILE.write_text("hello world!")
+        results = verify.verify_records([make_record()], self.roots)
+        self.assertEqual(results[0].status, "CORRUPTED")
+        self.assertFalse(results[0].ok)
+
+    def test_device_not_connected(self):
+        def missing(uuid):
+            raise AttributeError(f"Could not find the device {uuid}")
+
+        with mock.patch.object(common, "get_root_from_uuid", missing):
+            results = verify.verify_records(
+                [make_record("other"), make_record("other", "b")], self.roots
+            )
+        self.assertEqual(
+            [result.status for result in results], [verify.SKIPPED, verify.SKIPPED]
+        )
+        self.assertTrue(all(result.ok for result in results))
+        # nothing was checked
+        self.assertEqual(verify.exit_code(results), 2)
+        results.append(verify.Result(make_record(), common.Validation.VALID.name))
+        self.assertEqual(verify.exit_code(results), 0)
+        results.append(verify.Result(make_record(), verify.ERROR))
+        self.assertEqual(verify.exit_code(results), 1)
+
+    def test_interleave_devices(self):
+        records = [
+            make_record("a", "1"),
+            make_record("a", "2"),
+            make_record("b", "3"),
+        ]
+        self.assertEqual(
+            [record.file_name for record in verify.interleave_devices(records)],
+            ["1", "3", "2"],
+        )
+
+    def test_current_records(self):
+        record = make_record()
+        record.write(common.recordbook_path)
+        record.write(common.recordbook_path)
+        gone = make_record(file_name="gone")
+        gone.write(common.recordbook_path)
+        dataclasses.replace(gone, deleted=True).write(common.recordbook_path)
+        self.assertEqual(
+            [record.file_name for record in verify.current_records()], ["test_source"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import test
+from ltarchiver import common, jobs, watch
+
+
+class MyTestCase(test.BaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.staging = (test.TEST_DIRECTORY / "staging").resolve()
+        self.staging.mkdir()
+        self.ingester = watch.Ingester(
+            self.staging, [test.TEST_DESTINATION_DIRECTORY], settle=0, batch_size=2
+        )
+
+    def drop(self, name: str, content: bytes = b"content"):
+        path = self.staging / name
+        path.write_bytes(content)
+        return path
+
+    def test_debounce(self):
+        first = self.drop("first")
+        self.drop(".partial")
+        self.ingester.scan()
+        self.assertEqual(list(self.ingester.pending), [first])
+        # still being written
+        first.write_bytes(b"more content")
+        self.assertEqual(self.ingester.ready(), [])
+        self.assertEqual(self.ingester.ready(), [first])
+        self.assertEqual(self.ingester.pending, {})
+
+    def test_poller(self):
+        first = self.drop("first")
+        poller = watch.Poller(self.staging, interval=0)
+        self.assertEqual(poller.changed(0), [first])
+        self.assertEqual(poller.changed(0), [])
+        second = self.drop("second")
+        self.assertEqual(poller.changed(0), [second])
+
+    def test_inotify(self):
+        watcher = watch.open_watcher(self.staging)
+        if not isinstance(watcher, watch.Inotify):
+            self.skipTest("inotify isn't available")
+        try:
+            with (self.staging / "file").open("wb") as f:
+                f.write(b"content")
+                # not reported until it's closed
+                self.assertEqual(watcher.changed(0), [])
+            (test.TEST_DIRECTORY / "moved").write_bytes(b"content")
+            (test.TEST_DIRECTORY / "moved").rename(self.staging / "moved")
+            self.assertEqual(
+                watcher.changed(1), [self.staging / "file", self.staging / "moved"]
+            )
+        finally:
+            watcher.close()
+
+    def test_run(self):
+        batches = []
+        done = threading.Event()
+
+        def run_jobs(job_list, writers_per_device, remove_sources, codec):
+            self.assertFalse(remove_sources)
+            sources = [job.source for job in job_list]
+            error = common.LTAError("Could not store it")
+            batches.append(sources)
+            failures = []
+            for source in sources:
+                if source.name == "bad" and len(batches) < 4:
+                    failures.append(
+                        jobs.Failure(source, test.TEST_DESTINATION_DIRECTORY, error)
+                    )
+            if len(batches) == 4:
+                done.set()
+            return failures
+
+        for name in ("a", "b", "bad"):
+            self.drop(name)
+        stop = threading.Event()
+        watcher = watch.Poller(self.staging, interval=0.05)
+        with mock.patch.object(jobs, "run_jobs", run_jobs), mock.patch.object(
+            watch, "retry_delay", 0.1
+        ), mock.patch.object(watch, "max_retry_delay", 0.15):
+            thread = threading.Thread(target=self.ingester.run, args=(watcher, stop))
+            thread.start()
+            try:
+                # tried again after 0.1 and 0.15 seconds
+                self.assertTrue(done.wait(5))
+            finally:
+                stop.set()
+                thread.join()
+        self.assertEqual(sorted(map(len, batches[:2])), [1, 2])
+        self.assertEqual(batches[2:], [[self.staging / "bad"]] * 2)
+        self.assertEqual(list(self.staging.iterdir()), [])
+        self.assertEqual(self.ingester.failed, {})
+
+    def test_failed_file_backs_off(self):
+        path = self.drop("bad")
+        failure = jobs.Failure(
+            path, test.TEST_DESTINATION_DIRECTORY, common.LTAError("Could not")
+        )
+        with mock.patch.object(jobs, "run_jobs", return_value=[failure]):
+            self.ingester.store([path])
+            deadline, _ = self.ingester.pending[path]
+            self.assertGreater(deadline, time.monotonic() + watch.retry_delay / 2)
+            # noticing it again doesn't bring its next try forward
+            self.ingester.scan()
+            self.assertEqual(self.ingester.pending[path][0], deadline)
+            self.ingester.store([path])
+        self.assertEqual(self.ingester.failed[path], 2 * watch.retry_delay)
+        self.assertTrue(path.exists())
+
+    def test_changed_while_stored(self):
+        path = self.drop("file")
+
+        def run_jobs(*args, **kwargs):
+            path.write_bytes(b"new content")
+            return []
+
+        with mock.patch.object(jobs, "run_jobs", run_jobs):
+            self.ingester.store([path])
+        self.assertEqual(path.read_bytes(), b"new content")
+        self.assertEqual(list(self.ingester.pending), [path])
+
+if __name__ == "__main__":
+    unittest.main()